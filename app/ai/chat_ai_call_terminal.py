@@ -1,20 +1,22 @@
 # to run the file run the following command : poetry run python -m app.ai.chat_ai_call_terminal
+# batch mode (no LLM): poetry run python -m app.ai.chat_ai_call_terminal --batch queries.csv --output results.csv
+import argparse
+import csv
 import json
 import os
 import asyncio
+import sys
+import time
 from dotenv import load_dotenv
-from openai import OpenAI
-from ..utils.utils import (get_transit_times, operatorId_to_name, get_user_input, detect_language, get_lines_at_stop,
-                           fetch_and_decode_alerts, filter_alerts)
-from ..utils.schema import (get_transit_times_function, get_lines_at_stop_function)
+from ..utils.utils import (get_openai_client, get_transit_times, operatorId_to_name, get_user_input,
+                           detect_language, fetch_and_decode_alerts, filter_alerts, close_http_client,
+                           stop_times_cache)
+from ..utils.schema import OPENAI_FUNCTIONS, dispatch_tool
 from langdetect import detect, DetectorFactory
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
 # Get the directory of the current script
 script_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(script_dir)
@@ -118,11 +120,65 @@ async def process_successful_result(result, current_language, messages):
         return True
 
 
+async def print_transit_times_alerts(result):
+    """Print the service alert of the line, if any."""
+    if result.get('success'):
+        # Await the fetch_and_decode_alerts coroutine to get the result
+        alerts = await fetch_and_decode_alerts()
+        if alerts is not None:
+            # Pass the result to filter_alerts
+            changes = await filter_alerts(alerts, result["line_number"])
+            if changes:
+                print("CHANGES_HEAD_HE", f"{changes[0]['Header_text_he']}")
+                print("CHANGES_DESCR_HE", f"{changes[0]['Description_text_he']}")
+
+
+async def print_lines_at_stop(result):
+    """Print the lines stopping at the stop."""
+    print(f"For stop {result['stop_number']}, the following lines are passing through: ")
+    print(", ".join(result['lines_list']))
+
+
+async def print_arrival_board(result):
+    """Print the next arrivals of every line at the stop."""
+    if result.get('success'):
+        print(f"Next arrivals at stop {result['stop_number']} (minutes):")
+        for line in result['lines']:
+            print(f"{line['line_number']} ({line['english_name'] or line['agency']}): "
+                  f"{', '.join(map(str, line['etas']))}")
+
+
+async def print_vehicle_location(result):
+    """Print where the next bus of the line is."""
+    if result.get('success'):
+        distance = f"{result['distance_meters']} m" if result['distance_meters'] is not None else "unknown distance"
+        print(f"Next bus of line {result['line_number']} to stop {result['stop_number']} "
+              f"(in {result['eta_minutes']} min): {result['latitude']}, {result['longitude']} "
+              f"({distance}, position {result['age_seconds']}s old)")
+
+
+async def print_vehicles_nearby(result):
+    """Print the buses near the stop or location, nearest first."""
+    if result.get('success'):
+        print(f"Buses within {result['radius_meters']} m:")
+        for vehicle in result['vehicles']:
+            print(f"{vehicle['line_number']}: {vehicle['distance_meters']} m (vehicle {vehicle['vehicle_id']})")
+
+
+# What to show for the result of each tool, before the common success/error handling
+RESULT_HANDLERS = {
+    "get_transit_times": print_transit_times_alerts,
+    "get_lines_at_stop": print_lines_at_stop,
+    "get_arrival_board": print_arrival_board,
+    "get_vehicle_location": print_vehicle_location,
+    "get_vehicles_nearby": print_vehicles_nearby,
+}
+
+
 async def chat_with_ai():
     """Main chat function with OpenAI."""
     current_language = None
     timeout_seconds = 30
-    functions = [get_transit_times_function(), get_lines_at_stop_function()]
 
     messages = [{
         "role": "system",
@@ -156,10 +212,10 @@ async def chat_with_ai():
         messages.append({"role": "user", "content": user_input})
 
         try:
-            response = client.chat.completions.create(
+            response = get_openai_client().chat.completions.create(
                 model="gpt-4",
                 messages=messages,
-                functions=functions,
+                functions=OPENAI_FUNCTIONS,
                 function_call="auto"
             )
 
@@ -180,38 +236,19 @@ async def chat_with_ai():
                 function_args = json.loads(response_message.function_call.arguments)
 
                 try:
-                    if function_name == "get_transit_times":
-                        result = await get_transit_times(
-                            stop_number=function_args["stop_number"],
-                            line_number=function_args["line_number"],
-                            operator_id=function_args.get("agency"),
-                            detected_language=current_language
-                        )
-                        # print("RESULT. ", result)
-                        if result:
-                            # Await the fetch_and_decode_alerts coroutine to get the result
-                            alerts = await fetch_and_decode_alerts()
-                            if alerts is not None:
-                                # Pass the result to filter_alerts
-                                changes = await filter_alerts(alerts, result["line_number"])
-                                if changes:
-                                    print("CHANGES_HEAD_HE", f"{changes[0]['Header_text_he']}")
-                                    print("CHANGES_DESCR_HE", f"{changes[0]['Description_text_he']}")
-                    elif function_name == "get_lines_at_stop":
-                        stop_number = function_args["stop_number"]  # Ensure this is a dictionary
-                        result = await get_lines_at_stop(stop_number)
-                        print(f"For stop {stop_number}, the following lines are passing through: ")
-                        print(", ".join(result))
-                    else:
-                        raise ValueError(f"Unknown function: {function_name}")
+                    result = await dispatch_tool(function_name, function_args, detected_language=current_language)
+                    handler = RESULT_HANDLERS.get(function_name)
+                    if handler is not None:
+                        await handler(result)
 
                     if not result.get('success') and 'lines' in result:
                         result = await process_operator_selection(result, function_args)
 
                     if result.get('success'):
-                        should_continue = await process_successful_result(result, current_language, messages)
-                        if not should_continue:
-                            break
+                        if 'etas' in result:
+                            should_continue = await process_successful_result(result, current_language, messages)
+                            if not should_continue:
+                                break
                     else:
                         print(f"AI: Error - {result.get('error', 'Unknown error occurred')}")
                 except ValueError as e:
@@ -226,6 +263,148 @@ async def chat_with_ai():
         except Exception as e:
             print(f"Error: {e}")
 
+
+def read_queries(path: str) -> list:
+    """
+    Read the (stop, line, agency, problem) queries of a batch file.
+
+    A .jsonl file holds one {"stop": ..., "line": ..., "agency": ...} object per line; any other
+    file is read as CSV, where the first row is a header unless its stop is a number. Blank
+    lines and lines starting with # are skipped. A malformed line is kept as a query whose
+    problem names the line number, so it shows up as an error row of the results.
+    """
+    queries = []
+    first_row = True
+    with open(path, encoding="utf-8", newline="") as file:
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip() or line.startswith("#"):
+                continue
+            try:
+                if path.endswith(".jsonl"):
+                    query = json.loads(line)
+                    row = [query["stop"], query["line"], query.get("agency") or ""]
+                else:
+                    row = next(csv.reader([line]))
+                row = [str(cell).strip() for cell in row]
+            except KeyError as e:
+                queries.append(("", "", "", f"line {line_number}: missing field {e}"))
+                continue
+            except (ValueError, TypeError, AttributeError) as e:
+                queries.append(("", "", "", f"line {line_number}: unreadable query ({e})"))
+                continue
+            if first_row and not path.endswith(".jsonl") and not row[0].isdigit():
+                first_row = False
+                continue  # header
+            first_row = False
+            if len(row) < 2 or not row[0] or not row[1]:
+                queries.append((row[0] if row else "", "", "",
+                                f"line {line_number}: expected stop,line[,agency], got {line.strip()!r}"))
+                continue
+            queries.append((row[0], row[1], row[2] if len(row) > 2 else "", ""))
+    return queries
+
+
+async def resolve_query(stop: str, line: str, agency: str, semaphore: asyncio.Semaphore,
+                        problem: str = "") -> dict:
+    """
+    Arrival times of one query through the get_transit_times tool, without the LLM.
+
+    Any failure of the query (including a malformed line of the batch file) becomes a row
+    with the "error" status.
+    """
+    row = {"stop": stop, "line": line, "agency": agency, "status": "ok", "agency_name": "", "etas": [],
+           "error": "", "elapsed_ms": 0.0}
+    if problem:
+        row["status"] = "error"
+        row["error"] = problem
+        return row
+    arguments = {"stop_number": stop, "line_number": line}
+    if agency:
+        arguments["agency"] = agency
+    async with semaphore:
+        started = time.perf_counter()
+        try:
+            result = await dispatch_tool("get_transit_times", arguments)
+            if result.get("success"):
+                row["agency"] = result["agency"]
+                row["agency_name"] = operatorId_to_name(agency_file_path, result["agency"]).get("english_name", "")
+                row["etas"] = result["etas"]
+            elif "lines" in result:
+                # Several operators run this line number at the stop: the agency column picks one
+                row["status"] = "ambiguous"
+                row["error"] = "; ".join(result["lines"])
+            else:
+                row["status"] = "error"
+                row["error"] = result.get("error", "Unknown error occurred")
+        except Exception as e:
+            row["status"] = "error"
+            row["error"] = str(e) or type(e).__name__
+        row["elapsed_ms"] = round(1000 * (time.perf_counter() - started), 1)
+    return row
+
+
+def write_results(rows: list, output, output_format: str):
+    if output_format == "jsonl":
+        for row in rows:
+            output.write(json.dumps(row, ensure_ascii=False) + "\n")
+        return
+    writer = csv.DictWriter(output, fieldnames=list(rows[0]) if rows else ["stop", "line"])
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(dict(row, etas=" ".join(map(str, row["etas"]))))
+
+
+async def run_batch(queries_path: str, output_path: str = None, output_format: str = None,
+                    concurrency: int = 20):
+    """
+    Resolve a file of queries concurrently (at most `concurrency` at a time) and write the
+    results as CSV or JSON lines, in the order of the queries.
+
+    The queries share the pooled HTTP client and the SIRI cache: the queries of a stop cost one
+    upstream request.
+    """
+    queries = read_queries(queries_path)
+    if output_format is None:
+        output_format = "jsonl" if output_path and output_path.endswith(".jsonl") else "csv"
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.perf_counter()
+    try:
+        rows = await asyncio.gather(*(resolve_query(stop, line, agency, semaphore, problem)
+                                      for stop, line, agency, problem in queries))
+    finally:
+        await close_http_client()
+    elapsed = time.perf_counter() - started
+
+    if output_path:
+        with open(output_path, "w", encoding="utf-8", newline="") as output:
+            write_results(rows, output, output_format)
+    else:
+        write_results(rows, sys.stdout, output_format)
+
+    statuses = {status: sum(row["status"] == status for row in rows) for status in ("ok", "ambiguous", "error")}
+    cache = stop_times_cache.metrics()
+    print(f"{len(rows)} queries in {elapsed:.2f}s ({len(rows) / elapsed if elapsed else 0:.0f}/s): "
+          f"{statuses['ok']} ok, {statuses['ambiguous']} ambiguous, {statuses['error']} errors; "
+          f"SIRI requests: {cache['misses']} ({cache['hits'] + cache['coalesced']} served from the cache)",
+          file=sys.stderr)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Helpy in the terminal: a chat, or a batch of queries.")
+    parser.add_argument("--batch", metavar="QUERIES",
+                        help="CSV (stop,line[,agency]) or JSON lines file of queries, resolved without the LLM")
+    parser.add_argument("--output", help="Results file (default: standard output)")
+    parser.add_argument("--format", choices=["csv", "jsonl"],
+                        help="Results format (default: from the output file extension, else csv)")
+    parser.add_argument("--concurrency", type=int, default=20, help="Queries resolved at the same time")
+    args = parser.parse_args()
+    if args.batch:
+        asyncio.run(run_batch(args.batch, args.output, args.format, args.concurrency))
+    else:
+        asyncio.run(chat_with_ai())
+
+
 # async def main():
 #     # Await the fetch_and_decode_alerts coroutine to get the result
 #     alerts = await fetch_and_decode_alerts()
@@ -239,6 +418,6 @@ async def chat_with_ai():
 
 
 if __name__ == "__main__":
-    asyncio.run(chat_with_ai())
+    main()
     # asyncio.run(fetch_and_decode_alerts())
     # asyncio.run(main())
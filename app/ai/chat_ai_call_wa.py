@@ -2,22 +2,22 @@ import asyncio
 import json
 import logging
 import os
+import time
 from dotenv import load_dotenv
 from langdetect import DetectorFactory, LangDetectException
-from openai import OpenAI
 
+from app.utils.blocking import run_blocking
+from app.utils.logs import Truncated, configure_logging
 from app.utils.messaging import send_wait_message
-from app.utils.schema import get_transit_times_function, get_lines_at_stop_function, validate_transit_times
+from app.utils.metrics import timed
+from app.utils.schema import OPENAI_FUNCTIONS, TOOLS, ToolValidationError, dispatch_tool
+from app.utils.traffic_tape import traffic_tape
 
-from app.utils.utils import (get_transit_times, operatorId_to_name, get_lines_at_stop, detect_language,
-                             fetch_and_decode_alerts, filter_alerts)
+from app.utils.utils import get_openai_client, operatorId_to_name, detect_language, fetch_and_decode_alerts, filter_alerts, language_file_path
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI client
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
 # Get the directory of the current script
 script_dir = os.path.dirname(os.path.abspath(__file__))
 # Go up one level to get the parent directory
@@ -28,7 +28,7 @@ agency_file_path = os.path.join(parent_dir, 'data', 'agency_simple.txt')
 # Ensure consistent results from langdetect
 DetectorFactory.seed = 0
 
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 EXIT_KEYWORDS = {
@@ -83,10 +83,85 @@ LINES_AT_STOP_MSG = {
 }
 
 
+ARRIVAL_BOARD_MESSAGES = {
+    "en": "Next arrivals at stop {stop} (minutes):",
+    "he": "ההגעות הבאות לתחנה {stop} (בדקות):",
+    "fr": "Prochaines arrivées à l'arrêt {stop} (minutes) :",
+    "es": "Próximas llegadas a la parada {stop} (minutos):",
+    "it": "Prossimi arrivi alla fermata {stop} (minuti):",
+    "ar": "الوصولات التالية إلى المحطة {stop} (بالدقائق):",
+    "ru": "Ближайшие прибытия на остановку {stop} (минуты):"
+}
+
+NO_ARRIVALS_MESSAGES = {
+    "en": "No arrivals at stop {stop} in the next hour.",
+    "he": "אין הגעות לתחנה {stop} בשעה הקרובה.",
+    "fr": "Aucune arrivée à l'arrêt {stop} dans l'heure qui vient.",
+    "es": "No hay llegadas a la parada {stop} en la próxima hora.",
+    "it": "Nessun arrivo alla fermata {stop} nella prossima ora.",
+    "ar": "لا توجد وصولات إلى المحطة {stop} خلال الساعة القادمة.",
+    "ru": "В ближайший час на остановку {stop} ничего не прибывает."
+}
+
+ALERT_SET_MESSAGES = {
+    "en": "OK! I'll message you when line {line} is {minutes} minutes or less from stop {stop}.",
+    "he": "בסדר! אשלח לך הודעה כשקו {line} יהיה {minutes} דקות או פחות מתחנה {stop}.",
+    "fr": "D'accord ! Je vous écrirai quand la ligne {line} sera à {minutes} minutes ou moins de l'arrêt {stop}.",
+    "es": "¡De acuerdo! Te escribiré cuando la línea {line} esté a {minutes} minutos o menos de la parada {stop}.",
+    "it": "Va bene! Ti scriverò quando la linea {line} sarà a {minutes} minuti o meno dalla fermata {stop}.",
+    "ar": "حسنًا! سأراسلك عندما يكون الخط {line} على بعد {minutes} دقائق أو أقل من المحطة {stop}.",
+    "ru": "Хорошо! Я напишу вам, когда маршрут {line} будет в {minutes} минутах или меньше от остановки {stop}."
+}
+
+ALERTS_CANCELLED_MESSAGES = {
+    "en": "{count} arrival alert(s) cancelled.",
+    "he": "בוטלו {count} התראות הגעה.",
+    "fr": "{count} alerte(s) d'arrivée annulée(s).",
+    "es": "{count} alerta(s) de llegada cancelada(s).",
+    "it": "{count} avviso/i di arrivo annullato/i.",
+    "ar": "تم إلغاء {count} من تنبيهات الوصول.",
+    "ru": "Отменено оповещений о прибытии: {count}."
+}
+
+VEHICLE_LOCATION_MESSAGES = {
+    "en": "The next bus of line {line} (in {eta} minutes) is {distance} from stop {stop}: {map}",
+    "he": "האוטובוס הבא של קו {line} (בעוד {eta} דקות) נמצא {distance} מתחנה {stop}: {map}",
+    "fr": "Le prochain bus de la ligne {line} (dans {eta} minutes) est à {distance} de l'arrêt {stop} : {map}",
+    "es": "El próximo autobús de la línea {line} (en {eta} minutos) está a {distance} de la parada {stop}: {map}",
+    "it": "Il prossimo autobus della linea {line} (tra {eta} minuti) è a {distance} dalla fermata {stop}: {map}",
+    "ar": "الحافلة القادمة للخط {line} (خلال {eta} دقيقة) على بعد {distance} من المحطة {stop}: {map}",
+    "ru": "Следующий автобус маршрута {line} (через {eta} минут) в {distance} от остановки {stop}: {map}"
+}
+
+VEHICLES_NEARBY_MESSAGES = {
+    "en": "Buses within {radius} m:",
+    "he": "אוטובוסים בטווח {radius} מ':",
+    "fr": "Bus à moins de {radius} m :",
+    "es": "Autobuses a menos de {radius} m:",
+    "it": "Autobus entro {radius} m:",
+    "ar": "الحافلات ضمن {radius} م:",
+    "ru": "Автобусы в радиусе {radius} м:"
+}
+
+NO_VEHICLES_NEARBY_MESSAGES = {
+    "en": "No bus within {radius} m right now.",
+    "he": "אין כרגע אוטובוסים בטווח {radius} מ'.",
+    "fr": "Aucun bus à moins de {radius} m pour le moment.",
+    "es": "No hay autobuses a menos de {radius} m en este momento.",
+    "it": "Nessun autobus entro {radius} m al momento.",
+    "ar": "لا توجد حافلات ضمن {radius} م حاليًا.",
+    "ru": "Сейчас в радиусе {radius} м нет автобусов."
+}
+
+
+def map_link(latitude: float, longitude: float) -> str:
+    return f"https://maps.google.com/?q={latitude},{longitude}"
+
+
 async def process_successful_result(result, current_language):
     """Process successful result and handle follow-up."""
 
-    logger.info(f"current_language: {current_language}")
+    logger.debug("current_language: %s", current_language)
     if result['etas']:
         agency_name = operatorId_to_name(agency_file_path, result['agency'])
         formatted_times = ', '.join(map(str, result['etas'][:3]))
@@ -104,8 +179,7 @@ async def process_successful_result(result, current_language):
                 times=times
             )
         except KeyError as e:
-            logger.error(f"KeyError during message formatting: {e}")
-            logger.error(f"Current result: {result}")
+            logger.error("KeyError during message formatting: %s (result: %s)", e, Truncated(result))
             raise
 
         return eta_message
@@ -114,7 +188,7 @@ async def process_successful_result(result, current_language):
 async def process_successful_lines_at_stop(result, current_language):
     """Process successful result and handle follow-up."""
 
-    logger.info(f"current_language: {current_language}")
+    logger.debug("current_language: %s", current_language)
 
     if result['lines_list']:
         stop = result['stop_number']
@@ -126,14 +200,149 @@ async def process_successful_lines_at_stop(result, current_language):
                 lines=formatted_lines
             )
         except KeyError as e:
-            logger.error(f"KeyError during message formatting: {e}")
-            logger.error(f"Current result: {result}")
+            logger.error("KeyError during message formatting: %s (result: %s)", e, Truncated(result))
             raise
 
         return lines_at_stop_message
 
 
-async def chat_with_ai(user_message: str, user_id: str, messages: list = None):
+async def reply_transit_times(result, current_language):
+    """
+    Build the replies for get_transit_times: the line's service alert if any, then the ETAs.
+    """
+    replies = []
+    # Await the fetch_and_decode_alerts coroutine to get the result
+    alerts = await fetch_and_decode_alerts()
+    if alerts is not None:
+        # Pass the result to filter_alerts
+        changes = await filter_alerts(alerts, result["line_number"])
+        if changes:
+            reply_msg = (f"{changes[0]['Header_text_he'].strip()}\n"
+                         f"{changes[0]['Description_text_he'].strip()}")
+            replies.append({"role": "assistant", "content": f"WARNING for line {result['line_number']}"
+                                                            f":\n {reply_msg}"})
+    reply_message = await process_successful_result(result, current_language)
+    replies.append({"role": "assistant", "content": reply_message})
+    return replies
+
+
+async def reply_lines_at_stop(result, current_language):
+    """
+    Build the reply for get_lines_at_stop.
+    """
+    reply_message = await process_successful_lines_at_stop(result, current_language)
+    return [{"role": "assistant", "content": reply_message}]
+
+
+async def reply_arrival_board(result, current_language):
+    """
+    Build the arrival board: one line per bus line, "line (operator): ETAs".
+    """
+    stop = result["stop_number"]
+    if not result["lines"]:
+        reply_message = NO_ARRIVALS_MESSAGES.get(current_language, NO_ARRIVALS_MESSAGES["en"]).format(stop=stop)
+        return [{"role": "assistant", "content": reply_message}]
+    name_key = "hebrew_name" if current_language == "he" else "english_name"
+    rows = [ARRIVAL_BOARD_MESSAGES.get(current_language, ARRIVAL_BOARD_MESSAGES["en"]).format(stop=stop)]
+    for line in result["lines"]:
+        operator = line[name_key] or line["agency"]
+        rows.append(f"{line['line_number']} ({operator}): {', '.join(map(str, line['etas']))}")
+    return [{"role": "assistant", "content": "\n".join(rows)}]
+
+
+async def reply_subscribe_arrival(result, current_language):
+    """
+    Build the confirmation of subscribe_arrival_alert.
+    """
+    reply_message = ALERT_SET_MESSAGES.get(current_language, ALERT_SET_MESSAGES["en"]).format(
+        line=result["line_number"], minutes=result["threshold_minutes"], stop=result["stop_number"])
+    return [{"role": "assistant", "content": reply_message}]
+
+
+async def reply_cancel_arrival_alerts(result, current_language):
+    """
+    Build the confirmation of cancel_arrival_alerts.
+    """
+    reply_message = ALERTS_CANCELLED_MESSAGES.get(current_language, ALERTS_CANCELLED_MESSAGES["en"]).format(
+        count=result["cancelled"])
+    return [{"role": "assistant", "content": reply_message}]
+
+
+async def reply_vehicle_location(result, current_language):
+    """
+    Build the position of the next bus: its distance to the stop and a map link.
+    """
+    distance = f"{result['distance_meters']} m" if result["distance_meters"] is not None else "?"
+    reply_message = VEHICLE_LOCATION_MESSAGES.get(current_language, VEHICLE_LOCATION_MESSAGES["en"]).format(
+        line=result["line_number"], eta=result["eta_minutes"], distance=distance, stop=result["stop_number"],
+        map=map_link(result["latitude"], result["longitude"]))
+    return [{"role": "assistant", "content": reply_message}]
+
+
+async def reply_vehicles_nearby(result, current_language):
+    """
+    Build the list of the buses nearby: one line per bus, "line: distance".
+    """
+    radius = result["radius_meters"]
+    if not result["vehicles"]:
+        reply_message = NO_VEHICLES_NEARBY_MESSAGES.get(current_language, NO_VEHICLES_NEARBY_MESSAGES["en"]).format(
+            radius=radius)
+        return [{"role": "assistant", "content": reply_message}]
+    rows = [VEHICLES_NEARBY_MESSAGES.get(current_language, VEHICLES_NEARBY_MESSAGES["en"]).format(radius=radius)]
+    for vehicle in result["vehicles"]:
+        rows.append(f"{vehicle['line_number']}: {vehicle['distance_meters']} m")
+    return [{"role": "assistant", "content": "\n".join(rows)}]
+
+
+# How the successful result of each tool is turned into WhatsApp replies
+RESULT_HANDLERS = {
+    "get_transit_times": reply_transit_times,
+    "get_lines_at_stop": reply_lines_at_stop,
+    "get_arrival_board": reply_arrival_board,
+    "get_vehicle_location": reply_vehicle_location,
+    "get_vehicles_nearby": reply_vehicles_nearby,
+    "subscribe_arrival_alert": reply_subscribe_arrival,
+    "cancel_arrival_alerts": reply_cancel_arrival_alerts,
+}
+
+
+def create_completion(messages: list) -> tuple:
+    """
+    Call the LLM with the transit functions (blocking: run it in the shared thread pool; the
+    client itself is created there too, as the first call imports openai).
+
+    Returns:
+        tuple: (completion, seconds spent waiting for the API).
+    """
+    client = get_openai_client()
+    started = time.perf_counter()
+    response = client.chat.completions.create(
+        model="gpt-4o",
+        messages=messages,
+        functions=OPENAI_FUNCTIONS,
+        function_call="auto"
+    )
+    return response, time.perf_counter() - started
+
+
+async def detect_user_language(user_message: str, default: str = "en") -> str:
+    """
+    Language of a user message. A message of digits only (a stop or line number), or one whose
+    language can't be detected, keeps `default`, e.g. the language of the user's previous turn.
+    """
+    message = user_message.strip()
+    if not message or message.isdigit() or not os.path.exists(language_file_path):
+        return default
+    try:
+        detected_language = await run_blocking(detect_language, message)
+        logger.info("Detected language: %s", detected_language)
+        return detected_language
+    except LangDetectException:
+        logger.info("Language detection failed. Falling back to %s.", default)
+        return default
+
+
+async def chat_with_ai(user_message: str, user_id: str, messages: list = None, detected_language: str = None):
     """
     Main chat function with OpenAI. This function detects the language of the user's input
     and responds in the same language (fallback to English if unsupported).
@@ -142,6 +351,7 @@ async def chat_with_ai(user_message: str, user_id: str, messages: list = None):
         user_message (str): The user's input message.
         messages (list): A list of messages representing the conversation so far.
         user_id (str): The user's id used to send him a wait message.
+        detected_language (str): Language of the turn, detected from the message if not given.
 
     Returns:
         dict: AI's response as a dictionary with the updated messages list.
@@ -150,41 +360,24 @@ async def chat_with_ai(user_message: str, user_id: str, messages: list = None):
     if messages is None:
         messages = []
 
-    # Try to get the detected language from the conversation state
-    if hasattr(chat_with_ai, 'detected_language'):
-        detected_language = chat_with_ai.detected_language
-    else:
-        if user_message.strip().isdigit():
-            detected_language = "en"
-        else:
-            try:
-                detected_language = detect_language(user_message)
-                logger.info(f"Detected language: {detected_language}")
-            except LangDetectException:
-                detected_language = "en"
-                logger.info("Language detection failed. Falling back to English.")
-
-        # Store the detected language as a function attribute
-        chat_with_ai.detected_language = detected_language
+    if detected_language is None:
+        detected_language = await detect_user_language(user_message)
 
     # Log detected language
-    logger.info(f"Using language: {detected_language}")
+    logger.debug("Using language: %s", detected_language)
 
     # Case 0 : Exit by keywords in multiple languages
     # Initialize the language of communication (starting with None for detection)
 
     try:
-        logger.info("MESSAGES BEFORE CLEANING: %s", messages)
-        logger.info("USER MESSAGE: %s", user_message)
-
         # Clean messages - only keep messages with role and content
         clean_messages = [msg for msg in messages if msg.get('role') and msg.get('content')]
+        logger.info("Turn for user %s: %d messages in history (%d after cleaning), user message: %s",
+                    user_id, len(messages), len(clean_messages), Truncated(user_message, 120))
         messages = clean_messages
 
-        logger.info("MESSAGES AFTER CLEANING: %s", messages)
-
         # Check for exit keywords
-        if user_message.lower().strip() in EXIT_KEYWORDS.get(chat_with_ai.detected_language, EXIT_KEYWORDS["en"]):
+        if user_message.lower().strip() in EXIT_KEYWORDS.get(detected_language, EXIT_KEYWORDS["en"]):
             exit_message = EXIT_MESSAGES.get(detected_language, EXIT_MESSAGES["en"])
             messages.append({"role": "assistant", "content": exit_message})
             return messages
@@ -218,16 +411,11 @@ async def chat_with_ai(user_message: str, user_id: str, messages: list = None):
         # Add the user's first input
         messages.append({"role": "user", "content": user_message.strip()})
 
-        # Prepare functions for OpenAI
-        functions = [get_transit_times_function(), get_lines_at_stop_function()]
-
-        # Call OpenAI with function calling
-        response = openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            functions=functions,
-            function_call="auto"
-        )
+        # Call OpenAI with function calling (the client is synchronous: it runs in the shared thread pool)
+        with timed("llm"):
+            response, seconds = await run_blocking(create_completion, messages)
+            if traffic_tape is not None:
+                traffic_tape.record_completion(messages, response.model_dump(), seconds)
 
         # Parse OpenAI's response
         response_message = response.choices[0].message
@@ -244,52 +432,22 @@ async def chat_with_ai(user_message: str, user_id: str, messages: list = None):
             function_args = json.loads(response_message.function_call.arguments)
 
             try:
-                if function_name == "get_transit_times":
-                    # Validate input and process request
-                    if validate_transit_times(function_args):
-                        result = await get_transit_times(
-                            stop_number=function_args["stop_number"],
-                            line_number=function_args["line_number"],
-                            operator_id=function_args.get("agency"),
-                            detected_language=chat_with_ai.detected_language
-                        )
-                        logger.info(f"get_transit_times response: {result}")
-                        logger.info(f"chat_with_ai.detected_language: {chat_with_ai.detected_language}")
-                        if result.get('success'):
-                            # Await the fetch_and_decode_alerts coroutine to get the result
-                            alerts = await fetch_and_decode_alerts()
-                            reply_msg = ""
-                            if alerts is not None:
-                                # Pass the result to filter_alerts
-                                changes = await filter_alerts(alerts, result["line_number"])
-                                if changes:
-                                    reply_msg = (f"{changes[0]['Header_text_he'].strip()}\n"
-                                                 f"{changes[0]['Description_text_he'].strip()}")
-                                    messages.append({"role": "assistant", "content": f"WARNING for line {result['line_number']}"
-                                                                                     f":\n {reply_msg}"})
-                            reply_message = await process_successful_result(result, chat_with_ai.detected_language)
-                            messages.append({"role": "assistant", "content": reply_message})
-                        else:
-                            error_message = result.get('error', "An unknown error occurred.")
-                            messages.append({"role": "assistant", "content": error_message})
-                    else:
-                        messages.append({"role": "assistant", "content": "Invalid transit request parameters."})
-
-                elif function_name == "get_lines_at_stop":
-                    stop_number = function_args["stop_number"]
-                    await send_wait_message(chat_with_ai.detected_language, user_id)
-                    result = await get_lines_at_stop(stop_number)
-                    logger.info(f"Detected language for message: {chat_with_ai.detected_language}")
-                    if result.get('success'):
-                        reply_message = await process_successful_lines_at_stop(result, chat_with_ai.detected_language)
-                        messages.append({"role": "assistant", "content": reply_message})
-                    else:
-                        error_message = result.get('error', "An unknown error occurred.")
-                        messages.append({"role": "assistant", "content": error_message})
+                tool = TOOLS.get(function_name)
+                if tool is not None and tool.slow:
+                    await send_wait_message(detected_language, user_id)
+                with timed("tool", tool=function_name):
+                    result = await dispatch_tool(function_name, function_args,
+                                                 detected_language=detected_language)
+                logger.info("%s response: %s", function_name, Truncated(result))
+                if result.get('success'):
+                    messages.extend(await RESULT_HANDLERS[function_name](result, detected_language))
                 else:
-                    raise ValueError(f"Unknown function: {function_name}")
+                    error_message = result.get('error', "An unknown error occurred.")
+                    messages.append({"role": "assistant", "content": error_message})
+            except ToolValidationError:
+                messages.append({"role": "assistant", "content": "Invalid transit request parameters."})
             except Exception as e:
-                logger.error(f"Error: {e}")
+                logger.error("Error: %s", e)
                 messages.append({"role": "assistant", "content": f"An error occurred: {str(e)}"})
                 return messages
         else:
@@ -297,6 +455,6 @@ async def chat_with_ai(user_message: str, user_id: str, messages: list = None):
             messages.append(response_dict)
         return messages
     except Exception as e:
-        logger.error(f"Error: {e}")
+        logger.error("Error: %s", e)
         messages.append({"role": "assistant", "content": f"An error occurred: {str(e)}"})
     return messages
@@ -1,21 +1,157 @@
-from fastapi import FastAPI, Request
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Path, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import httpx
-from app.ai.chat_ai_call_wa import chat_with_ai
-from app.utils.messaging import send_whatsapp_message, send_whatsapp_response
+from app.ai.chat_ai_call_wa import chat_with_ai, detect_user_language
+from app.utils.arrival_archive import arrival_archive
+from app.utils.blocking import blocking_executors, run_blocking
+from app.utils.conversation_store import create_conversation_store
+from app.utils.dedup import SeenMessageIds
+from app.utils.http_cache import cacheable_response, render_json
+from app.utils.live_board import TooManyConnections, live_board_hub
+from app.utils.logs import configure_logging, new_turn_id
+from app.utils.messaging import (generate_slow_down_message, generate_voice_error_message, send_whatsapp_response,
+                                 whatsapp_sender)
+from app.utils.metrics import render_gauges, render_metrics, timed
+from app.utils.profiling import PROFILE_HEADER, RequestProfiler
+from app.utils.rate_limit import RateLimiter
+from app.utils.subscriptions import current_chat, subscription_scheduler
+from app.utils.traffic_tape import traffic_tape
+from app.utils.utils import (alerts_upstream, close_http_client, get_cached_board, get_cached_times,
+                             get_lines_at_stop, gtfs_store_metrics, siri_upstream, stop_times_cache, warm_up)
+from app.utils.vehicle_positions import vehicle_positions
+from app.utils.voice import voice_pipeline
+from app.utils.watchdog import LoopWatchdog
+
+configure_logging()
+logger = logging.getLogger(__name__)
+
+# Conversation history per user (in memory, or in a database shared by the workers)
+conversation_history = create_conversation_store()
+
+# IDs of the messages already received, to drop the webhooks redelivered by WHAPI
+seen_message_ids = SeenMessageIds.from_env()
+
+# Token buckets per user, per chat and global, checked before calling the AI
+rate_limiter = RateLimiter.from_env()
+
+# user_id -> [lock, turns holding or waiting for it] of the users with a turn running
+_user_locks = {}
 
-app = FastAPI()
+# Opt-in profiling of webhook requests (by header or sampled)
+request_profiler = RequestProfiler.from_env()
 
-# Global dictionary to store conversation history per user
-conversation_history = {}  # Declare this at the module level
+# Keys of the upstream metrics that only ever increase (rendered as Prometheus counters)
+UPSTREAM_COUNTERS = ("circuit_opened", "calls", "failures", "timeouts", "short_circuited", "hedged", "hedge_wins")
+
+# How long clients and CDNs may reuse the lines of a stop (they only change with the GTFS files)
+STOP_LINES_MAX_AGE = int(os.getenv("STOP_LINES_MAX_AGE", 3600))
+
+# Event-loop lag measurement and reports of the callbacks blocking the loop (None if disabled)
+loop_watchdog = LoopWatchdog.from_env()
+
+
+async def run_warm_up(app: FastAPI):
+    """
+    Load the models, tables and clients in the background, then mark the app ready.
+    """
+    try:
+        app.state.warm_up = await warm_up()
+        logger.info("Warm-up done: %s", app.state.warm_up)
+    except Exception as e:
+        logger.error("Warm-up failed: %s", e)
+        app.state.warm_up = {"error": str(e)}
+    app.state.ready = True
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.ready = False
+    app.state.warm_up = {}
+    if loop_watchdog is not None:
+        loop_watchdog.start()
+    await conversation_history.start()
+    whatsapp_sender.start()
+    voice_pipeline.check()
+    subscription_scheduler.start()
+    if arrival_archive is not None:
+        arrival_archive.start()
+    if traffic_tape is not None:
+        traffic_tape.start()
+    if vehicle_positions is not None:
+        vehicle_positions.start()
+    # The server accepts connections right away; /ready reports when the warm-up is done
+    warm_up_task = asyncio.create_task(run_warm_up(app))
+    yield
+    warm_up_task.cancel()
+    await live_board_hub.stop()
+    await subscription_scheduler.stop()
+    if arrival_archive is not None:
+        await arrival_archive.stop()
+    if traffic_tape is not None:
+        await traffic_tape.stop()
+    if vehicle_positions is not None:
+        await vehicle_positions.stop()
+    # Waits for the transcriptions running in the process pool, off the event loop
+    await run_blocking(voice_pipeline.shutdown)
+    await whatsapp_sender.stop()
+    await conversation_history.stop()
+    await close_http_client()
+    blocking_executors.shutdown()
+    if loop_watchdog is not None:
+        await loop_watchdog.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.post("/webhook/whatsapp")
-async def whatsapp_webhook(request: Request):
+async def whatsapp_webhook(request: Request, background_tasks: BackgroundTasks):
     """
     Handle incoming WhatsApp messages from WHAPI and respond using AI.
+
+    The request is profiled when it carries the X-Helpy-Profile header (set to PROFILE_TOKEN)
+    or is picked by the profiling sample rate, and recorded on the traffic tape when one is set.
+    """
+    handler = handle_whatsapp_webhook
+    if traffic_tape is not None and traffic_tape.recording:
+        handler = record_whatsapp_webhook
+    if request_profiler.should_profile(request.headers):
+        async with request_profiler.profile("whatsapp_webhook"):
+            return await handler(request, background_tasks)
+    return await handler(request, background_tasks)
+
+
+async def record_whatsapp_webhook(request: Request, background_tasks: BackgroundTasks):
+    """
+    Handle the webhook, then queue its payload and timing on the traffic tape.
     """
-    global conversation_history
+    started = time.perf_counter()
+    result = await handle_whatsapp_webhook(request, background_tasks)
+    try:
+        payload = await request.json()
+    except ValueError:
+        return result
+    traffic_tape.record_webhook(payload, started, time.perf_counter() - started,
+                                "ok" if result.get("success") else "error")
+    return result
+
 
+async def handle_whatsapp_webhook(request: Request, background_tasks: BackgroundTasks):
+    """
+    WHAPI may batch several messages (and several statuses) in one delivery, so the whole
+    batch is handled as a unit: messages are grouped per chat and user, consecutive texts
+    of a group are merged into a single AI turn, and the groups are processed concurrently.
+    Groups holding a voice message take seconds to transcribe, so they are processed after
+    the webhook has answered.
+    """
     try:
 
         # Parse the incoming JSON payload from WHAPI
@@ -25,63 +161,25 @@ async def whatsapp_webhook(request: Request):
         event_type = body.get('event', {}).get('type', '')
 
         if event_type == "messages":
-            message_data = body.get("messages")[0]
-            if not message_data["from_me"]:
-                chat_id_address = message_data["chat_id"]
-                chat_id, chat_type = chat_id_parsor(chat_id_address)
-                user_id = message_data["from"]  # WhatsApp user ID
-                if message_data.get("type", '') == "text":
-                    user_message = message_data.get("text", {}).get("body", "").strip()
-
-                    # Retrieve or initialize conversation history for this user
-                    if user_id not in conversation_history:
-                        conversation_history[user_id] = []
-
-                    # Interact with the AI
-                    if user_message:
-                        ai_response = await chat_with_ai(user_message, user_id, messages=conversation_history[user_id])
-                        # Save the updated conversation history
-                        conversation_history[user_id] = ai_response  # This includes the entire chat so far
-                        # Send the response back to the user via WHAPI
-                        async with httpx.AsyncClient() as client:
-                            recipient_id = (
-                                chat_id + "@g.us" if chat_type == "g.us"
-                                else user_id + "@s.whatsapp.net"
-                            )
-                            await send_whatsapp_response(client, recipient_id, ai_response)
-
-                if message_data.get("type", '') == "voice":
-                    user_voice_message = message_data.get("voice", {}).get("link", "").strip()
-
-                    # Retrieve or initialize conversation history for this user
-                    if user_id not in conversation_history:
-                        conversation_history[user_id] = []
-
-                    # Interact with the AI
-                    if user_voice_message:
-                        # download the audio message
-                        # convert with ffmpeg in mp3
-                        # transcription of the audio with openai-whisper
-                        # send to Helpy
-                        ai_response = await chat_with_ai(user_voice_message, user_id, messages=conversation_history[user_id])
-                        # Save the updated conversation history
-                        conversation_history[user_id] = ai_response  # This includes the entire chat so far
-                        # Send the response back to the user via WHAPI
-                        async with httpx.AsyncClient() as client:
-                            recipient_id = user_id
-                            await send_whatsapp_message(client, recipient_id, ai_response[-1]["content"])
+            batches = group_messages_by_chat(body.get("messages") or [])
+            voice_batches = {key: batch for key, batch in batches.items()
+                             if any(message_data.get("type") == "voice" for message_data in batch)}
+            text_batches = {key: batch for key, batch in batches.items() if key not in voice_batches}
+            if voice_batches:
+                background_tasks.add_task(process_chat_batches, voice_batches)
+            await process_chat_batches(text_batches)
 
         elif event_type == 'statuses':
             # Handle status updates (read receipts, etc.)
-            print(f"Status event received: {body['statuses']}")
+            handle_statuses(body.get("statuses") or [])
 
         else:
-            print(f"Unknown event type: {event_type}")
+            logger.warning("Unknown event type: %s", event_type)
 
         return {"success": True}
 
     except Exception as e:
-        print(f"Error in whatsapp_webhook: {e}")
+        logger.error("Error in whatsapp_webhook: %s", e)
         return {"status": "error", "reason": str(e)}
 
 
@@ -90,8 +188,6 @@ async def sms_webhook(request: Request):
     """
     Handle incoming SMS messages from operator and respond using AI.
     """
-    global conversation_history
-
     try:
 
         # Parse the incoming JSON payload from SMS
@@ -102,18 +198,19 @@ async def sms_webhook(request: Request):
 
         if event_type == "sms":
             message_data = body.get("sms")[0]
+            if seen_message_ids.is_duplicate(message_data.get("id")):
+                return {"success": True}
             user_id = message_data["from"]  # WhatsApp user ID
             user_message = message_data.get("text", {}).get("body", "").strip()
 
-            # Retrieve or initialize conversation history for this user
-            if user_id not in conversation_history:
-                conversation_history[user_id] = []
-
             # Interact with the AI
-            if user_message:
-                ai_response = await chat_with_ai(user_message, user_id, messages=conversation_history[user_id])
-                # Save the updated conversation history
-                conversation_history[user_id] = ai_response  # This includes the entire chat so far
+            new_turn_id()
+            if user_message and rate_limiter.admit(user_id, user_id):
+                async with user_turn(user_id):
+                    history = await conversation_history.load(user_id)
+                    ai_response = await chat_with_ai(user_message, user_id, messages=history)
+                    # Save the updated conversation history
+                    await conversation_history.save(user_id, ai_response)  # This includes the entire chat so far
                 # Send the response back to the user via WHAPI
                 async with httpx.AsyncClient() as client:
                     recipient_id = user_id
@@ -122,18 +219,279 @@ async def sms_webhook(request: Request):
 
         elif event_type == 'statuses':
             # Handle status updates (read receipts, etc.)
-            print(f"Status event received: {body['statuses']}")
+            handle_statuses(body.get("statuses") or [])
 
         else:
-            print(f"Unknown event type: {event_type}")
+            logger.warning("Unknown event type: %s", event_type)
 
         return {"success": True}
 
     except Exception as e:
-        print(f"Error in whatsapp_webhook: {e}")
+        logger.error("Error in whatsapp_webhook: %s", e)
         return {"status": "error", "reason": str(e)}
 
 
+@app.get("/stops/{stop_code}/arrivals")
+async def stop_arrivals(request: Request, stop_code: str = Path(pattern=r"^\d{1,8}$")):
+    """
+    Next arrivals of every line at the stop, in minutes from fetched_at.
+
+    Served from the SIRI cache of the chat path: the ETag changes with each upstream refresh
+    and max-age is the time left before it, so repeated reads end at the client or the CDN.
+    """
+    try:
+        cached = await get_cached_times(stop_code)
+    except Exception as e:
+        logger.warning("Arrivals of stop %s unavailable: %s", stop_code, e)
+        raise HTTPException(status_code=502, detail="Arrival times unavailable")
+    rendered = cached.derived.get("arrivals")
+    if rendered is None:
+        fetched_at = datetime.fromtimestamp(cached.fetched_at)
+        rendered = cached.derived["arrivals"] = render_json({
+            "stop_number": stop_code,
+            "fetched_at": fetched_at.isoformat(timespec="seconds"),
+            "lines": get_cached_board(cached, stop_code),
+        })
+    body, etag = rendered
+    return cacheable_response(request, body, etag, stop_times_cache.remaining(cached), cached.fetched_at)
+
+
+@app.get("/stops/{stop_code}/live")
+async def stop_live(stop_code: str = Path(pattern=r"^\d{1,8}$")):
+    """
+    Live arrival board of the stop, as Server-Sent Events: a "snapshot" event with every line,
+    then "update" events with the lines whose ETAs changed.
+    """
+    try:
+        live_board_hub.check_capacity()
+    except TooManyConnections as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return StreamingResponse(
+        live_board_hub.stream(stop_code),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get("/stops/{stop_code}/lines")
+async def stop_lines(request: Request, stop_code: str = Path(pattern=r"^\d{1,8}$")):
+    """
+    Lines stopping at the stop, from the GTFS index of the chat path (404 for an unknown stop).
+    """
+    result = await get_lines_at_stop(stop_code)
+    body, etag = render_json({"stop_number": stop_code, "lines": result["lines_list"]})
+    return cacheable_response(request, body, etag, STOP_LINES_MAX_AGE)
+
+
+@app.post("/admin/profiling")
+async def set_profiling(request: Request):
+    """
+    Change the share of the webhook requests profiled, e.g. {"sample_rate": 0.01}.
+    Requires the X-Helpy-Profile header set to PROFILE_TOKEN.
+    """
+    if not request_profiler.is_authorized(request.headers.get(PROFILE_HEADER)):
+        raise HTTPException(status_code=403, detail="Invalid profiling token")
+    body = await request.json()
+    request_profiler.sample_rate = min(1.0, max(0.0, float(body.get("sample_rate", 0.0))))
+    return {
+        "sample_rate": request_profiler.sample_rate,
+        "output_dir": request_profiler.output_dir,
+        "profiles_written": request_profiler.profiles_written,
+    }
+
+
+@app.get("/ready")
+async def ready():
+    """
+    Readiness probe: 503 until the warm-up (language model, GTFS index, clients) is done.
+    """
+    state = getattr(app.state, "ready", False)
+    return JSONResponse(
+        {"ready": state, "warm_up": getattr(app.state, "warm_up", {})},
+        status_code=200 if state else 503
+    )
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Per-stage latency histograms, error counters and the state of the in-process components,
+    in the Prometheus text format.
+    """
+    return PlainTextResponse(
+        render_metrics(
+            render_gauges("helpy_conversations", conversation_history.metrics(),
+                          ("hits", "misses", "expired", "evicted", "loads", "flushes", "rows_written")),
+            render_gauges("helpy_dedup", seen_message_ids.metrics(), ("checked", "suppressed")),
+            render_gauges("helpy_rate_limit", rate_limiter.metrics(), ("admitted", "evicted_refilling", "shed")),
+            render_gauges("helpy_whapi_sender", whatsapp_sender.metrics(), whatsapp_sender.counters),
+            render_gauges("helpy_siri_cache", stop_times_cache.metrics(), stop_times_cache.counters),
+            render_gauges("helpy_upstream_siri", siri_upstream.metrics(), UPSTREAM_COUNTERS),
+            render_gauges("helpy_upstream_alerts", alerts_upstream.metrics(), UPSTREAM_COUNTERS),
+            render_gauges("helpy_live_board", live_board_hub.metrics(), live_board_hub.counters),
+            render_gauges("helpy_arrival_alerts", subscription_scheduler.metrics(), subscription_scheduler.counters),
+            render_gauges("helpy_arrival_archive", arrival_archive.metrics() if arrival_archive else {},
+                          arrival_archive.counters if arrival_archive else ()),
+            render_gauges("helpy_traffic_tape", traffic_tape.metrics() if traffic_tape else {},
+                          traffic_tape.counters if traffic_tape else ()),
+            render_gauges("helpy_vehicle_positions", vehicle_positions.metrics() if vehicle_positions else {},
+                          vehicle_positions.counters if vehicle_positions else ()),
+            render_gauges("helpy_upstream_vehicle_positions",
+                          vehicle_positions.upstream.metrics() if vehicle_positions else {}, UPSTREAM_COUNTERS),
+            render_gauges("helpy_gtfs_store", gtfs_store_metrics()),
+            render_gauges("helpy_blocking_executors", blocking_executors.metrics(), ("completed",)),
+            render_gauges("helpy_event_loop", loop_watchdog.metrics() if loop_watchdog else {}, ("blocks",)),
+        ),
+        media_type="text/plain; version=0.0.4"
+    )
+
+
+def group_messages_by_chat(messages: list) -> dict:
+    """
+    Group the incoming messages of a webhook batch by (user_id, recipient_id).
+
+    Messages sent by ourselves and messages already received (redelivered webhooks) are
+    dropped. The order of the messages inside each group is preserved, and so is the order
+    in which the groups first appear in the batch.
+    """
+    batches = {}
+    for message_data in messages:
+        if message_data.get("from_me") or seen_message_ids.is_duplicate(message_data.get("id")):
+            continue
+        chat_id, chat_type = chat_id_parsor(message_data["chat_id"])
+        user_id = message_data["from"]  # WhatsApp user ID
+        recipient_id = (
+            chat_id + "@g.us" if chat_type == "g.us"
+            else user_id + "@s.whatsapp.net"
+        )
+        batches.setdefault((user_id, recipient_id), []).append(message_data)
+    return batches
+
+
+def merge_turns(batch: list) -> list:
+    """
+    Split a chat batch into AI turns.
+
+    Consecutive text messages are merged into one text turn (one line per message) so the
+    AI answers them together; every voice message is a turn of its own.
+
+    Returns:
+        list: (message_type, content) tuples in arrival order.
+    """
+    turns = []
+    pending_texts = []
+    for message_data in batch:
+        message_type = message_data.get("type", '')
+        if message_type == "text":
+            user_message = message_data.get("text", {}).get("body", "").strip()
+            if user_message:
+                pending_texts.append(user_message)
+        elif message_type == "voice":
+            user_voice_message = message_data.get("voice", {}).get("link", "").strip()
+            if user_voice_message:
+                if pending_texts:
+                    turns.append(("text", "\n".join(pending_texts)))
+                    pending_texts = []
+                turns.append(("voice", user_voice_message))
+    if pending_texts:
+        turns.append(("text", "\n".join(pending_texts)))
+    return turns
+
+
+async def process_chat_batches(batches: dict):
+    """
+    Process the batches of different chats concurrently.
+    """
+    if not batches:
+        return
+    results = await asyncio.gather(
+        *(process_chat_batch(user_id, recipient_id, batch)
+          for (user_id, recipient_id), batch in batches.items()),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("Error processing WhatsApp batch: %s", result)
+
+
+@asynccontextmanager
+async def user_turn(user_id: str):
+    """
+    Hold the history of the user for one turn (load, AI, save): the turns of the user's
+    different chats (a DM and a group, or a text batch and a voice batch) run one at a time.
+    """
+    entry = _user_locks.get(user_id)
+    if entry is None:
+        entry = _user_locks[user_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _user_locks[user_id]
+
+
+async def process_chat_batch(user_id: str, recipient_id: str, batch: list):
+    """
+    Run the AI turns of one chat batch sequentially, so the conversation history stays ordered.
+    Voice messages are transcribed first and then follow the text path.
+
+    Turns over the rate limits are shed before reaching the AI; the user is told to slow down
+    (at most once per cooldown, so a flood doesn't turn into a flood of replies).
+    """
+    # The arrival alerts taken during these turns are sent to this chat
+    current_chat.set((user_id, recipient_id))
+    # Language of the last turn, kept for the messages without a detectable one (numbers, voice)
+    language = "en"
+    for message_type, content in merge_turns(batch):
+        new_turn_id()
+        if not rate_limiter.admit(user_id, recipient_id):
+            if rate_limiter.should_notify(user_id):
+                if message_type == "text":
+                    language = await detect_user_language(content, language)
+                await whatsapp_sender.send(recipient_id, await generate_slow_down_message(language))
+            continue
+
+        if message_type == "voice":
+            # Download, transcode and transcribe the audio, then continue on the text path
+            try:
+                with timed("voice_transcribe"):
+                    content = await voice_pipeline.transcribe(content)
+            except Exception as e:
+                logger.error("Error transcribing voice message of user %s: %s", user_id, e)
+                content = ""
+            if not content:
+                # Nothing to answer: ask for the question as text rather than staying silent
+                await whatsapp_sender.send(recipient_id, await generate_voice_error_message(language))
+                continue
+
+        # Interact with the AI
+        language = await detect_user_language(content, language)
+        async with user_turn(user_id):
+            history = await conversation_history.load(user_id)
+            with timed("turn"):
+                ai_response = await chat_with_ai(content, user_id, messages=history, detected_language=language)
+            # Save the updated conversation history
+            await conversation_history.save(user_id, ai_response)  # This includes the entire chat so far
+        # Send the response back to the user via WHAPI
+        await send_whatsapp_response(recipient_id, ai_response)
+
+
+def handle_statuses(statuses: list):
+    """
+    Handle a batch of status updates (read receipts, etc.) with a single summary log line.
+    """
+    if not statuses:
+        return
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    counts = Counter(status.get("status", "unknown") for status in statuses)
+    summary = ", ".join(f"{status}={count}" for status, count in sorted(counts.items()))
+    logger.info("Status events received: %d (%s)", len(statuses), summary)
+
+
 def chat_id_parsor (chat_id: str):
     chat_id_splitted = chat_id.split("@")
     return chat_id_splitted
@@ -0,0 +1,331 @@
+import asyncio
+import fcntl
+import logging
+import mmap
+import os
+import time
+from array import array
+from collections import deque
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from app.utils.blocking import run_blocking
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_INTERVAL = 5
+DEFAULT_MAX_PENDING = 10000
+
+# One file per column, every value a little-endian uint32 (times in epoch seconds, strings
+# as codes into the dictionary of the segment)
+COLUMNS = ("observed_at", "stop", "line", "operator", "journey", "expected_at")
+STRING_COLUMNS = ("line", "operator", "journey")
+DICTIONARY_FILE = "dictionary.txt"
+LOCK_FILE = ".lock"
+
+
+def segment_name(timestamp: float) -> str:
+    """
+    Daily segment of an observation time (UTC day).
+    """
+    return time.strftime("%Y-%m-%d", time.gmtime(timestamp))
+
+
+def extract_rows(stop_code: str, times_response: dict, observed_at: float) -> list:
+    """
+    (observed_at, stop, line, operator, journey, expected_at) of every visit of a SIRI response.
+    """
+    rows = []
+    observed = int(observed_at)
+    stop = int(stop_code) if str(stop_code).isdigit() else 0
+    deliveries = times_response.get("Siri", {}).get("ServiceDelivery", {}).get("StopMonitoringDelivery") or [{}]
+    for element in deliveries[0].get("MonitoredStopVisit") or []:
+        vehicle_journey = element.get("MonitoredVehicleJourney", {})
+        expected = vehicle_journey.get("MonitoredCall", {}).get("ExpectedArrivalTime")
+        if not expected:
+            continue
+        rows.append((
+            observed,
+            stop,
+            vehicle_journey.get("PublishedLineName") or "",
+            vehicle_journey.get("OperatorRef") or "",
+            (vehicle_journey.get("FramedVehicleJourneyRef") or {}).get("DatedVehicleJourneyRef") or "",
+            int(datetime.fromisoformat(expected).timestamp()),
+        ))
+    return rows
+
+
+class SegmentWriter:
+    """
+    Append-only writer of one daily segment directory, shared by the uvicorn workers.
+
+    Every append holds an exclusive lock on the segment: it first reads the strings the other
+    workers added to the dictionary, so all of them code the same string the same way, and
+    cuts the columns back to the shortest one, dropping the rows of a write interrupted by a
+    crash. The dictionary is then appended before the columns that use its codes, and each
+    column gets the same number of values.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.codes = {}
+        self._dictionary_lines = 0
+        self._dictionary_size = 0
+
+    def append(self, rows: list) -> int:
+        with open(os.path.join(self.path, LOCK_FILE), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._sync()
+                return self._append(rows)
+            except Exception:
+                # Reread the whole dictionary next time: it may hold only part of this batch
+                self.codes, self._dictionary_lines, self._dictionary_size = {}, 0, 0
+                raise
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _sync(self):
+        with open(os.path.join(self.path, DICTIONARY_FILE), "a+b") as dictionary:
+            dictionary.seek(self._dictionary_size)
+            added = dictionary.read()
+            complete = added.rfind(b"\n") + 1
+            if complete < len(added):
+                # A line cut short by a crash: the next string would be glued to it
+                dictionary.truncate(self._dictionary_size + complete)
+        for value in added[:complete].decode("utf-8").split("\n")[:-1]:
+            self.codes.setdefault(value, self._dictionary_lines)
+            self._dictionary_lines += 1
+        self._dictionary_size += complete
+
+        column_paths = [os.path.join(self.path, f"{name}.u32") for name in COLUMNS]
+        sizes = [os.path.getsize(path) if os.path.exists(path) else 0 for path in column_paths]
+        length = 4 * (min(sizes) // 4)
+        for path, size in zip(column_paths, sizes):
+            if size > length:
+                os.truncate(path, length)
+
+    def _append(self, rows: list) -> int:
+        new_strings = []
+        columns = {name: array("I") for name in COLUMNS}
+        for row in rows:
+            for name, value in zip(COLUMNS, row):
+                if name in STRING_COLUMNS:
+                    code = self.codes.get(value)
+                    if code is None:
+                        value = value.replace("\n", " ")
+                        code = self.codes.setdefault(value, self._dictionary_lines)
+                        if code == self._dictionary_lines:
+                            self._dictionary_lines += 1
+                            new_strings.append(value)
+                    value = code
+                columns[name].append(value)
+        if new_strings:
+            data = ("\n".join(new_strings) + "\n").encode("utf-8")
+            with open(os.path.join(self.path, DICTIONARY_FILE), "ab") as dictionary:
+                dictionary.write(data)
+            self._dictionary_size += len(data)
+        written = 0
+        for name, values in columns.items():
+            with open(os.path.join(self.path, f"{name}.u32"), "ab") as column:
+                values.tofile(column)
+                written += len(values) * values.itemsize
+        return written
+
+
+class ArrivalArchive:
+    """
+    Optional recorder of the SIRI responses, as a compact columnar archive.
+
+    record() only queues the response (the request path pays an append to a deque); a
+    background task turns the queued responses into rows every flush_interval seconds and
+    appends them to the daily segment in the shared thread pool. When more than max_pending
+    responses wait, the oldest are dropped and counted.
+    """
+
+    def __init__(self, directory: str, flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                 max_pending: int = DEFAULT_MAX_PENDING):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._pending = deque(maxlen=max_pending)
+        self._writers = {}
+        self._task = None
+        self._stopping = None
+        self.counters = {"recorded": 0, "dropped": 0, "rows_written": 0, "bytes_written": 0, "flush_errors": 0}
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build an archive in ARRIVAL_ARCHIVE_DIR, or None when it isn't set.
+        """
+        directory = os.getenv("ARRIVAL_ARCHIVE_DIR")
+        if not directory:
+            return None
+        return cls(
+            directory,
+            flush_interval=float(os.getenv("ARRIVAL_ARCHIVE_FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL)),
+            max_pending=int(os.getenv("ARRIVAL_ARCHIVE_MAX_PENDING", DEFAULT_MAX_PENDING)),
+        )
+
+    def record(self, stop_code: str, times_response: dict, observed_at: float = None):
+        """
+        Queue a SIRI response for the archive (ignored until start()).
+        """
+        if self._task is None:
+            return
+        if len(self._pending) == self._pending.maxlen:
+            self.counters["dropped"] += 1
+        self._pending.append((stop_code, times_response, observed_at or time.time()))
+        self.counters["recorded"] += 1
+
+    def start(self):
+        if self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """
+        Write what is queued and stop recording.
+        """
+        if self._task is None:
+            return
+        self._stopping.set()
+        await self._task
+        self._task = None
+
+    async def _flush_loop(self):
+        # Flushes run one after the other (a write is never cancelled halfway), the last one
+        # after stop()
+        stopping = False
+        while not stopping:
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+                stopping = True
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch = list(self._pending)
+        self._pending.clear()
+        try:
+            rows, written = await run_blocking(self._write, batch)
+            self.counters["rows_written"] += rows
+            self.counters["bytes_written"] += written
+        except Exception as e:
+            self.counters["flush_errors"] += 1
+            logger.error("Error writing %d responses to the arrival archive: %s", len(batch), e)
+
+    def _write(self, batch: list) -> tuple:
+        rows_by_segment = {}
+        for stop_code, times_response, observed_at in batch:
+            try:
+                rows = extract_rows(stop_code, times_response, observed_at)
+            except Exception as e:
+                logger.warning("Unreadable SIRI response of stop %s not archived: %s", stop_code, e)
+                continue
+            rows_by_segment.setdefault(segment_name(observed_at), []).extend(rows)
+        rows_written = bytes_written = 0
+        for name, rows in rows_by_segment.items():
+            writer = self._writers.get(name)
+            if writer is None:
+                # A new day: the writers of the previous days won't be appended to anymore
+                self._writers = {name: SegmentWriter(os.path.join(self.directory, name))}
+                writer = self._writers[name]
+            bytes_written += writer.append(rows)
+            rows_written += len(rows)
+        return rows_written, bytes_written
+
+    def metrics(self) -> dict:
+        return {"pending": len(self._pending), **self.counters}
+
+
+class ArchiveSegment:
+    """
+    Read-only view of a daily segment: every column memory-mapped as a numpy uint32 array.
+
+    Use as a context manager, or call close(); the arrays are invalid afterwards.
+    """
+
+    def __init__(self, path: str):
+        import numpy as np
+
+        self.path = path
+        self._maps = []
+        self.columns = {}
+        for name in COLUMNS:
+            column_path = os.path.join(path, f"{name}.u32")
+            size = os.path.getsize(column_path) if os.path.exists(column_path) else 0
+            if size < 4:
+                self.columns[name] = np.zeros(0, dtype="<u4")
+                continue
+            with open(column_path, "rb") as column:
+                mapped = mmap.mmap(column.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps.append(mapped)
+            self.columns[name] = np.frombuffer(mapped, dtype="<u4", count=size // 4)
+        self.rows = min(len(values) for values in self.columns.values())
+        self.columns = {name: values[:self.rows] for name, values in self.columns.items()}
+        with open(os.path.join(path, DICTIONARY_FILE), encoding="utf-8") as dictionary:
+            self.dictionary = dictionary.read().split("\n")[:-1]
+        self._codes = {value: code for code, value in enumerate(self.dictionary)}
+
+    def code(self, value: str):
+        """
+        Dictionary code of a string value, or None if the segment never saw it.
+        """
+        return self._codes.get(value)
+
+    def scan(self, stop: str = None, line: str = None, operator: str = None):
+        """
+        Boolean mask of the rows matching the filters.
+        """
+        import numpy as np
+
+        mask = np.ones(self.rows, dtype=bool)
+        if stop is not None:
+            mask &= self.columns["stop"] == int(stop)
+        for name, value in (("line", line), ("operator", operator)):
+            if value is not None:
+                code = self.code(value)
+                if code is None:
+                    return np.zeros(self.rows, dtype=bool)
+                mask &= self.columns[name] == code
+        return mask
+
+    def close(self):
+        self.columns = {}
+        for mapped in self._maps:
+            try:
+                mapped.close()
+            except BufferError:
+                # numpy views still alive: the map is released with them
+                pass
+        self._maps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def list_segments(directory: str) -> list:
+    """
+    Paths of the daily segments of an archive, oldest first.
+    """
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if os.path.isdir(os.path.join(directory, name))]
+
+
+# Recorder of the SIRI responses (None unless ARRIVAL_ARCHIVE_DIR is set)
+arrival_archive = ArrivalArchive.from_env()
@@ -0,0 +1,108 @@
+import asyncio
+import contextvars
+import functools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class BlockingExecutors:
+    """
+    Shared executors for the calls that would otherwise block the event loop.
+
+    - the thread pool runs blocking I/O and C extensions (the sync OpenAI client, fasttext,
+      file reads); the caller's context variables (turn id, stage trace) follow the call;
+    - the process pool runs CPU-bound Python work (building the GTFS index).
+
+    Both are created on first use and sized once for the whole process, so a burst of
+    requests queues on the pools instead of spawning threads.
+    """
+
+    def __init__(self, threads: int = 32, processes: int = 1):
+        self.threads = threads
+        self.processes = processes
+        self._thread_pool = None
+        self._process_pool = None
+        self.in_flight = {"thread": 0, "process": 0}
+        self.completed = {"thread": 0, "process": 0}
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build the executors sized by BLOCKING_THREADS and BLOCKING_PROCESSES.
+        """
+        return cls(
+            threads=int(os.getenv("BLOCKING_THREADS", 32)),
+            processes=int(os.getenv("BLOCKING_PROCESSES", 1)),
+        )
+
+    @property
+    def thread_pool(self) -> ThreadPoolExecutor:
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="helpy-blocking")
+        return self._thread_pool
+
+    @property
+    def process_pool(self) -> ProcessPoolExecutor:
+        if self._process_pool is None:
+            # Spawned, not forked: a fork of the server would inherit its signal handlers (and
+            # outlive it on SIGTERM) and its threads' locks
+            self._process_pool = ProcessPoolExecutor(max_workers=self.processes,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+        return self._process_pool
+
+    async def run_in_thread(self, function, *args, **kwargs):
+        """
+        Run function(*args, **kwargs) in the thread pool and wait for its result.
+        """
+        call = functools.partial(contextvars.copy_context().run, function, *args, **kwargs)
+        return await self._run("thread", self.thread_pool, call)
+
+    async def run_in_process(self, function, *args):
+        """
+        Run function(*args) in the process pool; the function, its arguments and its result
+        must be picklable.
+        """
+        return await self._run("process", self.process_pool, functools.partial(function, *args))
+
+    async def _run(self, kind: str, pool, call):
+        self.in_flight[kind] += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, call)
+        finally:
+            self.in_flight[kind] -= 1
+            self.completed[kind] += 1
+
+    def shutdown(self):
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=False, cancel_futures=True)
+            self._thread_pool = None
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=True, cancel_futures=True)
+            self._process_pool = None
+
+    def metrics(self) -> dict:
+        return {
+            "threads": self.threads,
+            "processes": self.processes,
+            "in_flight": dict(self.in_flight),
+            "completed": dict(self.completed),
+        }
+
+
+# Executors shared by every module of the process
+blocking_executors = BlockingExecutors.from_env()
+
+
+async def run_blocking(function, *args, **kwargs):
+    """
+    Run a blocking call in the shared thread pool.
+    """
+    return await blocking_executors.run_in_thread(function, *args, **kwargs)
+
+
+async def run_cpu_bound(function, *args):
+    """
+    Run a CPU-bound call in the shared process pool.
+    """
+    return await blocking_executors.run_in_process(function, *args)
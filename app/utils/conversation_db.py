@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from databases import Database
+from dotenv import load_dotenv
+
+from app.utils.conversation_store import ConversationStore, pack_messages, unpack_messages
+from app.utils.metrics import timed
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_FLUSH_BATCH_SIZE = 200
+DEFAULT_CACHE_TTL_SECONDS = 30
+DEFAULT_CACHE_MAX_ENTRIES = 1000
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+
+UPSERT_QUERY = """
+    INSERT INTO conversations (user_id, history, updated_at)
+    VALUES (:user_id, :history, :updated_at)
+    ON CONFLICT (user_id) DO UPDATE SET history = excluded.history, updated_at = excluded.updated_at
+    WHERE conversations.updated_at < excluded.updated_at
+"""
+# The history is only sent back when the row is newer than the version cached by the worker
+SELECT_QUERY = """
+    SELECT updated_at, CASE WHEN updated_at > :version THEN history END AS history
+    FROM conversations WHERE user_id = :user_id
+"""
+PURGE_QUERY = "DELETE FROM conversations WHERE updated_at < :oldest"
+
+
+class PersistentConversationStore:
+    """
+    Conversation history stored in PostgreSQL (asyncpg) or SQLite, shared by all the workers.
+
+    Every turn costs one small query: the local cache keeps the history with the updated_at
+    it was read or written at, and the query only sends the history back when another worker
+    wrote a newer one. Writes are buffered (only the last write per user is kept) and flushed
+    in batches by a background task, every flush_interval seconds or as soon as
+    flush_batch_size users are pending, so a turn handled by another worker less than
+    flush_interval seconds after the previous one may still miss it.
+    """
+
+    def __init__(self, database_url: str, flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                 flush_batch_size: int = DEFAULT_FLUSH_BATCH_SIZE, ttl_seconds: float = DEFAULT_TTL_SECONDS,
+                 cache: ConversationStore = None):
+        self.database = Database(database_url)
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self.ttl_seconds = ttl_seconds
+        self.cache = cache or ConversationStore(ttl_seconds=DEFAULT_CACHE_TTL_SECONDS,
+                                                max_entries=DEFAULT_CACHE_MAX_ENTRIES)
+        # user_id -> (updated_at, blob) waiting to be written
+        self._pending = {}
+        # user_id -> updated_at of the history in the cache
+        self._versions = OrderedDict()
+        self._flush_lock = asyncio.Lock()
+        self._flush_needed = asyncio.Event()
+        self._flusher = None
+        self.loads = 0
+        self.flushes = 0
+        self.rows_written = 0
+
+    @classmethod
+    def from_env(cls, database_url: str):
+        """
+        Build a store configured by CONVERSATION_FLUSH_INTERVAL, CONVERSATION_FLUSH_BATCH_SIZE,
+        CONVERSATION_DB_TTL_SECONDS and the CONVERSATION_CACHE_* settings.
+        """
+        cache = ConversationStore(
+            ttl_seconds=float(os.getenv("CONVERSATION_CACHE_TTL_SECONDS", DEFAULT_CACHE_TTL_SECONDS)),
+            max_entries=int(os.getenv("CONVERSATION_CACHE_MAX_ENTRIES", DEFAULT_CACHE_MAX_ENTRIES)),
+        )
+        return cls(
+            database_url,
+            flush_interval=float(os.getenv("CONVERSATION_FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL)),
+            flush_batch_size=int(os.getenv("CONVERSATION_FLUSH_BATCH_SIZE", DEFAULT_FLUSH_BATCH_SIZE)),
+            ttl_seconds=float(os.getenv("CONVERSATION_DB_TTL_SECONDS", DEFAULT_TTL_SECONDS)),
+            cache=cache,
+        )
+
+    async def start(self):
+        """
+        Connect to the database, create the table if needed and start the background flusher.
+        """
+        await self.database.connect()
+        blob_type = "BYTEA" if self.database.url.dialect == "postgresql" else "BLOB"
+        await self.database.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            f"user_id TEXT PRIMARY KEY, history {blob_type} NOT NULL, updated_at DOUBLE PRECISION NOT NULL)"
+        )
+        await self.purge_expired()
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """
+        Stop the flusher, write the pending conversations and disconnect.
+        """
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+        await self.database.disconnect()
+
+    async def load(self, user_id: str) -> list:
+        """
+        Return the conversation of the user from the write buffer or the cache, unless the
+        database holds a newer one written by another worker.
+        """
+        with timed("conversation_load") as stage:
+            pending = self._pending.get(user_id)
+            if pending is not None:
+                version = pending[0]
+            elif user_id in self.cache:
+                version = self._versions.get(user_id, -1.0)
+            else:
+                version = -1.0
+            self.loads += 1
+            row = await self.database.fetch_one(SELECT_QUERY, values={"user_id": user_id, "version": version})
+            if row is None or row["history"] is None:
+                # Nothing newer in the database (or not flushed yet): the local copy is current
+                if pending is not None:
+                    stage.cache = "pending"
+                    return unpack_messages(pending[1])
+                stage.cache = "hit" if version >= 0 else "miss"
+                return self.cache.get(user_id) if version >= 0 else []
+            stage.cache = "stale" if version >= 0 else "miss"
+            # Another worker wrote after the write still buffered here, which is then dropped
+            self._pending.pop(user_id, None)
+            if time.time() - row["updated_at"] > self.ttl_seconds:
+                return []
+            messages = unpack_messages(bytes(row["history"]))
+            self._cache(user_id, messages, row["updated_at"])
+            return messages
+
+    async def save(self, user_id: str, messages: list):
+        """
+        Buffer the conversation of the user; it's written by the next flush.
+        """
+        updated_at = time.time()
+        self._cache(user_id, messages, updated_at)
+        self._pending[user_id] = (updated_at, pack_messages(messages))
+        if len(self._pending) >= self.flush_batch_size:
+            self._flush_needed.set()
+
+    def _cache(self, user_id: str, messages: list, updated_at: float):
+        self.cache.set(user_id, messages)
+        self._versions[user_id] = updated_at
+        self._versions.move_to_end(user_id)
+        while len(self._versions) > self.cache.max_entries:
+            self._versions.popitem(last=False)
+
+    async def flush(self) -> int:
+        """
+        Write every buffered conversation in one batch and return how many were written.
+
+        A row already holding a newer write (flushed meanwhile by another worker) is kept.
+        """
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, {}
+            values = [{"user_id": user_id, "history": blob, "updated_at": updated_at}
+                      for user_id, (updated_at, blob) in pending.items()]
+            try:
+                await self.database.execute_many(UPSERT_QUERY, values=values)
+            except Exception:
+                # Put the batch back, without overwriting newer writes made meanwhile
+                for user_id, entry in pending.items():
+                    self._pending.setdefault(user_id, entry)
+                raise
+            self.flushes += 1
+            self.rows_written += len(values)
+            return len(values)
+
+    async def purge_expired(self):
+        """
+        Delete the conversations idle for more than ttl_seconds from the database.
+        """
+        await self.database.execute(PURGE_QUERY, values={"oldest": time.time() - self.ttl_seconds})
+
+    def metrics(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "loads": self.loads,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "cache": self.cache.metrics(),
+        }
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Error flushing conversations: %s", e)
@@ -0,0 +1,188 @@
+import json
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+from app.utils.metrics import timed
+
+# Load environment variables
+load_dotenv()
+
+DEFAULT_TTL_SECONDS = 30 * 60
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def pack_messages(messages: list) -> bytes:
+    """
+    Encode a conversation into a compact blob.
+
+    Only the role and content of each message are kept (that's all the AI needs), stored as
+    [role, content] pairs in a compressed JSON document.
+    """
+    pairs = [[msg.get("role"), msg.get("content")] for msg in messages]
+    return zlib.compress(json.dumps(pairs, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def unpack_messages(blob: bytes) -> list:
+    """
+    Decode a blob produced by pack_messages back into a list of message dictionaries.
+    """
+    return [{"role": role, "content": content} for role, content in json.loads(zlib.decompress(blob))]
+
+
+class ConversationStore:
+    """
+    In-memory conversation history per user with idle expiry and LRU eviction.
+
+    Each entry expires when it hasn't been read or written for ttl_seconds. When the store
+    holds more than max_entries conversations or more than max_bytes of packed history, the
+    least recently used conversations are evicted first.
+    """
+
+    def __init__(self, ttl_seconds: float = DEFAULT_TTL_SECONDS, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 max_bytes: int = DEFAULT_MAX_BYTES, clock=time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._clock = clock
+        # user_id -> (last_access, blob), ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a store configured by CONVERSATION_TTL_SECONDS, CONVERSATION_MAX_ENTRIES and
+        CONVERSATION_MAX_BYTES.
+        """
+        return cls(
+            ttl_seconds=float(os.getenv("CONVERSATION_TTL_SECONDS", DEFAULT_TTL_SECONDS)),
+            max_entries=int(os.getenv("CONVERSATION_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+            max_bytes=int(os.getenv("CONVERSATION_MAX_BYTES", DEFAULT_MAX_BYTES)),
+        )
+
+    def get(self, user_id: str) -> list:
+        """
+        Return the conversation of the user, or an empty list if unknown or expired.
+        """
+        with self._lock:
+            now = self._clock()
+            self._purge_expired(now)
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return []
+            self.hits += 1
+            self._entries[user_id] = (now, entry[1])
+            self._entries.move_to_end(user_id)
+            blob = entry[1]
+        return unpack_messages(blob)
+
+    def set(self, user_id: str, messages: list):
+        """
+        Store the whole conversation of the user, evicting other users if the caps are exceeded.
+        """
+        blob = pack_messages(messages)
+        with self._lock:
+            now = self._clock()
+            self._remove(user_id)
+            self._entries[user_id] = (now, blob)
+            self._bytes += len(blob)
+            self._purge_expired(now)
+            while len(self._entries) > 1 and (len(self._entries) > self.max_entries
+                                              or self._bytes > self.max_bytes):
+                oldest_user_id = next(iter(self._entries))
+                self._remove(oldest_user_id)
+                self.evicted += 1
+
+    async def start(self):
+        """
+        Nothing to set up in memory; part of the interface shared with the persistent backend.
+        """
+
+    async def stop(self):
+        pass
+
+    async def load(self, user_id: str) -> list:
+        with timed("conversation_load") as stage:
+            messages = self.get(user_id)
+            stage.cache = "hit" if messages else "miss"
+        return messages
+
+    async def save(self, user_id: str, messages: list):
+        self.set(user_id, messages)
+
+    def delete(self, user_id: str):
+        with self._lock:
+            self._remove(user_id)
+
+    def purge_expired(self) -> int:
+        """
+        Drop every idle conversation and return how many were dropped.
+        """
+        with self._lock:
+            return self._purge_expired(self._clock())
+
+    def metrics(self) -> dict:
+        """
+        Size and eviction counters of the store.
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
+
+    def __contains__(self, user_id: str) -> bool:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            return entry is not None and self._clock() - entry[0] <= self.ttl_seconds
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, user_id: str):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+
+    def _purge_expired(self, now: float) -> int:
+        # Entries are kept in access order, so the expired ones are all at the front
+        purged = 0
+        while self._entries:
+            user_id, (last_access, _) = next(iter(self._entries.items()))
+            if now - last_access <= self.ttl_seconds:
+                break
+            self._remove(user_id)
+            purged += 1
+        self.expired += purged
+        return purged
+
+
+def create_conversation_store():
+    """
+    Build the conversation store selected by the environment.
+
+    When CONVERSATION_DATABASE_URL is set (postgresql://... or sqlite:///...), conversations
+    are persisted in the database and shared by every worker; otherwise they are kept in
+    the memory of the current process.
+    """
+    database_url = os.getenv("CONVERSATION_DATABASE_URL")
+    if database_url:
+        from app.utils.conversation_db import PersistentConversationStore
+        return PersistentConversationStore.from_env(database_url)
+    return ConversationStore.from_env()
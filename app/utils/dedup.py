@@ -0,0 +1,79 @@
+import os
+import threading
+import time
+from collections import deque
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+DEFAULT_WINDOW_SECONDS = 10 * 60
+DEFAULT_CAPACITY = 50000
+
+
+class SeenMessageIds:
+    """
+    Bounded, time-windowed set of the message IDs already received.
+
+    IDs are kept in a ring buffer (in arrival order) next to a hash set for O(1) lookups.
+    An ID is forgotten once it is older than window_seconds, or when more than capacity
+    newer IDs have been received since.
+    """
+
+    def __init__(self, window_seconds: float = DEFAULT_WINDOW_SECONDS, capacity: int = DEFAULT_CAPACITY,
+                 clock=time.monotonic):
+        self.window_seconds = window_seconds
+        self.capacity = capacity
+        self._clock = clock
+        self._ring = deque()
+        self._ids = set()
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.suppressed = 0
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a set configured by DEDUP_WINDOW_SECONDS and DEDUP_CAPACITY.
+        """
+        return cls(
+            window_seconds=float(os.getenv("DEDUP_WINDOW_SECONDS", DEFAULT_WINDOW_SECONDS)),
+            capacity=int(os.getenv("DEDUP_CAPACITY", DEFAULT_CAPACITY)),
+        )
+
+    def is_duplicate(self, message_id: str) -> bool:
+        """
+        Record the message ID and tell whether it was already received in the window.
+
+        Messages without an ID can't be deduplicated and are never reported as duplicates.
+        """
+        if not message_id:
+            return False
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            self.checked += 1
+            if message_id in self._ids:
+                self.suppressed += 1
+                return True
+            self._ids.add(message_id)
+            self._ring.append((now, message_id))
+            if len(self._ring) > self.capacity:
+                _, oldest_id = self._ring.popleft()
+                self._ids.discard(oldest_id)
+            return False
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "tracked": len(self._ids),
+                "checked": self.checked,
+                "suppressed": self.suppressed,
+            }
+
+    def _expire(self, now: float):
+        oldest = now - self.window_seconds
+        while self._ring and self._ring[0][0] < oldest:
+            _, message_id = self._ring.popleft()
+            self._ids.discard(message_id)
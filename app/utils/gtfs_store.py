@@ -0,0 +1,315 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the layout of the files changes: older stores are rebuilt
+STORE_VERSION = 1
+SOURCE_FILES = ("stops.txt", "routes.txt", "trips.txt", "stop_times.txt")
+MANIFEST_FILE = "manifest.json"
+LOCK_FILE = ".lock"
+STOP_TIMES_CHUNK_ROWS = 2_000_000
+
+# Arrays of a store, one .npy file each. Stops are sorted by stop code; the routes, and the
+# lines of a stop, are in routes.txt order; the departures of a stop are sorted by time.
+ARRAYS = (
+    "stop_code", "stop_id", "stop_lat", "stop_lon",
+    "stop_route_offsets", "stop_routes",
+    "route_id", "route_short_name", "route_agency", "route_id_order",
+    "departure_offsets", "departure_time", "departure_route", "departure_service",
+    "service_id",
+)
+
+
+def source_fingerprint(data_dir: str) -> str:
+    """
+    Name of the store of a GTFS directory: changes with the size or modification time of any
+    source file, and with STORE_VERSION.
+    """
+    digest = hashlib.blake2b(f"v{STORE_VERSION}".encode("ascii"), digest_size=10)
+    for name in SOURCE_FILES:
+        path = os.path.join(data_dir, name)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Missing required file: {path}")
+        stat = os.stat(path)
+        digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode("ascii"))
+    return digest.hexdigest()
+
+
+def data_dir_key(data_dir: str) -> str:
+    """
+    Prefix of the stores of a GTFS directory, so deployments with different data directories
+    can share one store directory.
+    """
+    return hashlib.blake2b(os.path.abspath(data_dir).encode("utf-8"), digest_size=6).hexdigest()
+
+
+def parse_gtfs_times(values) -> "np.ndarray":
+    """
+    Seconds since the start of the service day of "HH:MM:SS" (or "H:MM:SS") GTFS times, past
+    24:00:00 included, parsed on the bytes in one numpy pass.
+    """
+    import numpy as np
+
+    digits = np.asarray(values).astype("S8").view(np.uint8).reshape(-1, 8).astype(np.int32) - ord("0")
+    short = digits[:, 1] == ord(":") - ord("0")
+    digits[short, 1:] = digits[short, :-1]
+    digits[short, 0] = 0
+    return ((digits[:, 0] * 10 + digits[:, 1]) * 3600 + (digits[:, 3] * 10 + digits[:, 4]) * 60
+            + digits[:, 6] * 10 + digits[:, 7]).astype(np.int32)
+
+
+def offsets_of(groups, count: int) -> "np.ndarray":
+    """
+    Start offsets (count + 1 values) of the rows of each group, the rows sorted by group.
+    """
+    import numpy as np
+
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(groups, minlength=count), out=offsets[1:])
+    return offsets
+
+
+def build_gtfs_store(data_dir: str, output_dir: str) -> dict:
+    """
+    Build the arrays of the store of a GTFS directory in output_dir.
+
+    stop_times.txt is read in chunks; only four int32 values per row are kept.
+
+    Returns:
+        dict: The row counts of the store.
+    """
+    import numpy as np
+    import pandas as pd
+
+    stops = pd.read_csv(os.path.join(data_dir, "stops.txt"), usecols=["stop_id", "stop_code", "stop_lat", "stop_lon"],
+                        dtype={"stop_code": str})
+    routes = pd.read_csv(os.path.join(data_dir, "routes.txt"),
+                         usecols=lambda column: column in ("route_id", "route_short_name", "agency_id"),
+                         dtype=str, keep_default_na=False)
+    trips = pd.read_csv(os.path.join(data_dir, "trips.txt"), usecols=["trip_id", "route_id", "service_id"],
+                        dtype=str, keep_default_na=False)
+
+    # One stop per stop code (the first one, as listed in stops.txt), sorted by code
+    stops["stop_code"] = stops["stop_code"].astype(str).str.strip()
+    stops = stops.drop_duplicates(subset="stop_code")
+    stop_codes = np.array([code.encode("utf-8") for code in stops["stop_code"]], dtype="S")
+    by_code = np.argsort(stop_codes, kind="stable")
+    stops, stop_codes = stops.iloc[by_code], stop_codes[by_code]
+    stop_count = len(stops)
+    position_of_stop_id = pd.Index(stops["stop_id"])
+
+    route_count = len(routes)
+    route_ids = routes["route_id"].to_numpy()
+    encoded_route_ids = np.array([value.encode("utf-8") for value in route_ids], dtype="S")
+    # Short name of each route as a code: the lines of a stop are distinct short names
+    name_codes, _ = pd.factorize(routes["route_short_name"])
+    route_of_trip = pd.Index(route_ids).get_indexer(trips["route_id"]).astype(np.int32)
+    service_codes, service_ids = pd.factorize(trips["service_id"])
+    service_of_trip = service_codes.astype(np.int32)
+    trip_index = pd.Index(trips["trip_id"])
+
+    stop_parts, time_parts, route_parts, service_parts = [], [], [], []
+    for chunk in pd.read_csv(os.path.join(data_dir, "stop_times.txt"),
+                             usecols=["trip_id", "stop_id", "departure_time"],
+                             dtype={"trip_id": str, "departure_time": str}, chunksize=STOP_TIMES_CHUNK_ROWS):
+        chunk = chunk.dropna()
+        trip_rows = trip_index.get_indexer(chunk["trip_id"])
+        stop_rows = position_of_stop_id.get_indexer(chunk["stop_id"])
+        keep = (trip_rows >= 0) & (stop_rows >= 0)
+        keep[keep] &= route_of_trip[trip_rows[keep]] >= 0
+        trip_rows = trip_rows[keep]
+        stop_parts.append(stop_rows[keep].astype(np.int32))
+        time_parts.append(parse_gtfs_times(chunk["departure_time"].to_numpy()[keep]))
+        route_parts.append(route_of_trip[trip_rows])
+        service_parts.append(service_of_trip[trip_rows])
+
+    def concat(parts):
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int32)
+
+    stop_rows, times, route_rows, service_rows = (concat(stop_parts), concat(time_parts), concat(route_parts),
+                                                  concat(service_parts))
+    del stop_parts, time_parts, route_parts, service_parts
+
+    # Lines of each stop: the distinct short names of its routes, in routes.txt order
+    pairs = np.unique(stop_rows.astype(np.int64) * max(route_count, 1) + route_rows)
+    pair_stops, pair_routes = pairs // max(route_count, 1), pairs % max(route_count, 1)
+    _, first = np.unique(pair_stops * (int(name_codes.max(initial=0)) + 1) + name_codes[pair_routes],
+                         return_index=True)
+    first.sort()
+    stop_routes = pair_routes[first].astype(np.int32)
+    stop_route_offsets = offsets_of(pair_stops[first], stop_count)
+
+    # Departures of each stop, by time
+    order = np.lexsort((times, stop_rows))
+    arrays = {
+        "stop_code": stop_codes,
+        "stop_id": stops["stop_id"].to_numpy(dtype=np.int64),
+        "stop_lat": stops["stop_lat"].to_numpy(dtype=np.float64),
+        "stop_lon": stops["stop_lon"].to_numpy(dtype=np.float64),
+        "stop_route_offsets": stop_route_offsets,
+        "stop_routes": stop_routes,
+        "route_id": encoded_route_ids,
+        "route_short_name": np.array([value.encode("utf-8") for value in routes["route_short_name"]], dtype="S"),
+        "route_agency": np.array([value.encode("utf-8") for value in routes.get("agency_id", [""] * route_count)],
+                                 dtype="S"),
+        "route_id_order": np.argsort(encoded_route_ids, kind="stable").astype(np.int32),
+        "departure_offsets": offsets_of(stop_rows, stop_count),
+        "departure_time": times[order],
+        "departure_route": route_rows[order],
+        "departure_service": service_rows[order],
+        "service_id": np.array([str(value).encode("utf-8") for value in service_ids], dtype="S"),
+    }
+    for name in ARRAYS:
+        np.save(os.path.join(output_dir, f"{name}.npy"), arrays[name], allow_pickle=False)
+    return {"stops": stop_count, "routes": route_count, "departures": int(len(times))}
+
+
+def ensure_gtfs_store(data_dir: str, store_dir: str) -> str:
+    """
+    Path of the store of the GTFS directory, built if it doesn't exist yet.
+
+    Stores are named after the data directory and the fingerprint of its files. The build
+    holds an exclusive lock of the data directory: the uvicorn workers starting together wait
+    for the first one's build and then use it. It is written to a temporary directory renamed
+    into place, so a store is never seen half-written; the stores of older GTFS files of the
+    same data directory are removed (a worker still mapping one keeps its pages until it
+    closes it), those of other data directories are left alone.
+    """
+    key = data_dir_key(data_dir)
+    path = os.path.join(store_dir, f"{key}-{source_fingerprint(data_dir)}")
+    if os.path.exists(os.path.join(path, MANIFEST_FILE)):
+        return path
+    os.makedirs(store_dir, exist_ok=True)
+    with open(os.path.join(store_dir, f"{LOCK_FILE}-{key}"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(os.path.join(path, MANIFEST_FILE)):
+                return path
+            started = time.perf_counter()
+            building = f"{path}.tmp-{os.getpid()}"
+            shutil.rmtree(building, ignore_errors=True)
+            os.makedirs(building)
+            try:
+                counts = build_gtfs_store(data_dir, building)
+                with open(os.path.join(building, MANIFEST_FILE), "w", encoding="utf-8") as manifest:
+                    json.dump({"version": STORE_VERSION, "data_dir": os.path.abspath(data_dir),
+                               "built_at": time.time(), **counts}, manifest)
+                os.rename(building, path)
+            except BaseException:
+                shutil.rmtree(building, ignore_errors=True)
+                raise
+            for name in os.listdir(store_dir):
+                old = os.path.join(store_dir, name)
+                if name.startswith(f"{key}-") and old != path and os.path.isdir(old):
+                    shutil.rmtree(old, ignore_errors=True)
+            logger.info("GTFS store %s built in %.1fs: %s", path, time.perf_counter() - started, counts)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return path
+
+
+class GtfsStore:
+    """
+    Read-only view of a GTFS store: every array is memory-mapped, so the worker processes
+    of a node share the same pages (from the page cache) instead of each holding a copy.
+
+    get(stop_code) answers like the dictionary index it replaces: (stop_id, short names of
+    the lines stopping there), or the default.
+    """
+
+    def __init__(self, path: str):
+        import numpy as np
+
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE), encoding="utf-8") as manifest:
+            self.manifest = json.load(manifest)
+        self.arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r", allow_pickle=False)
+                       for name in ARRAYS}
+        self.mapped_bytes = sum(os.path.getsize(os.path.join(path, f"{name}.npy")) for name in ARRAYS)
+
+    def __len__(self):
+        return len(self.arrays["stop_code"])
+
+    def __contains__(self, stop_code) -> bool:
+        return self.stop_index(stop_code) is not None
+
+    @staticmethod
+    def _search(keys, value: str, order=None):
+        import numpy as np
+
+        encoded = str(value).strip().encode("utf-8")
+        if len(keys) == 0 or len(encoded) > keys.dtype.itemsize:
+            return None
+        position = int(np.searchsorted(keys, encoded, sorter=order))
+        if position == len(keys):
+            return None
+        index = position if order is None else int(order[position])
+        return index if keys[index] == encoded else None
+
+    def stop_index(self, stop_code: str):
+        return self._search(self.arrays["stop_code"], stop_code)
+
+    def route_index(self, route_id: str):
+        return self._search(self.arrays["route_id"], route_id, self.arrays["route_id_order"])
+
+    def get(self, stop_code: str, default=None):
+        index = self.stop_index(stop_code)
+        if index is None:
+            return default
+        start, end = self.arrays["stop_route_offsets"][index:index + 2]
+        names = self.arrays["route_short_name"]
+        lines = [names[route].decode("utf-8") for route in self.arrays["stop_routes"][start:end]]
+        return int(self.arrays["stop_id"][index]), lines
+
+    def stop_location(self, stop_code: str):
+        """
+        (lat, lon) of a stop, None if it isn't in stops.txt.
+        """
+        index = self.stop_index(stop_code)
+        if index is None:
+            return None
+        return float(self.arrays["stop_lat"][index]), float(self.arrays["stop_lon"][index])
+
+    def route_short_name(self, route_id: str):
+        index = self.route_index(route_id)
+        return None if index is None else self.arrays["route_short_name"][index].decode("utf-8")
+
+    def departures(self, stop_code: str, after_seconds: int = 0, limit: int = 10) -> list:
+        """
+        Scheduled departures of a stop from after_seconds (since the start of the service day),
+        by time: [{"time": seconds, "route_id", "line_number", "agency", "service_id"}, ...].
+        Every service day is included: filter on service_id with calendar.txt.
+        """
+        import numpy as np
+
+        index = self.stop_index(stop_code)
+        if index is None:
+            return []
+        start, end = (int(value) for value in self.arrays["departure_offsets"][index:index + 2])
+        start += int(np.searchsorted(self.arrays["departure_time"][start:end], after_seconds))
+        rows = []
+        for row in range(start, min(end, start + limit)):
+            route = self.arrays["departure_route"][row]
+            rows.append({
+                "time": int(self.arrays["departure_time"][row]),
+                "route_id": self.arrays["route_id"][route].decode("utf-8"),
+                "line_number": self.arrays["route_short_name"][route].decode("utf-8"),
+                "agency": self.arrays["route_agency"][route].decode("utf-8"),
+                "service_id": self.arrays["service_id"][self.arrays["departure_service"][row]].decode("utf-8"),
+            })
+        return rows
+
+    def metrics(self) -> dict:
+        return {
+            "stops": len(self),
+            "routes": len(self.arrays["route_id"]),
+            "departures": len(self.arrays["departure_time"]),
+            "mapped_bytes": self.mapped_bytes,
+            "age_seconds": round(time.time() - self.manifest["built_at"]),
+        }
@@ -0,0 +1,42 @@
+import hashlib
+import json
+from email.utils import formatdate
+
+from fastapi import Request
+from fastapi.responses import Response
+
+
+def render_json(payload) -> tuple:
+    """
+    Serialize a payload once and derive its strong ETag from the bytes.
+
+    Returns:
+        tuple: (body bytes, ETag header value).
+    """
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return body, '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    True when the If-None-Match header of the request holds the ETag (or "*").
+    """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [candidate.strip() for candidate in header.split(",")]
+    return "*" in candidates or any(candidate.removeprefix("W/") == etag for candidate in candidates)
+
+
+def cacheable_response(request: Request, body: bytes, etag: str, max_age: int,
+                       last_modified: float = None) -> Response:
+    """
+    JSON response with ETag and Cache-Control headers, or an empty 304 when the client
+    already holds this version.
+    """
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={max(0, int(max_age))}"}
+    if last_modified is not None:
+        headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -0,0 +1,191 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from app.utils.utils import get_cached_board, get_cached_times
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 15
+DEFAULT_KEEPALIVE_SECONDS = 20
+DEFAULT_MAX_CONNECTIONS = 5000
+
+
+class TooManyConnections(Exception):
+    """
+    Raised when the worker already streams max_connections live boards.
+    """
+
+
+def _event(name: str, version: int, payload: dict) -> bytes:
+    data = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    return f"event: {name}\nid: {version}\ndata: {data}\n\n".encode("utf-8")
+
+
+class StopPoller:
+    """
+    The live board of one stop, polled once for all its connections.
+
+    Every update is rendered once, as Server-Sent Events bytes: the full board ("snapshot")
+    and the rows that changed since the previous version ("update"). A connection only keeps
+    the version it has sent; it waits on a future shared by all the connections of the stop.
+    """
+
+    def __init__(self, stop_number: str, poll_interval: float):
+        self.stop_number = stop_number
+        self.poll_interval = poll_interval
+        self.connections = 0
+        self.version = 0
+        self.snapshot = None
+        self.update = None
+        self._rows = {}
+        self._changed = asyncio.get_running_loop().create_future()
+        self._task = asyncio.create_task(self._run())
+
+    async def wait_for_change(self, timeout: float) -> bool:
+        """
+        Wait until the next version (True) or the timeout (False).
+        """
+        try:
+            await asyncio.wait_for(asyncio.shield(self._changed), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def close(self):
+        self._task.cancel()
+        if not self._changed.done():
+            self._changed.cancel()
+
+    async def _run(self):
+        while True:
+            try:
+                cached = await get_cached_times(self.stop_number)
+                self._publish(cached.fetched_at, get_cached_board(cached, self.stop_number))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Live board poll of stop %s failed: %s", self.stop_number, e)
+            await asyncio.sleep(self.poll_interval)
+
+    def _publish(self, fetched_at: float, lines: list):
+        rows = {(line["line_number"], line["agency"]): line for line in lines}
+        changed = [row for key, row in rows.items() if self._rows.get(key, {}).get("etas") != row["etas"]]
+        removed = [{"line_number": line_number, "agency": agency}
+                   for line_number, agency in self._rows.keys() - rows.keys()]
+        if self.snapshot is not None and not changed and not removed:
+            return
+        self._rows = rows
+        self.version += 1
+        fetched_at = datetime.fromtimestamp(fetched_at).isoformat(timespec="seconds")
+        self.snapshot = _event("snapshot", self.version,
+                               {"stop_number": self.stop_number, "fetched_at": fetched_at, "lines": lines})
+        self.update = _event("update", self.version,
+                             {"stop_number": self.stop_number, "fetched_at": fetched_at,
+                              "changed": changed, "removed": removed})
+        changed_future, self._changed = self._changed, asyncio.get_running_loop().create_future()
+        # Already cancelled when the poller was closed during the poll
+        if not changed_future.done():
+            changed_future.set_result(self.version)
+
+
+class LiveBoardHub:
+    """
+    Live arrival boards streamed as Server-Sent Events, with one shared poller per stop.
+
+    A poller starts with the first connection to its stop and stops with the last one. It
+    reads the SIRI cache every poll_interval seconds, so the upstream cost is one request per
+    watched stop and interval, whatever the number of connections. A connection first gets
+    the full board, then only the rows whose ETAs changed (or the full board again if it fell
+    more than one version behind), and a comment every keepalive_seconds.
+    """
+
+    def __init__(self, poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 keepalive_seconds: float = DEFAULT_KEEPALIVE_SECONDS, max_connections: int = DEFAULT_MAX_CONNECTIONS):
+        self.poll_interval = poll_interval
+        self.keepalive_seconds = keepalive_seconds
+        self.max_connections = max_connections
+        self.connections = 0
+        self._pollers = {}
+        self.counters = {"events_sent": 0, "connections_refused": 0}
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a hub configured by the LIVE_BOARD_* environment variables.
+        """
+        return cls(
+            poll_interval=float(os.getenv("LIVE_BOARD_POLL_INTERVAL", DEFAULT_POLL_INTERVAL)),
+            keepalive_seconds=float(os.getenv("LIVE_BOARD_KEEPALIVE_SECONDS", DEFAULT_KEEPALIVE_SECONDS)),
+            max_connections=int(os.getenv("LIVE_BOARD_MAX_CONNECTIONS", DEFAULT_MAX_CONNECTIONS)),
+        )
+
+    def check_capacity(self):
+        """
+        Raises:
+            TooManyConnections: If the worker already streams max_connections boards.
+        """
+        if self.connections >= self.max_connections:
+            self.counters["connections_refused"] += 1
+            raise TooManyConnections(f"At most {self.max_connections} live boards per worker")
+
+    def open(self, stop_number: str) -> StopPoller:
+        """
+        Register a connection to the stop's board.
+        """
+        poller = self._pollers.get(stop_number)
+        if poller is None:
+            poller = self._pollers[stop_number] = StopPoller(stop_number, self.poll_interval)
+        poller.connections += 1
+        self.connections += 1
+        return poller
+
+    def close(self, poller: StopPoller):
+        poller.connections -= 1
+        self.connections -= 1
+        if poller.connections == 0:
+            poller.close()
+            self._pollers.pop(poller.stop_number, None)
+
+    async def stream(self, stop_number: str):
+        """
+        Server-Sent Events of a connection to the stop's board, registered while it is iterated
+        (so a client gone before the first event holds nothing).
+        """
+        poller = self.open(stop_number)
+        sent = 0
+        try:
+            while True:
+                if poller.version > sent:
+                    event = poller.update if sent and poller.version == sent + 1 else poller.snapshot
+                    sent = poller.version
+                    self.counters["events_sent"] += 1
+                    yield event
+                elif not await poller.wait_for_change(self.keepalive_seconds):
+                    yield b": keepalive\n\n"
+        finally:
+            self.close(poller)
+
+    async def stop(self):
+        """
+        Close every poller and wait for their tasks to end.
+        """
+        pollers = list(self._pollers.values())
+        for poller in pollers:
+            poller.close()
+        self._pollers.clear()
+        await asyncio.gather(*(poller._task for poller in pollers), return_exceptions=True)
+
+    def metrics(self) -> dict:
+        return {"connections": self.connections, "stops": len(self._pollers), **self.counters}
+
+
+# Live boards of the process
+live_board_hub = LiveBoardHub.from_env()
@@ -0,0 +1,113 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import uuid
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Correlation ID of the chat turn being processed, added to every log record
+turn_id = contextvars.ContextVar("turn_id", default="-")
+
+_listener = None
+
+
+def new_turn_id() -> str:
+    """
+    Start a new chat turn: generate its correlation ID and attach it to the current context.
+    """
+    value = uuid.uuid4().hex[:12]
+    turn_id.set(value)
+    return value
+
+
+class Truncated:
+    """
+    Lazy, size-capped rendering of a large payload for a log message.
+
+    Nothing is formatted unless the record is actually emitted, and then at most `limit`
+    characters are kept, followed by the full size.
+    """
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value, limit: int = None):
+        self.value = value
+        self.limit = limit if limit is not None else int(os.getenv("LOG_PAYLOAD_LIMIT", 300))
+
+    def __str__(self):
+        text = str(self.value)
+        if len(text) <= self.limit:
+            return text
+        size = f"{len(self.value)} items, " if isinstance(self.value, (list, tuple, dict, set)) else ""
+        return f"{text[:self.limit]}... ({size}{len(text)} chars)"
+
+    __repr__ = __str__
+
+
+class TurnIdFilter(logging.Filter):
+    """
+    Add the turn correlation ID to the record. Installed on the QueueHandler, it runs in the
+    caller's thread before the record is queued, where the turn's context is still current.
+    """
+
+    def filter(self, record):
+        record.turn_id = turn_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line: time, level, logger, turn ID, message (and exception if any).
+    """
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "turn_id": getattr(record, "turn_id", "-"),
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def configure_logging():
+    """
+    Set up the root logger once for the process.
+
+    Records at or above LOG_LEVEL are put on an in-memory queue and written by a background
+    listener thread, so logging never blocks the event loop on I/O. LOG_FORMAT selects
+    "text" (default) or "json" lines; both carry the turn correlation ID.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    level = os.getenv("LOG_LEVEL", "INFO").upper()
+    if os.getenv("LOG_FORMAT", "text").lower() == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(turn_id)s] %(message)s")
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(TurnIdFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+    # httpx logs every request at INFO
+    logging.getLogger("httpx").setLevel(max(root.level, logging.WARNING))
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
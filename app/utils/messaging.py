@@ -1,16 +1,17 @@
+import asyncio
+import random
 import httpx
 import os
 from dotenv import load_dotenv
-from openai import OpenAI
 import logging
 
+from app.utils.logs import configure_logging
+from app.utils.metrics import timed
+
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI client
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 wait_messages = {
@@ -23,6 +24,26 @@ wait_messages = {
     "he": "אנא המתן רגע בעוד אני מעבד את בקשתך."
 }
 
+slow_down_messages = {
+    "en": "You are sending messages too quickly. Please wait a moment before asking again.",
+    "es": "Está enviando mensajes demasiado rápido. Por favor, espere un momento antes de volver a preguntar.",
+    "fr": "Vous envoyez des messages trop rapidement. Veuillez patienter un moment avant de redemander.",
+    "it": "Sta inviando messaggi troppo velocemente. Per favore, aspetti un momento prima di chiedere di nuovo.",
+    "ru": "Вы отправляете сообщения слишком быстро. Пожалуйста, подождите немного, прежде чем спросить снова.",
+    "ar": "أنت ترسل الرسائل بسرعة كبيرة. الرجاء الانتظار لحظة قبل السؤال مرة أخرى.",
+    "he": "אתה שולח הודעות מהר מדי. אנא המתן רגע לפני שתשאל שוב."
+}
+
+voice_error_messages = {
+    "en": "Sorry, I couldn't understand your voice message. Please send your question as text.",
+    "es": "Lo siento, no pude entender su mensaje de voz. Por favor, envíe su pregunta por escrito.",
+    "fr": "Désolé, je n'ai pas pu comprendre votre message vocal. Veuillez envoyer votre question par écrit.",
+    "it": "Mi dispiace, non sono riuscito a capire il suo messaggio vocale. Per favore, invii la domanda per iscritto.",
+    "ru": "Извините, я не смог разобрать ваше голосовое сообщение. Пожалуйста, отправьте вопрос текстом.",
+    "ar": "عذرًا، لم أتمكن من فهم رسالتك الصوتية. الرجاء إرسال سؤالك كتابةً.",
+    "he": "מצטער, לא הצלחתי להבין את ההודעה הקולית שלך. אנא שלח את שאלתך בכתב."
+}
+
 
 async def generate_polite_wait_message(language: str):
     """
@@ -33,22 +54,38 @@ async def generate_polite_wait_message(language: str):
     return message
 
 
+async def generate_slow_down_message(language: str):
+    """
+    Generate the "please slow down" message sent when a user is rate limited.
+    """
+    return slow_down_messages.get(language, slow_down_messages["en"])
+
+
+async def generate_voice_error_message(language: str):
+    """
+    Generate the message sent when a voice message couldn't be transcribed.
+    """
+    return voice_error_messages.get(language, voice_error_messages["en"])
+
+
 async def send_wait_message(current_language: str, user_id):
     wait_message = await generate_polite_wait_message(current_language)
     try:
-        async with httpx.AsyncClient() as client:
-            await send_whatsapp_message(client, recipient_id=user_id, message=wait_message)
-        print(f"Wait message sent successfully to user {user_id}")
+        await whatsapp_sender.send(user_id, wait_message)
+        logger.debug("Wait message queued for user %s", user_id)
     except Exception as e:
-        print(f"Error sending wait message to user {user_id}: {e}")
+        logger.error("Error sending wait message to user %s: %s", user_id, e)
 
 
-async def send_whatsapp_response(client, recipient_id, ai_response):
+async def send_whatsapp_response(recipient_id, ai_response):
     """
     Handle sending WhatsApp messages based on AI response content.
 
+    The WARNING and the transit times are queued one after the other, so the sender
+    delivers them in a single POST. Delivery happens in the background: its failures are
+    logged and counted by the sender.
+
     Args:
-        client: The HTTP client for sending messages
         recipient_id: The recipient's WhatsApp ID
         ai_response: List of message dictionaries from the AI
     """
@@ -61,26 +98,16 @@ async def send_whatsapp_response(client, recipient_id, ai_response):
     last_message = ai_response[-1]["content"] if ai_response else None
     second_last_message = ai_response[-2]["content"] if len(ai_response) > 1 else None
 
-    try:
-        if second_last_message and second_last_message.startswith("WARNING"):
-            # Send both the warning and the transit times
-            await send_whatsapp_message(client, recipient_id, second_last_message)
-            if last_message:  # Ensure there's a last message before sending
-                await send_whatsapp_message(client, recipient_id, last_message)
-        elif last_message:
-            # No warning, just send the transit times
-            await send_whatsapp_message(client, recipient_id, last_message)
-        else:
-            logger.error("No valid message content to send")
-
-    except Exception as e:
-        logger.error(f"Error sending WhatsApp message: {str(e)}")
-        # Optionally send an error message to the user
-        await send_whatsapp_message(
-            client,
-            recipient_id,
-            "Sorry, there was an error processing your request."
-        )
+    if second_last_message and second_last_message.startswith("WARNING"):
+        # Send both the warning and the transit times
+        await whatsapp_sender.send(recipient_id, second_last_message)
+        if last_message:  # Ensure there's a last message before sending
+            await whatsapp_sender.send(recipient_id, last_message)
+    elif last_message:
+        # No warning, just send the transit times
+        await whatsapp_sender.send(recipient_id, last_message)
+    else:
+        logger.error("No valid message content to send")
 
 
 async def send_whatsapp_message(client: httpx.AsyncClient, recipient_id: str, message: str):
@@ -104,3 +131,153 @@ async def send_whatsapp_message(client: httpx.AsyncClient, recipient_id: str, me
 
     # Raise an error if the response fails
     response.raise_for_status()
+
+
+class WhapiSender:
+    """
+    Outbound WHAPI sender shared by the whole process.
+
+    - One pooled HTTP client (keep-alive connections) for every POST.
+    - Messages produced for the same recipient within coalesce_window seconds are joined
+      into one POST (up to max_body characters).
+    - Batches go through per-worker queues, chosen by recipient so a recipient's messages
+      keep their order, and at most max_pending messages wait at once: send() waits for
+      room when the queue is full.
+    - POSTs answered with 429/5xx (or failing on the network) are retried with exponential
+      backoff, honouring Retry-After.
+    """
+
+    def __init__(self, workers: int = 4, max_pending: int = 1000, coalesce_window: float = 0.3,
+                 max_body: int = 4000, max_retries: int = 4, backoff_base: float = 0.5, backoff_max: float = 10.0,
+                 max_connections: int = 20, timeout: float = 10.0):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.coalesce_window = coalesce_window
+        self.max_body = max_body
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.client = None
+        self._queues = []
+        self._tasks = []
+        self._slots = None
+        # recipient_id -> messages waiting for the coalescing window to close, and its timer
+        self._open_batches = {}
+        self._batch_timers = {}
+        self._pending = 0
+        self.counters = {"messages": 0, "posts": 0, "coalesced": 0, "retries": 0, "failures": 0}
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a sender configured by the WHAPI_SENDER_* environment variables.
+        """
+        return cls(
+            workers=int(os.getenv("WHAPI_SENDER_WORKERS", 4)),
+            max_pending=int(os.getenv("WHAPI_SENDER_MAX_PENDING", 1000)),
+            coalesce_window=float(os.getenv("WHAPI_SENDER_COALESCE_WINDOW", 0.3)),
+            max_retries=int(os.getenv("WHAPI_SENDER_MAX_RETRIES", 4)),
+            max_connections=int(os.getenv("WHAPI_SENDER_MAX_CONNECTIONS", 20)),
+            timeout=float(os.getenv("WHAPI_SENDER_TIMEOUT", 10.0)),
+        )
+
+    def start(self):
+        if self._tasks:
+            return
+        limits = httpx.Limits(max_connections=self.max_connections,
+                              max_keepalive_connections=self.max_connections)
+        self.client = httpx.AsyncClient(limits=limits, timeout=self.timeout)
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._queues = [asyncio.Queue() for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+
+    async def stop(self):
+        """
+        Deliver everything still queued, then stop the workers and close the HTTP client.
+        """
+        if not self._tasks:
+            return
+        for recipient_id in list(self._open_batches):
+            self._close_batch(recipient_id)
+        for queue in self._queues:
+            await queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.client.aclose()
+        self.client = None
+
+    async def send(self, recipient_id: str, message: str):
+        """
+        Queue a message for the recipient (delivered in the background).
+        """
+        self.start()
+        await self._slots.acquire()
+        self._pending += 1
+        self.counters["messages"] += 1
+        batch = self._open_batches.get(recipient_id)
+        if batch is not None and sum(len(m) + 2 for m in batch) + len(message) > self.max_body:
+            self._close_batch(recipient_id)
+            batch = None
+        if batch is None:
+            self._open_batches[recipient_id] = [message]
+            self._batch_timers[recipient_id] = asyncio.get_running_loop().call_later(
+                self.coalesce_window, self._close_batch, recipient_id)
+        else:
+            batch.append(message)
+            self.counters["coalesced"] += 1
+
+    def metrics(self) -> dict:
+        return dict(self.counters, pending=self._pending)
+
+    def _close_batch(self, recipient_id: str):
+        # A batch closed early (full, or at stop) must not leave its timer to close the next one
+        timer = self._batch_timers.pop(recipient_id, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._open_batches.pop(recipient_id, None)
+        if batch:
+            self._queues[hash(recipient_id) % len(self._queues)].put_nowait((recipient_id, batch))
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            recipient_id, batch = await queue.get()
+            try:
+                await self._post_with_retries(recipient_id, "\n\n".join(batch))
+            except Exception as e:
+                self.counters["failures"] += 1
+                logger.error("Error sending WhatsApp message to %s: %s", recipient_id, e)
+            finally:
+                for _ in batch:
+                    self._slots.release()
+                self._pending -= len(batch)
+                queue.task_done()
+
+    async def _post_with_retries(self, recipient_id: str, message: str):
+        for attempt in range(self.max_retries + 1):
+            try:
+                with timed("whapi_send"):
+                    await send_whatsapp_message(self.client, recipient_id, message)
+                self.counters["posts"] += 1
+                return
+            except (httpx.HTTPStatusError, httpx.TransportError) as e:
+                retry_after = None
+                if isinstance(e, httpx.HTTPStatusError):
+                    status = e.response.status_code
+                    if status != 429 and status < 500:
+                        raise
+                    retry_after = e.response.headers.get("Retry-After")
+                if attempt == self.max_retries:
+                    raise
+                delay = min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.0)
+                if retry_after and retry_after.isdigit():
+                    delay = min(self.backoff_max, float(retry_after))
+                self.counters["retries"] += 1
+                await asyncio.sleep(delay)
+
+
+# Sender used by every outbound WhatsApp message of the process
+whatsapp_sender = WhapiSender.from_env()
@@ -0,0 +1,182 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from bisect import bisect_left
+
+# Latency buckets in seconds, from cache hits to slow LLM answers
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Every metric created, rendered in this order by render_metrics()
+_registry = []
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values) if value is not None]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """
+    Monotonic counter with labels, rendered in the Prometheus text format.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram with labels, rendered in the Prometheus text format.
+
+    An observation is a bisect plus three additions, cheap enough to leave on in production.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [count per bucket (+Inf last), sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self) -> dict:
+        """
+        Copy of every series: labels -> (count per bucket, sum, count).
+        """
+        with self._lock:
+            return {labels: (list(bucket_counts), total, count)
+                    for labels, (bucket_counts, total, count) in self._series.items()}
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (bucket_counts, total, count) in self._series.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ("+Inf",), bucket_counts):
+                    cumulative += bucket_count
+                    le = f'le="{bound}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("helpy_stage_duration_seconds", "Duration of each stage of a chat turn.",
+                          ("stage", "tool", "cache"))
+STAGE_ERRORS = Counter("helpy_stage_errors_total", "Stages of a chat turn that raised an error.",
+                       ("stage", "tool"))
+
+
+# When set (e.g. by the request profiler), every stage of the current request is also appended
+# to this list as (stage, tool, cache, start, seconds, error)
+stage_trace = contextvars.ContextVar("stage_trace", default=None)
+
+
+class timed:
+    """
+    Context manager recording the duration (and the error, if any) of a stage.
+
+    The labels can be completed inside the block, e.g. `stage.cache = "hit"`.
+    """
+    __slots__ = ("stage", "tool", "cache", "_start")
+
+    def __init__(self, stage: str, tool: str = None, cache: str = None):
+        self.stage = stage
+        self.tool = tool
+        self.cache = cache
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._start
+        STAGE_SECONDS.observe(seconds, self.stage, self.tool, self.cache)
+        error = exc_type is not None and not issubclass(exc_type, asyncio.CancelledError)
+        if error:
+            STAGE_ERRORS.inc(self.stage, self.tool)
+        trace = stage_trace.get()
+        if trace is not None:
+            trace.append((self.stage, self.tool, self.cache, self._start, seconds, error))
+        return False
+
+
+def instrumented(stage: str):
+    """
+    Decorator recording every call of a sync or async function as a stage.
+    """
+    def decorator(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with timed(stage):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render_gauges(prefix: str, values: dict, counters=()) -> list:
+    """
+    Render the numeric values of a (nested) metrics dictionary named prefix_key: as counters
+    for the keys in `counters` (every value under a nested dictionary of such a key), as gauges
+    for the others.
+    """
+    lines = []
+    for key, value in values.items():
+        name = f"{prefix}_{key}"
+        if isinstance(value, dict):
+            lines.extend(render_gauges(name, value, value.keys() if key in counters else counters))
+        elif isinstance(value, (int, float)):
+            lines.append(f"# TYPE {name} {'counter' if key in counters else 'gauge'}")
+            lines.append(f"{name} {value}")
+    return lines
+
+
+def render_metrics(*extra_lines: list) -> str:
+    """
+    Render every metric, followed by the extra gauge lines, in the Prometheus text format.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for extra in extra_lines:
+        lines.extend(extra)
+    return "\n".join(lines) + "\n"
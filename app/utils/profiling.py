@@ -0,0 +1,169 @@
+import cProfile
+import hmac
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from app.utils.blocking import run_blocking
+from app.utils.metrics import stage_trace
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "X-Helpy-Profile"
+
+
+class StackSampler:
+    """
+    Statistical profiler: a background thread samples the stack of the profiled thread every
+    `interval` seconds and counts the stacks in the "folded" format read by flamegraph.pl,
+    speedscope or inferno ("outer;inner;leaf count" per line).
+
+    The profiled thread is the event loop thread, so the stacks include every task the loop
+    runs meanwhile (other requests, background loops), not only the profiled request.
+    """
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if frames:
+                stack = ";".join(reversed(frames))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+
+class RequestProfiler:
+    """
+    Opt-in profiling of single webhook requests.
+
+    A request is profiled when it carries the X-Helpy-Profile header set to PROFILE_TOKEN, or
+    randomly for a `sample_rate` share of the requests. Each profile writes, in `output_dir`:
+    - <name>.folded: sampled stacks, ready for a flamegraph (mode "sampling", the default), or
+      <name>.pstats: cProfile statistics (mode "cprofile"),
+    - <name>.json: the duration of the request and the timing of each of its stages.
+
+    Only one request is profiled at a time; the others run normally meanwhile. Both modes
+    record the whole event loop thread while the request runs, so the stacks also cover the
+    other requests and background tasks interleaved with it; only the .json stages belong to
+    the request alone. The files are written in the blocking thread pool.
+    """
+
+    def __init__(self, output_dir: str = "profiles", sample_rate: float = 0.0, token: str = None,
+                 mode: str = "sampling", interval: float = 0.005):
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        self.token = token
+        self.mode = mode
+        self.interval = interval
+        self.profiles_written = 0
+        self._active = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a profiler configured by the PROFILE_* environment variables.
+        """
+        return cls(
+            output_dir=os.getenv("PROFILE_DIR", "profiles"),
+            sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", 0.0)),
+            token=os.getenv("PROFILE_TOKEN") or None,
+            mode=os.getenv("PROFILE_MODE", "sampling"),
+            interval=float(os.getenv("PROFILE_INTERVAL", 0.005)),
+        )
+
+    def is_authorized(self, token: str) -> bool:
+        return bool(self.token) and token is not None and hmac.compare_digest(token, self.token)
+
+    def should_profile(self, headers) -> bool:
+        if self.is_authorized(headers.get(PROFILE_HEADER)):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    @asynccontextmanager
+    async def profile(self, label: str):
+        """
+        Profile the enclosed block (if no other profile is running) and write its files.
+        """
+        if not self._active.acquire(blocking=False):
+            yield
+            return
+        trace = []
+        token = stage_trace.set(trace)
+        sampler = profiler = None
+        if self.mode == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            sampler = StackSampler(threading.get_ident(), self.interval)
+            sampler.start()
+        started_at = time.time()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started
+            if profiler is not None:
+                profiler.disable()
+            if sampler is not None:
+                sampler.stop()
+            stage_trace.reset(token)
+            try:
+                await run_blocking(self._write, label, started_at, started, duration, trace, profiler, sampler)
+            except OSError as e:
+                logger.error("Error writing profile: %s", e)
+            finally:
+                self._active.release()
+
+    def _write(self, label, started_at, started, duration, trace, profiler, sampler):
+        os.makedirs(self.output_dir, exist_ok=True)
+        name = f"{datetime.fromtimestamp(started_at).strftime('%Y%m%d-%H%M%S-%f')}-{label}"
+        base_path = os.path.join(self.output_dir, name)
+        if profiler is not None:
+            profiler.dump_stats(base_path + ".pstats")
+        if sampler is not None:
+            with open(base_path + ".folded", "w", encoding="utf-8") as file:
+                file.write(sampler.folded())
+        report = {
+            "label": label,
+            "started_at": started_at,
+            "duration_ms": round(1000 * duration, 3),
+            "stages": [{"stage": stage, "tool": tool, "cache": cache,
+                        "offset_ms": round(1000 * (start - started), 3), "duration_ms": round(1000 * seconds, 3),
+                        "error": error}
+                       for stage, tool, cache, start, seconds, error in trace],
+        }
+        with open(base_path + ".json", "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        self.profiles_written += 1
+        logger.info("Profile written to %s", base_path)
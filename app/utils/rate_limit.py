@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+DEFAULT_USER_PER_MINUTE = 6
+DEFAULT_USER_BURST = 5
+DEFAULT_CHAT_PER_MINUTE = 20
+DEFAULT_CHAT_BURST = 10
+DEFAULT_GLOBAL_PER_SECOND = 20
+DEFAULT_GLOBAL_BURST = 40
+DEFAULT_MAX_BUCKETS = 100000
+DEFAULT_NOTICE_COOLDOWN_SECONDS = 60
+
+
+class TokenBucket:
+    """
+    Classic token bucket: refilled with `rate` tokens per second, holding at most `capacity`.
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+
+class RateLimiter:
+    """
+    Admission control with token buckets per user, per chat and for the whole process.
+
+    A request is admitted only if the three buckets have a token left, and then takes one
+    token from each. Beyond max_buckets, the least recently used buckets are dropped. A bucket
+    idle long enough to be full again changes no decision when dropped; one still refilling
+    (when more than max_buckets users and chats were active within a refill time) hands its
+    user a fresh burst, so those evictions are counted (evicted_refilling) to size max_buckets.
+    """
+
+    def __init__(self, user_per_minute: float = DEFAULT_USER_PER_MINUTE, user_burst: int = DEFAULT_USER_BURST,
+                 chat_per_minute: float = DEFAULT_CHAT_PER_MINUTE, chat_burst: int = DEFAULT_CHAT_BURST,
+                 global_per_second: float = DEFAULT_GLOBAL_PER_SECOND, global_burst: int = DEFAULT_GLOBAL_BURST,
+                 max_buckets: int = DEFAULT_MAX_BUCKETS,
+                 notice_cooldown_seconds: float = DEFAULT_NOTICE_COOLDOWN_SECONDS, clock=time.monotonic):
+        self._clock = clock
+        self.user_rate, self.user_burst = user_per_minute / 60, user_burst
+        self.chat_rate, self.chat_burst = chat_per_minute / 60, chat_burst
+        self.max_buckets = max_buckets
+        self.notice_cooldown_seconds = notice_cooldown_seconds
+        self._global_bucket = TokenBucket(global_per_second, global_burst, clock())
+        self._buckets = OrderedDict()
+        self._notices = OrderedDict()
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.evicted_refilling = 0
+        self.shed = {"user": 0, "chat": 0, "global": 0}
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a limiter configured by the RATE_LIMIT_* environment variables.
+        """
+        return cls(
+            user_per_minute=float(os.getenv("RATE_LIMIT_USER_PER_MINUTE", DEFAULT_USER_PER_MINUTE)),
+            user_burst=int(os.getenv("RATE_LIMIT_USER_BURST", DEFAULT_USER_BURST)),
+            chat_per_minute=float(os.getenv("RATE_LIMIT_CHAT_PER_MINUTE", DEFAULT_CHAT_PER_MINUTE)),
+            chat_burst=int(os.getenv("RATE_LIMIT_CHAT_BURST", DEFAULT_CHAT_BURST)),
+            global_per_second=float(os.getenv("RATE_LIMIT_GLOBAL_PER_SECOND", DEFAULT_GLOBAL_PER_SECOND)),
+            global_burst=int(os.getenv("RATE_LIMIT_GLOBAL_BURST", DEFAULT_GLOBAL_BURST)),
+            max_buckets=int(os.getenv("RATE_LIMIT_MAX_BUCKETS", DEFAULT_MAX_BUCKETS)),
+            notice_cooldown_seconds=float(os.getenv("RATE_LIMIT_NOTICE_COOLDOWN_SECONDS",
+                                                    DEFAULT_NOTICE_COOLDOWN_SECONDS)),
+        )
+
+    def admit(self, user_id: str, chat_id: str) -> bool:
+        """
+        Take a token for this user and chat, or tell that the request must be shed.
+        """
+        with self._lock:
+            now = self._clock()
+            scopes = (
+                ("user", self._bucket(("user", user_id), self.user_rate, self.user_burst, now)),
+                ("chat", self._bucket(("chat", chat_id), self.chat_rate, self.chat_burst, now)),
+                ("global", self._global_bucket),
+            )
+            for scope, bucket in scopes:
+                if bucket.refill(now) < 1:
+                    self.shed[scope] += 1
+                    return False
+            for _, bucket in scopes:
+                bucket.tokens -= 1
+            self.admitted += 1
+            return True
+
+    def should_notify(self, user_id: str) -> bool:
+        """
+        Tell whether a shed user should get the "please slow down" reply, at most once per cooldown.
+        """
+        with self._lock:
+            now = self._clock()
+            last_notice = self._notices.get(user_id)
+            if last_notice is not None and now - last_notice < self.notice_cooldown_seconds:
+                return False
+            self._notices[user_id] = now
+            self._notices.move_to_end(user_id)
+            while len(self._notices) > self.max_buckets:
+                self._notices.popitem(last=False)
+            return True
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "buckets": len(self._buckets),
+                "admitted": self.admitted,
+                "evicted_refilling": self.evicted_refilling,
+                "shed": dict(self.shed),
+            }
+
+    def _bucket(self, key: tuple, rate: float, capacity: int, now: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, capacity, now)
+            while len(self._buckets) > self.max_buckets:
+                _, oldest = self._buckets.popitem(last=False)
+                if oldest.refill(now) < oldest.capacity:
+                    self.evicted_refilling += 1
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
@@ -0,0 +1,207 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_SECONDS = 30
+DEFAULT_HEDGE_MIN_DELAY = 0.05
+DEFAULT_HEDGE_MAX_RATIO = 0.1
+# Latencies kept to estimate the p95, and needed before hedging
+LATENCY_WINDOW = 200
+MIN_HEDGE_SAMPLES = 20
+
+
+class UpstreamUnavailable(Exception):
+    """
+    Raised when an upstream call is refused by its open circuit or times out.
+    """
+
+
+class CircuitBreaker:
+    """
+    Fail fast while an upstream is unhealthy.
+
+    After failure_threshold consecutive failures the circuit opens: calls are refused for
+    reset_seconds, then a single probe call is let through (half-open). Its success closes the
+    circuit, its failure opens it again.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 reset_seconds: float = DEFAULT_RESET_SECONDS, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        """
+        True if a call may go to the upstream (it must then be reported to record_success,
+        record_failure or release).
+        """
+        if self.state == self.OPEN:
+            if self._clock() - self._opened_at < self.reset_seconds:
+                return False
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.opened += 1
+            self.state = self.OPEN
+            self._opened_at = self._clock()
+        self._probing = False
+
+    def release(self):
+        """
+        A call that ended without an outcome (cancelled): let another probe through.
+        """
+        self._probing = False
+
+
+class ResilientUpstream:
+    """
+    Timeout, circuit breaker and hedged requests around the calls to one upstream endpoint.
+
+    A call gets timeout seconds in all. Once enough latencies are known, a call that hasn't
+    answered by their p95 (at least hedge_min_delay) is sent a second time and the first answer
+    wins: a slow connection or a slow upstream replica no longer sets the tail latency. At most
+    hedge_max_ratio of the calls are hedged, so a slow upstream doesn't get twice the load.
+    """
+
+    def __init__(self, name: str, timeout: float, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 reset_seconds: float = DEFAULT_RESET_SECONDS, hedge: bool = True,
+                 hedge_min_delay: float = DEFAULT_HEDGE_MIN_DELAY, hedge_max_ratio: float = DEFAULT_HEDGE_MAX_RATIO,
+                 clock=time.monotonic):
+        self.name = name
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(failure_threshold, reset_seconds, clock)
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_ratio = hedge_max_ratio
+        self._clock = clock
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self.counters = {"calls": 0, "failures": 0, "timeouts": 0, "short_circuited": 0, "hedged": 0,
+                         "hedge_wins": 0}
+
+    @classmethod
+    def from_env(cls, name: str, default_timeout: float):
+        """
+        Build the wrapper of an upstream, with its timeout from <NAME>_TIMEOUT_SECONDS and the
+        breaker and hedging settings shared by the UPSTREAM_* variables.
+        """
+        return cls(
+            name,
+            timeout=float(os.getenv(f"{name.upper()}_TIMEOUT_SECONDS", default_timeout)),
+            failure_threshold=int(os.getenv("UPSTREAM_BREAKER_FAILURES", DEFAULT_FAILURE_THRESHOLD)),
+            reset_seconds=float(os.getenv("UPSTREAM_BREAKER_RESET_SECONDS", DEFAULT_RESET_SECONDS)),
+            hedge=os.getenv("UPSTREAM_HEDGE", "true").lower() in ("1", "true", "yes"),
+            hedge_min_delay=float(os.getenv("UPSTREAM_HEDGE_MIN_DELAY", DEFAULT_HEDGE_MIN_DELAY)),
+            hedge_max_ratio=float(os.getenv("UPSTREAM_HEDGE_MAX_RATIO", DEFAULT_HEDGE_MAX_RATIO)),
+        )
+
+    def p95(self) -> float:
+        """
+        p95 of the recent successful call latencies (None until enough calls were made).
+        """
+        if len(self._latencies) < MIN_HEDGE_SAMPLES:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def hedge_delay(self) -> float:
+        """
+        How long to wait before hedging the next call (None: don't hedge it).
+        """
+        if not self.hedge or self.counters["hedged"] >= self.hedge_max_ratio * self.counters["calls"]:
+            return None
+        p95 = self.p95()
+        return None if p95 is None else max(self.hedge_min_delay, p95)
+
+    async def call(self, request):
+        """
+        Await request() (a coroutine function, raising on a failed response) with the timeout,
+        the breaker and hedging.
+
+        Raises:
+            UpstreamUnavailable: If the circuit is open or the call timed out.
+        """
+        if not self.breaker.allow():
+            self.counters["short_circuited"] += 1
+            raise UpstreamUnavailable(f"{self.name} upstream unavailable (circuit open)")
+        self.counters["calls"] += 1
+        started = self._clock()
+        try:
+            result = await asyncio.wait_for(self._hedged(request), self.timeout)
+        except asyncio.TimeoutError:
+            self.counters["timeouts"] += 1
+            self.counters["failures"] += 1
+            self.breaker.record_failure()
+            raise UpstreamUnavailable(f"{self.name} upstream timed out after {self.timeout}s")
+        except asyncio.CancelledError:
+            self.breaker.release()
+            raise
+        except Exception:
+            self.counters["failures"] += 1
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        self._latencies.append(self._clock() - started)
+        return result
+
+    async def _hedged(self, request):
+        delay = self.hedge_delay()
+        tasks = [asyncio.ensure_future(request())]
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    self.counters["hedged"] += 1
+                    tasks.append(asyncio.ensure_future(request()))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self.counters["hedge_wins"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def metrics(self) -> dict:
+        p95 = self.p95()
+        return {
+            "circuit_open": int(self.breaker.state == CircuitBreaker.OPEN),
+            "circuit_opened": self.breaker.opened,
+            "consecutive_failures": self.breaker.failures,
+            "p95_ms": round(1000 * p95, 1) if p95 is not None else 0,
+            **self.counters,
+        }
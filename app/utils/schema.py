@@ -1,24 +1,205 @@
 # schema.py
-from typing import Dict, Any
+import logging
+from typing import Any, Awaitable, Callable, Dict
 import jsonschema
 
-from app.utils.utils import get_lines_at_stop, get_transit_times
+from app.utils.subscriptions import current_chat, subscription_scheduler
+from app.utils.utils import get_arrival_board, get_lines_at_stop, get_transit_times
+from app.utils.vehicle_positions import locate_next_vehicle, vehicle_positions, vehicles_near
 
+logger = logging.getLogger(__name__)
 
-def get_transit_times_function():
+
+class ToolValidationError(ValueError):
+    """
+    Raised when the arguments chosen by the AI for a tool don't match its schema.
     """
-    Creates a function definition for OpenAI's function calling mechanism.
 
-    Returns:
-    - A dictionary describing the function parameters
-    - Used to tell the AI what information it can request
-    - Matches the structure expected by OpenAI's API
+
+class Tool:
     """
-    return {
-        "name": "get_transit_times",  # Name of the function
-        "description": "Retrieve transit arrival times for a specific stop and line",
-        "parameters": {
-            "type": "object",  # Specifies the parameters are an object
+    A function the AI can call, declared once.
+
+    The OpenAI function definition and the compiled JSON schema validator are built when
+    the tool is registered (at import time), not on every chat turn.
+    """
+    __slots__ = ("name", "description", "parameters", "handler", "slow", "openai_schema", "validator")
+
+    def __init__(self, name: str, description: str, parameters: Dict[str, Any],
+                 handler: Callable[..., Awaitable[dict]], slow: bool = False):
+        self.name = name
+        self.description = description
+        self.parameters = parameters
+        # async handler(arguments, detected_language) -> result dictionary
+        self.handler = handler
+        # Slow tools get a "please wait" message sent to the user before running
+        self.slow = slow
+        self.openai_schema = {"name": name, "description": description, "parameters": parameters}
+        validator_class = jsonschema.validators.validator_for(parameters)
+        validator_class.check_schema(parameters)
+        self.validator = validator_class(parameters)
+
+
+# Dispatch table shared by the WhatsApp and terminal front-ends: tool name -> Tool
+TOOLS: Dict[str, Tool] = {}
+
+# Function definitions sent to OpenAI with every chat turn, kept in sync with TOOLS
+OPENAI_FUNCTIONS = []
+
+
+def register_tool(name: str, description: str, parameters: Dict[str, Any],
+                  handler: Callable[..., Awaitable[dict]], slow: bool = False) -> Tool:
+    """
+    Declare a tool the AI can call and add it to the dispatch table.
+    """
+    tool = Tool(name, description, parameters, handler, slow=slow)
+    TOOLS[name] = tool
+    OPENAI_FUNCTIONS[:] = [registered.openai_schema for registered in TOOLS.values()]
+    return tool
+
+
+async def dispatch_tool(name: str, arguments: Dict[str, Any], detected_language: str = None) -> dict:
+    """
+    Validate the arguments chosen by the AI and run the matching tool.
+
+    Raises:
+        ValueError: If the tool is unknown.
+        ToolValidationError: If the arguments don't match the tool's schema.
+    """
+    tool = TOOLS.get(name)
+    if tool is None:
+        raise ValueError(f"Unknown function: {name}")
+    error = jsonschema.exceptions.best_match(tool.validator.iter_errors(arguments))
+    if error is not None:
+        logger.warning("Validation Error: %s", error.message)
+        raise ToolValidationError(f"Invalid {name} parameters: {error.message}")
+    return await tool.handler(arguments, detected_language)
+
+
+async def _handle_transit_times(arguments: Dict[str, Any], detected_language: str = None) -> dict:
+    return await get_transit_times(
+        stop_number=arguments["stop_number"],
+        line_number=arguments["line_number"],
+        operator_id=arguments.get("agency"),
+        detected_language=detected_language
+    )
+
+
+async def _handle_lines_at_stop(arguments: Dict[str, Any], detected_language: str = None) -> dict:
+    return await get_lines_at_stop(validate_lines_at_stop(arguments)["stop_number"])
+
+
+async def _handle_arrival_board(arguments: Dict[str, Any], detected_language: str = None) -> dict:
+    return await get_arrival_board(arguments["stop_number"])
+
+
+async def _handle_vehicle_location(arguments: Dict[str, Any], detected_language: str = None) -> dict:
+    return await locate_next_vehicle(arguments["stop_number"], arguments["line_number"], arguments.get("agency"))
+
+
+async def _handle_vehicles_nearby(arguments: Dict[str, Any], detected_language: str = None) -> dict:
+    return await vehicles_near(
+        stop_number=arguments.get("stop_number"),
+        latitude=arguments.get("latitude"),
+        longitude=arguments.get("longitude"),
+        radius_meters=arguments.get("radius_meters", 500)
+    )
+
+
+async def _handle_subscribe_arrival(arguments: Dict[str, Any], detected_language: str = None) -> dict:
+    chat = current_chat.get()
+    if chat is None:
+        return {"success": False, "error": "Arrival alerts are only available on WhatsApp."}
+    user_id, recipient_id = chat
+    try:
+        subscription = subscription_scheduler.subscribe(
+            user_id, recipient_id,
+            stop_number=arguments["stop_number"],
+            line_number=arguments["line_number"],
+            threshold_minutes=arguments.get("minutes", 5),
+            operator_id=arguments.get("agency"),
+            language=detected_language or "en"
+        )
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+    return {"success": True, **subscription.as_dict()}
+
+
+async def _handle_cancel_arrival_alerts(arguments: Dict[str, Any], detected_language: str = None) -> dict:
+    chat = current_chat.get()
+    if chat is None:
+        return {"success": False, "error": "Arrival alerts are only available on WhatsApp."}
+    cancelled = subscription_scheduler.unsubscribe(chat[0], arguments.get("stop_number"), arguments.get("line_number"))
+    return {"success": True, "cancelled": cancelled}
+
+
+TRANSIT_TIMES_TOOL = register_tool(
+    name="get_transit_times",
+    description="Retrieve transit arrival times for a specific stop and line",
+    parameters={
+        "type": "object",  # Specifies the parameters are an object
+        "properties": {
+            "stop_number": {
+                "type": "string",
+                "description": "Unique identifier for the bus stop"
+            },
+            "line_number": {
+                "type": "string",
+                "description": "Bus line number"
+            },
+            "agency": {
+                "type": "string",
+                "description": "Transit agency operating the line (optional)",
+                "optional": True
+            }
+        },
+        "required": ["stop_number", "line_number"]  # Mandatory fields
+    },
+    handler=_handle_transit_times
+)
+
+LINES_AT_STOP_TOOL = register_tool(
+    name="get_lines_at_stop",
+    description="Only use this when specifically asked to list all lines at a stop.",
+    parameters={
+        "type": "object",  # Specifies the parameters are an object
+        "properties": {
+            "stop_number": {
+                "type": "string",
+                "description": "Unique identifier for the bus stop."
+            }
+        },
+        "required": ["stop_number"]  # Mandatory fields
+    },
+    handler=_handle_lines_at_stop,
+    slow=True
+)
+
+ARRIVAL_BOARD_TOOL = register_tool(
+    name="get_arrival_board",
+    description="Next arrivals of every line at a stop. Use it when the user asks what is coming to "
+                "a stop without naming a line.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "stop_number": {
+                "type": "string",
+                "description": "Unique identifier for the bus stop"
+            }
+        },
+        "required": ["stop_number"]
+    },
+    handler=_handle_arrival_board
+)
+
+# Only offered when a VehiclePositions feed is configured (VEHICLE_POSITIONS_URL)
+if vehicle_positions is not None:
+    VEHICLE_LOCATION_TOOL = register_tool(
+        name="get_vehicle_location",
+        description="Where the next bus of a line heading to a stop is right now (e.g. 'where is bus 5 "
+                    "coming to stop 1234').",
+        parameters={
+            "type": "object",
             "properties": {
                 "stop_number": {
                     "type": "string",
@@ -30,27 +211,50 @@ def get_transit_times_function():
                 },
                 "agency": {
                     "type": "string",
-                    "description": "Transit agency operating the line (optional)",
-                    "optional": True
+                    "description": "Transit agency operating the line (optional)"
                 }
             },
-            "required": ["stop_number", "line_number"]  # Mandatory fields
-        }
-    }
-
-
-def validate_transit_times(input_data: Dict[str, Any]) -> bool:
-    """
-    Validates the transit request input against a predefined JSON schema.
+            "required": ["stop_number", "line_number"]
+        },
+        handler=_handle_vehicle_location
+    )
 
-    Args:
-    - input_data: Dictionary of transit request parameters
+    VEHICLES_NEARBY_TOOL = register_tool(
+        name="get_vehicles_nearby",
+        description="Buses currently near a stop or a location, nearest first.",
+        parameters={
+            "type": "object",
+            "properties": {
+                "stop_number": {
+                    "type": "string",
+                    "description": "Unique identifier for the bus stop (or give latitude and longitude)"
+                },
+                "latitude": {
+                    "type": "number",
+                    "minimum": -90,
+                    "maximum": 90
+                },
+                "longitude": {
+                    "type": "number",
+                    "minimum": -180,
+                    "maximum": 180
+                },
+                "radius_meters": {
+                    "type": "integer",
+                    "minimum": 50,
+                    "maximum": 5000,
+                    "description": "Search radius in meters (default 500)"
+                }
+            }
+        },
+        handler=_handle_vehicles_nearby
+    )
 
-    Returns:
-    - Boolean indicating whether the input is valid
-    """
-    # Use the same schema structure for validation
-    TRANSIT_REQUEST_SCHEMA = {
+SUBSCRIBE_ARRIVAL_TOOL = register_tool(
+    name="subscribe_arrival_alert",
+    description="Notify the user when a line is a given number of minutes away from a stop "
+                "(e.g. 'tell me when bus 5 is 3 minutes from stop 1234').",
+    parameters={
         "type": "object",
         "properties": {
             "stop_number": {
@@ -61,22 +265,69 @@ def validate_transit_times(input_data: Dict[str, Any]) -> bool:
                 "type": "string",
                 "description": "Bus line number"
             },
+            "minutes": {
+                "type": "integer",
+                "minimum": 1,
+                "maximum": 60,
+                "description": "Notify when the bus is this many minutes away or less (default 5)"
+            },
             "agency": {
                 "type": "string",
-                "description": "Transit agency operating the line (optional)",
-                "optional": True
+                "description": "Transit agency operating the line (optional)"
             }
         },
         "required": ["stop_number", "line_number"]
-    }
+    },
+    handler=_handle_subscribe_arrival
+)
 
-    try:
-        # Validate input against the schema
-        jsonschema.validate(instance=input_data, schema=TRANSIT_REQUEST_SCHEMA)
-        return True
-    except jsonschema.exceptions.ValidationError as e:
-        print(f"Validation Error: {e}")
+CANCEL_ARRIVAL_ALERTS_TOOL = register_tool(
+    name="cancel_arrival_alerts",
+    description="Cancel the user's arrival alerts, all of them or those of a stop and/or line.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "stop_number": {
+                "type": "string",
+                "description": "Only cancel the alerts of this stop (optional)"
+            },
+            "line_number": {
+                "type": "string",
+                "description": "Only cancel the alerts of this line (optional)"
+            }
+        }
+    },
+    handler=_handle_cancel_arrival_alerts
+)
+
+
+def get_transit_times_function():
+    """
+    Creates a function definition for OpenAI's function calling mechanism.
+
+    Returns:
+    - A dictionary describing the function parameters
+    - Used to tell the AI what information it can request
+    - Matches the structure expected by OpenAI's API
+    """
+    return TRANSIT_TIMES_TOOL.openai_schema
+
+
+def validate_transit_times(input_data: Dict[str, Any]) -> bool:
+    """
+    Validates the transit request input against the precompiled JSON schema of the tool.
+
+    Args:
+    - input_data: Dictionary of transit request parameters
+
+    Returns:
+    - Boolean indicating whether the input is valid
+    """
+    error = jsonschema.exceptions.best_match(TRANSIT_TIMES_TOOL.validator.iter_errors(input_data))
+    if error is not None:
+        logger.warning("Validation Error: %s", error.message)
         return False
+    return True
 
 
 def get_lines_at_stop_function():
@@ -88,20 +339,7 @@ def get_lines_at_stop_function():
     - Used to tell the AI what information it can request
     - Matches the structure expected by OpenAI's API
     """
-    return {
-        "name": "get_lines_at_stop",  # Name of the function
-        "description": "Only use this when specifically asked to list all lines at a stop.",
-        "parameters": {
-            "type": "object",  # Specifies the parameters are an object
-            "properties": {
-                "stop_number": {
-                    "type": "string",
-                    "description": "Unique identifier for the bus stop."
-                }
-            },
-            "required": ["stop_number"]  # Mandatory fields
-        }
-    }
+    return LINES_AT_STOP_TOOL.openai_schema
 
 
 def validate_lines_at_stop(inputs):
@@ -0,0 +1,144 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+DEFAULT_TTL_SECONDS = 15
+DEFAULT_MAX_ENTRIES = 5000
+DEFAULT_STALE_IF_ERROR_SECONDS = 300
+
+
+class CachedTimes:
+    """
+    A SIRI stop-monitoring response and when it was fetched.
+    """
+    __slots__ = ("response", "fetched_at", "expires_at", "derived")
+
+    def __init__(self, response: dict, fetched_at: float, expires_at: float):
+        self.response = response
+        # Wall-clock time of the fetch (for Last-Modified and the ETAs), and monotonic expiry
+        self.fetched_at = fetched_at
+        self.expires_at = expires_at
+        # Values computed from the response (e.g. a rendered board), dropped with it
+        self.derived = {}
+
+
+class StopTimesCache:
+    """
+    Short-lived cache of the SIRI responses per stop, shared by the chat, the arrival alerts
+    and the REST endpoints.
+
+    Arrival predictions are refreshed upstream every few seconds, so a response is reused for
+    ttl_seconds. Concurrent misses on the same stop wait for a single upstream request. When
+    the refresh fails (upstream down, circuit open), the expired response is served for up to
+    stale_if_error_seconds more: its fetched_at tells how old it is. The cached responses are
+    shared: callers must not modify them.
+    """
+
+    def __init__(self, fetch, ttl_seconds: float = DEFAULT_TTL_SECONDS, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 stale_if_error_seconds: float = DEFAULT_STALE_IF_ERROR_SECONDS,
+                 clock=time.monotonic, wall_clock=time.time):
+        # async fetch(stop_code, time_interval) -> SIRI response
+        self._fetch = fetch
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.stale_if_error_seconds = stale_if_error_seconds
+        self._clock = clock
+        self._wall_clock = wall_clock
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "stale_served": 0}
+
+    @classmethod
+    def from_env(cls, fetch):
+        """
+        Build a cache configured by SIRI_CACHE_TTL_SECONDS, SIRI_CACHE_MAX_ENTRIES and
+        SIRI_CACHE_STALE_IF_ERROR_SECONDS.
+        """
+        return cls(
+            fetch,
+            ttl_seconds=float(os.getenv("SIRI_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS)),
+            max_entries=int(os.getenv("SIRI_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+            stale_if_error_seconds=float(os.getenv("SIRI_CACHE_STALE_IF_ERROR_SECONDS",
+                                                   DEFAULT_STALE_IF_ERROR_SECONDS)),
+        )
+
+    def __len__(self):
+        return len(self._entries)
+
+    def remaining(self, entry: CachedTimes) -> float:
+        """
+        Seconds before the entry is refreshed.
+        """
+        return max(0.0, entry.expires_at - self._clock())
+
+    def peek(self, stop_code: str, time_interval: str = "PT1H") -> CachedTimes:
+        """
+        The cached entry of the stop, fresh or not, without fetching (None if never fetched or evicted).
+        """
+        return self._entries.get((stop_code, time_interval))
+
+    def outcome(self, stop_code: str, time_interval: str = "PT1H") -> str:
+        """
+        How get() would be answered right now: "hit", "coalesced" (waits for a fetch in flight)
+        or "miss".
+        """
+        key = (stop_code, time_interval)
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at > self._clock():
+            return "hit"
+        return "coalesced" if key in self._in_flight else "miss"
+
+    async def get(self, stop_code: str, time_interval: str = "PT1H") -> CachedTimes:
+        key = (stop_code, time_interval)
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at > self._clock():
+            self._entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.counters["coalesced"] += 1
+            try:
+                return await asyncio.shield(in_flight)
+            except asyncio.CancelledError:
+                if not in_flight.cancelled() or asyncio.current_task().cancelling():
+                    raise
+                # The leading request was cancelled, not this one: fetch again (one waiter leads)
+                return await self.get(stop_code, time_interval)
+
+        self.counters["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            response = await self._fetch(stop_code, time_interval)
+            entry = CachedTimes(response, self._wall_clock(), self._clock() + self.ttl_seconds)
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            future.set_result(entry)
+            return entry
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            if entry is not None and self._clock() < entry.expires_at + self.stale_if_error_seconds:
+                self.counters["stale_served"] += 1
+                future.set_result(entry)
+                return entry
+            future.set_exception(e)
+            # The waiters get the error; nobody may be waiting, so don't warn about it
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+
+    def metrics(self) -> dict:
+        return {"entries": len(self._entries), "in_flight": len(self._in_flight), **self.counters}
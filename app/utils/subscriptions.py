@@ -0,0 +1,295 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import time
+
+from dotenv import load_dotenv
+
+from app.utils.messaging import whatsapp_sender
+from app.utils.metrics import timed
+from app.utils.utils import etas_by_line, get_times
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 30
+DEFAULT_MAX_POLL_INTERVAL = 300
+DEFAULT_MAX_CONCURRENT_POLLS = 20
+DEFAULT_MAX_PER_USER = 5
+DEFAULT_MAX_SUBSCRIPTIONS = 50000
+DEFAULT_MAX_AGE_SECONDS = 7200
+
+# (user_id, recipient_id) of the chat turn being processed, so the subscription tools know
+# where to push the notifications; None outside WhatsApp (e.g. in the terminal app)
+current_chat = contextvars.ContextVar("current_chat", default=None)
+
+ARRIVAL_NOTIFICATIONS = {
+    "en": "Line {line} will reach stop {stop} in {eta} minutes.",
+    "he": "קו {line} יגיע לתחנה {stop} בעוד {eta} דקות.",
+    "fr": "La ligne {line} arrivera à l'arrêt {stop} dans {eta} minutes.",
+    "es": "La línea {line} llegará a la parada {stop} en {eta} minutos.",
+    "it": "La linea {line} arriverà alla fermata {stop} tra {eta} minuti.",
+    "ar": "سيصل الخط {line} إلى المحطة {stop} خلال {eta} دقيقة.",
+    "ru": "Маршрут {line} прибудет на остановку {stop} через {eta} минут."
+}
+
+
+class Subscription:
+    """
+    "Tell me when line L is at most N minutes away from stop S", for one chat.
+    """
+    __slots__ = ("id", "user_id", "recipient_id", "stop_number", "line_number", "operator_id",
+                 "threshold_minutes", "language", "expires_at")
+
+    def __init__(self, id: int, user_id: str, recipient_id: str, stop_number: str, line_number: str,
+                 operator_id: str, threshold_minutes: int, language: str, expires_at: float):
+        self.id = id
+        self.user_id = user_id
+        self.recipient_id = recipient_id
+        self.stop_number = stop_number
+        self.line_number = line_number
+        self.operator_id = operator_id
+        self.threshold_minutes = threshold_minutes
+        self.language = language
+        self.expires_at = expires_at
+
+    def as_dict(self) -> dict:
+        return {"stop_number": self.stop_number, "line_number": self.line_number, "agency": self.operator_id,
+                "threshold_minutes": self.threshold_minutes}
+
+
+class SubscriptionScheduler:
+    """
+    Arrival subscriptions, polled per stop rather than per subscription.
+
+    The subscriptions are grouped by stop, and a heap holds the next poll time of every stop
+    with at least one subscription. One get_times call per stop and cycle serves all its
+    subscriptions, so the polling cost grows with the number of distinct stops (and at most
+    max_concurrent_polls run at once), not with the number of subscriptions. A stop whose
+    nearest relevant bus is still far away is polled less often (up to max_poll_interval).
+
+    A subscription fires once: the chat gets a message when its line is threshold minutes
+    away or closer, and the subscription is removed. Unfired ones expire after max_age_seconds.
+    Subscriptions live in the memory of the worker that took them.
+    """
+
+    def __init__(self, poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 max_poll_interval: float = DEFAULT_MAX_POLL_INTERVAL,
+                 max_concurrent_polls: int = DEFAULT_MAX_CONCURRENT_POLLS, max_per_user: int = DEFAULT_MAX_PER_USER,
+                 max_subscriptions: int = DEFAULT_MAX_SUBSCRIPTIONS, max_age_seconds: float = DEFAULT_MAX_AGE_SECONDS,
+                 fetch=get_times, notify=None, clock=time.monotonic):
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.max_concurrent_polls = max_concurrent_polls
+        self.max_per_user = max_per_user
+        self.max_subscriptions = max_subscriptions
+        self.max_age_seconds = max_age_seconds
+        self._fetch = fetch
+        self._notify = notify or whatsapp_sender.send
+        self._clock = clock
+        self._ids = itertools.count(1)
+        # stop_number -> {subscription id -> Subscription}
+        self._by_stop = {}
+        # user_id -> {subscription id -> Subscription}
+        self._by_user = {}
+        self._count = 0
+        # (next poll time, stop_number) entries; an entry is stale when _next_poll disagrees
+        self._heap = []
+        self._next_poll = {}
+        # Stops being polled: they are rescheduled when their poll ends
+        self._polling = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._polls = set()
+        self.counters = {"polls": 0, "poll_errors": 0, "notifications": 0, "expired": 0}
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a scheduler configured by the SUBSCRIPTION_* environment variables.
+        """
+        return cls(
+            poll_interval=float(os.getenv("SUBSCRIPTION_POLL_INTERVAL", DEFAULT_POLL_INTERVAL)),
+            max_poll_interval=float(os.getenv("SUBSCRIPTION_MAX_POLL_INTERVAL", DEFAULT_MAX_POLL_INTERVAL)),
+            max_concurrent_polls=int(os.getenv("SUBSCRIPTION_MAX_CONCURRENT_POLLS", DEFAULT_MAX_CONCURRENT_POLLS)),
+            max_per_user=int(os.getenv("SUBSCRIPTION_MAX_PER_USER", DEFAULT_MAX_PER_USER)),
+            max_subscriptions=int(os.getenv("SUBSCRIPTION_MAX", DEFAULT_MAX_SUBSCRIPTIONS)),
+            max_age_seconds=float(os.getenv("SUBSCRIPTION_MAX_AGE_SECONDS", DEFAULT_MAX_AGE_SECONDS)),
+        )
+
+    def __len__(self):
+        return self._count
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        for poll in list(self._polls):
+            poll.cancel()
+        await asyncio.gather(self._task, *self._polls, return_exceptions=True)
+        self._task = None
+
+    def subscribe(self, user_id: str, recipient_id: str, stop_number: str, line_number: str,
+                  threshold_minutes: int, operator_id: str = None, language: str = "en") -> Subscription:
+        """
+        Add a subscription (replacing the chat's one for the same stop and line).
+
+        Raises:
+            ValueError: If the user or the process has too many subscriptions.
+        """
+        stop_number, line_number = str(stop_number).strip(), str(line_number).strip()
+        for existing in list(self._by_user.get(user_id, {}).values()):
+            if existing.stop_number == stop_number and existing.line_number == line_number:
+                self._remove(existing)
+        if len(self._by_user.get(user_id, {})) >= self.max_per_user:
+            raise ValueError(f"At most {self.max_per_user} arrival alerts per user")
+        if len(self) >= self.max_subscriptions:
+            raise ValueError("Too many arrival alerts right now, please try again later")
+
+        subscription = Subscription(next(self._ids), user_id, recipient_id, stop_number, line_number, operator_id,
+                                    int(threshold_minutes), language, self._clock() + self.max_age_seconds)
+        self._by_stop.setdefault(stop_number, {})[subscription.id] = subscription
+        self._by_user.setdefault(user_id, {})[subscription.id] = subscription
+        self._count += 1
+        # A new stop is polled right away; a stop already polled keeps its schedule
+        # unless the new subscription needs an earlier look
+        self._schedule(stop_number, self._clock(), earlier_only=True)
+        return subscription
+
+    def unsubscribe(self, user_id: str, stop_number: str = None, line_number: str = None) -> int:
+        """
+        Remove the user's subscriptions (all of them, or those matching the stop and/or line).
+
+        Returns:
+            int: The number of subscriptions removed.
+        """
+        removed = 0
+        for subscription in list(self._by_user.get(user_id, {}).values()):
+            if stop_number is not None and subscription.stop_number != str(stop_number).strip():
+                continue
+            if line_number is not None and subscription.line_number != str(line_number).strip():
+                continue
+            self._remove(subscription)
+            removed += 1
+        return removed
+
+    def subscriptions_of(self, user_id: str) -> list:
+        return list(self._by_user.get(user_id, {}).values())
+
+    def _remove(self, subscription: Subscription):
+        if self._by_user.get(subscription.user_id, {}).pop(subscription.id, None) is None:
+            return
+        self._count -= 1
+        stop_subscriptions = self._by_stop.get(subscription.stop_number, {})
+        stop_subscriptions.pop(subscription.id, None)
+        if not stop_subscriptions:
+            self._by_stop.pop(subscription.stop_number, None)
+            self._next_poll.pop(subscription.stop_number, None)
+        if not self._by_user.get(subscription.user_id):
+            self._by_user.pop(subscription.user_id, None)
+
+    def _schedule(self, stop_number: str, at: float, earlier_only: bool = False):
+        current = self._next_poll.get(stop_number)
+        if earlier_only and (stop_number in self._polling or (current is not None and current <= at)):
+            return
+        self._next_poll[stop_number] = at
+        heapq.heappush(self._heap, (at, stop_number))
+        self._wakeup.set()
+
+    async def _run(self):
+        slots = asyncio.Semaphore(self.max_concurrent_polls)
+        while True:
+            now = self._clock()
+            while self._heap and self._heap[0][0] <= now:
+                at, stop_number = heapq.heappop(self._heap)
+                if self._next_poll.get(stop_number) != at:
+                    continue  # stale entry: rescheduled or no subscriptions left
+                # Not due again until this poll reschedules it
+                del self._next_poll[stop_number]
+                self._polling.add(stop_number)
+                await slots.acquire()
+                poll = asyncio.create_task(self._poll_stop(stop_number))
+                self._polls.add(poll)
+                poll.add_done_callback(lambda task: (self._polls.discard(task), slots.release()))
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - self._clock() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll_stop(self, stop_number: str):
+        self.counters["polls"] += 1
+        try:
+            with timed("subscription_poll"):
+                grouped = etas_by_line(await self._fetch(stop_number), stop_number)
+        except Exception as e:
+            self.counters["poll_errors"] += 1
+            logger.warning("Arrival alerts poll of stop %s failed: %s", stop_number, e)
+            grouped = None
+
+        now = self._clock()
+        next_poll = self.max_poll_interval
+        # Sending a notification yields: the subscriptions added meanwhile are checked too, so
+        # the next poll is scheduled from every subscription the stop has when this one ends
+        checked = set()
+        while True:
+            unchecked = [subscription for subscription in self._by_stop.get(stop_number, {}).values()
+                         if subscription.id not in checked]
+            if not unchecked:
+                break
+            for subscription in unchecked:
+                checked.add(subscription.id)
+                if now >= subscription.expires_at:
+                    self.counters["expired"] += 1
+                    self._remove(subscription)
+                    continue
+                if grouped is None:
+                    next_poll = self.poll_interval
+                    continue
+                etas = [eta for (line, operator_id), line_etas in grouped.items() for eta in line_etas
+                        if line == subscription.line_number
+                        and (subscription.operator_id is None or operator_id == subscription.operator_id)]
+                nearest = min(etas, default=None)
+                if nearest is not None and nearest <= subscription.threshold_minutes:
+                    self._remove(subscription)
+                    await self._send(subscription, nearest)
+                elif nearest is not None:
+                    # The bus can't cover the remaining minutes faster than real time: look again
+                    # halfway to the moment it could cross the threshold
+                    next_poll = min(next_poll, (nearest - subscription.threshold_minutes) * 60 / 2)
+
+        self._polling.discard(stop_number)
+        if stop_number in self._by_stop:
+            self._schedule(stop_number, now + max(self.poll_interval, next_poll))
+
+    async def _send(self, subscription: Subscription, eta: int):
+        message = ARRIVAL_NOTIFICATIONS.get(subscription.language, ARRIVAL_NOTIFICATIONS["en"]).format(
+            line=subscription.line_number, stop=subscription.stop_number, eta=eta)
+        try:
+            await self._notify(subscription.recipient_id, message)
+            self.counters["notifications"] += 1
+        except Exception as e:
+            logger.error("Error sending the arrival alert to %s: %s", subscription.recipient_id, e)
+
+    def metrics(self) -> dict:
+        return {
+            "subscriptions": len(self),
+            "stops": len(self._by_stop),
+            "polls_in_flight": len(self._polls),
+            **self.counters,
+        }
+
+
+# Arrival subscriptions of the process, polled once it is started by the app's lifespan
+subscription_scheduler = SubscriptionScheduler.from_env()
@@ -0,0 +1,298 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import secrets
+import time
+from collections import deque
+
+from dotenv import load_dotenv
+
+from app.utils.blocking import run_blocking
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+TAPE_VERSION = 1
+DEFAULT_FLUSH_INTERVAL = 2
+DEFAULT_MAX_PENDING = 10000
+DEFAULT_MAX_BYTES = 500 * 1024 * 1024
+
+# WHAPI fields naming a user or a chat: replaced by a stable pseudonym
+ID_KEYS = {"from", "chat_id", "recipient_id", "to", "author"}
+# Fields dropped from the tape: names, contact cards, media links and previews
+DROP_KEYS = {"from_name", "chat_name", "contact", "contact_list", "link", "preview", "sha256", "url",
+             "vcard", "location", "live_location", "context"}
+# Free text: phone numbers and e-mail addresses are masked
+TEXT_KEYS = {"body", "caption"}
+
+# (9+ digits, dashes allowed: stop and line numbers are shorter)
+PHONE_PATTERN = re.compile(r"\+?\d(?:-?\d){8,}")
+EMAIL_PATTERN = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+
+
+class Pseudonymizer:
+    """
+    Stable pseudonyms of the user identifiers of a tape: the same user always gets the same
+    pseudonym (so the per-user history and rate limits replay alike), and without the salt
+    the pseudonym can't be traced back.
+    """
+
+    def __init__(self, salt: str):
+        self.salt = salt.encode("utf-8")
+
+    def _digest(self, value: str, size: int) -> bytes:
+        return hashlib.blake2b(value.encode("utf-8"), key=self.salt, digest_size=size).digest()
+
+    def user(self, value: str) -> str:
+        """
+        Pseudonym of a WhatsApp id, keeping its @domain and a phone-number shape.
+        """
+        local, at, domain = str(value).partition("@")
+        digits = str(int.from_bytes(self._digest(local, 8), "big"))[-9:].zfill(9)
+        return f"999{digits}{at}{domain}"
+
+    def token(self, kind: str, value: str) -> str:
+        return f"[{kind}-{self._digest(value, 4).hex()}]"
+
+    def text(self, value: str) -> str:
+        """
+        Mask the phone numbers and e-mail addresses of a free text (the masks are left as is
+        when the text is sanitized again).
+        """
+        value = EMAIL_PATTERN.sub(lambda match: self.token("email", match.group()), value)
+        return PHONE_PATTERN.sub(lambda match: self.token("phone", match.group()), value)
+
+    def payload(self, value, key: str = None):
+        """
+        Sanitized copy of a WHAPI webhook payload.
+        """
+        if isinstance(value, dict):
+            return {name: self.payload(item, name) for name, item in value.items() if name not in DROP_KEYS}
+        if isinstance(value, list):
+            return [self.payload(item, key) for item in value]
+        if isinstance(value, str):
+            if key in ID_KEYS:
+                return self.user(value)
+            if key == "id":
+                return self._digest(value, 12).hex()
+            if key in TEXT_KEYS:
+                return self.text(value)
+        return value
+
+
+def llm_key(messages: list, pseudonymizer: Pseudonymizer = None) -> str:
+    """
+    Key of a chat completion request on a tape: its last user message, as sanitized.
+    """
+    content = next((message.get("content") or "" for message in reversed(messages)
+                    if message.get("role") == "user"), "")
+    if pseudonymizer is not None:
+        content = pseudonymizer.text(content)
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=12).hexdigest()
+
+
+def shared_salt(path: str) -> str:
+    """
+    Salt of the pseudonyms stored next to the tape (created by the first worker to need it),
+    so every worker writing to the tape gives a user the same pseudonym.
+    """
+    salt_path = f"{path}.salt"
+    if not os.path.exists(salt_path):
+        # Written aside and linked into place: a worker never reads a half-written salt
+        building = f"{salt_path}.tmp-{os.getpid()}"
+        with open(os.open(building, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as salt_file:
+            salt_file.write(secrets.token_hex(16))
+        try:
+            os.link(building, salt_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(building)
+    with open(salt_path, encoding="ascii") as salt_file:
+        return salt_file.read().strip()
+
+
+class TrafficTape:
+    """
+    Optional recorder of the production traffic, for offline replays.
+
+    The tape is a JSON lines file: a "start" entry, then the sanitized WHAPI webhooks (with
+    their offset from the start and how long the webhook took) and the upstream responses the
+    app got meanwhile (SIRI by stop, the alerts feed, the chat completions by sanitized user
+    message), each with its latency. record_*() only queue the entry; a background task
+    appends them to the file every flush_interval seconds in the shared thread pool. The
+    recording stops once the tape reaches max_bytes.
+
+    Several workers may append to the same tape: each writes its own "start" entry and tags
+    its entries with its pid, and read_tape() puts their offsets on a common timeline.
+    """
+
+    def __init__(self, path: str, salt: str = None, flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                 max_pending: int = DEFAULT_MAX_PENDING, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = path
+        self.pseudonymizer = Pseudonymizer(salt or secrets.token_hex(16))
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self._pending = deque(maxlen=max_pending)
+        self._started = None
+        self._pid = os.getpid()
+        self._task = None
+        self._stopping = None
+        self.counters = {"webhooks": 0, "upstream_responses": 0, "dropped": 0, "bytes_written": 0,
+                         "write_errors": 0}
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a recorder writing to TRAFFIC_TAPE_PATH, or None when it isn't set.
+        """
+        path = os.getenv("TRAFFIC_TAPE_PATH")
+        if not path:
+            return None
+        return cls(
+            path,
+            salt=os.getenv("TRAFFIC_TAPE_SALT") or shared_salt(path),
+            flush_interval=float(os.getenv("TRAFFIC_TAPE_FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL)),
+            max_pending=int(os.getenv("TRAFFIC_TAPE_MAX_PENDING", DEFAULT_MAX_PENDING)),
+            max_bytes=int(float(os.getenv("TRAFFIC_TAPE_MAX_MB", DEFAULT_MAX_BYTES / 1024 / 1024)) * 1024 * 1024),
+        )
+
+    @property
+    def recording(self) -> bool:
+        return self._task is not None and self.counters["bytes_written"] < self.max_bytes
+
+    def record_webhook(self, payload: dict, started: float, duration: float, status: str):
+        """
+        Queue a webhook delivery, sanitized (started is a time.perf_counter() value).
+        """
+        if self.recording:
+            self._queue({"type": "webhook", "pid": self._pid, "t": started - self._started, "duration": duration,
+                         "status": status, "payload": self.pseudonymizer.payload(payload)})
+            self.counters["webhooks"] += 1
+
+    def record_upstream(self, service: str, key: str, body, duration: float, status: int = 200):
+        """
+        Queue an upstream response: a JSON body, or bytes (stored in base64).
+        """
+        if self.recording:
+            entry = {"type": "upstream", "service": service, "key": key, "pid": self._pid,
+                     "t": time.perf_counter() - self._started, "at": time.time(), "duration": duration,
+                     "status": status}
+            if isinstance(body, bytes):
+                entry["body_b64"] = base64.b64encode(body).decode("ascii")
+            else:
+                entry["body"] = body
+            self._queue(entry)
+            self.counters["upstream_responses"] += 1
+
+    def record_completion(self, messages: list, completion: dict, duration: float):
+        """
+        Queue a chat completion, keyed by the sanitized user message it answers.
+        """
+        if self.recording:
+            for choice in completion.get("choices") or []:
+                message = choice.get("message") or {}
+                if message.get("content"):
+                    message["content"] = self.pseudonymizer.text(message["content"])
+            self.record_upstream("openai", llm_key(messages, self.pseudonymizer), completion, duration)
+
+    def _queue(self, entry: dict):
+        if len(self._pending) == self._pending.maxlen:
+            self.counters["dropped"] += 1
+        self._pending.append(entry)
+
+    def start(self):
+        if self._task is None:
+            self._started = time.perf_counter()
+            self._pid = os.getpid()
+            self._pending.append({"type": "start", "version": TAPE_VERSION, "pid": self._pid, "at": time.time()})
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """
+        Write what is queued and stop recording.
+        """
+        if self._task is None:
+            return
+        self._stopping.set()
+        await self._task
+        self._task = None
+
+    async def _flush_loop(self):
+        stopping = False
+        while not stopping:
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+                stopping = True
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch = list(self._pending)
+        self._pending.clear()
+        try:
+            self.counters["bytes_written"] += await run_blocking(self._write, batch)
+        except Exception as e:
+            self.counters["write_errors"] += 1
+            logger.error("Error writing %d entries to the traffic tape: %s", len(batch), e)
+
+    def _write(self, batch: list) -> int:
+        # Entries are serialized here, off the event loop
+        data = "".join(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+                       for entry in batch).encode("utf-8")
+        with open(self.path, "ab") as tape:
+            tape.write(data)
+        return len(data)
+
+    def metrics(self) -> dict:
+        return {"pending": len(self._pending), **self.counters}
+
+
+def read_tape(path: str) -> list:
+    """
+    Entries of a tape, in recording order (a line cut short by a crash is skipped).
+
+    The offsets ("t") of the entries written by several workers, each from its own start, are
+    moved to a common timeline starting at the first "start" entry.
+    """
+    entries = []
+    with open(path, encoding="utf-8") as tape:
+        for line in tape:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.warning("Skipping a truncated tape entry")
+    starts = [entry["at"] for entry in entries if entry.get("type") == "start" and "pid" in entry]
+    if starts:
+        origin = min(starts)
+        # pid -> wall-clock time of the start of its current recording
+        started_at = {}
+        for entry in entries:
+            if entry.get("type") == "start" and "pid" in entry:
+                started_at[entry["pid"]] = entry["at"]
+            elif entry.get("pid") in started_at and "t" in entry:
+                entry["t"] += started_at[entry["pid"]] - origin
+    return entries
+
+
+def upstream_body(entry: dict):
+    """
+    Body of an upstream entry: the JSON document, or the bytes.
+    """
+    if "body_b64" in entry:
+        return base64.b64decode(entry["body_b64"])
+    return entry.get("body")
+
+
+# Recorder of the webhook traffic (None unless TRAFFIC_TAPE_PATH is set)
+traffic_tape = TrafficTape.from_env()
@@ -1,25 +1,32 @@
 import asyncio
 import csv
 import json
+import logging
 import os
+import tempfile
+import time
 from datetime import datetime
 
-import aiohttp
-import fasttext
 import httpx
-import pandas as pd
 from dotenv import load_dotenv
 from fastapi import HTTPException
-from google.protobuf.message import DecodeError
-from openai import OpenAI
 
-from app.utils import gtfs_realtime_pb2
+from app.utils.arrival_archive import arrival_archive
+from app.utils.blocking import run_blocking, run_cpu_bound
+from app.utils.gtfs_store import GtfsStore, ensure_gtfs_store
+from app.utils.logs import Truncated
+from app.utils.metrics import instrumented, timed
+from app.utils.resilience import ResilientUpstream
+from app.utils.stop_cache import StopTimesCache
+from app.utils.traffic_tape import traffic_tape
+
+# pandas, numpy, fasttext, openai and protobuf are imported on first use: they make up most of the
+# start-up time and not every entry point needs them
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+logger = logging.getLogger(__name__)
 
 # Get the directory of the current script
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -27,9 +34,154 @@ script_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(script_dir)
 # Construct path to agency_simple.txt in the data directory
 agency_file_path = os.path.join(parent_dir, 'data', 'agency_simple.txt')
+# Directory of the GTFS static files (stops.txt, stop_times.txt, trips.txt, routes.txt)
+gtfs_data_dir = os.getenv("GTFS_DATA_DIR", os.path.join(parent_dir, 'data'))
+# Directory of the memory-mapped indexes built from them, shared by the workers of the node
+gtfs_store_dir = os.getenv("GTFS_STORE_DIR", os.path.join(tempfile.gettempdir(), "helpy-gtfs-store"))
 # Construct path to lid.176.bin in the models directory
 language_file_path = os.path.join(parent_dir, 'models', 'lid.176.bin')
 
+# Resources shared by every request, created on first use or by warm_up()
+_openai_client = None
+_http_client = None
+_language_model = None
+_agency_tables = {}
+_gtfs_index = None
+_gtfs_index_lock = None
+# Last alerts decoded, served while the alerts upstream fails: (alerts, time.monotonic())
+_last_alerts = None
+
+# Timeouts, circuit breakers and hedged requests of the MOT endpoints
+siri_upstream = ResilientUpstream.from_env("siri", default_timeout=5)
+alerts_upstream = ResilientUpstream.from_env("alerts", default_timeout=10)
+ALERTS_STALE_IF_ERROR_SECONDS = float(os.getenv("ALERTS_STALE_IF_ERROR_SECONDS", 900))
+
+
+def get_openai_client():
+    """
+    Return the OpenAI client of the process, created on first use.
+    """
+    global _openai_client
+    if _openai_client is None:
+        from openai import OpenAI
+        _openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _openai_client
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Return the pooled HTTP client used for the SIRI and alerts requests, created on first use.
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=100, max_keepalive_connections=20))
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def get_language_model():
+    """
+    Return the fasttext language identification model, loaded once.
+    """
+    global _language_model
+    if _language_model is None:
+        import fasttext
+        _language_model = fasttext.load_model(language_file_path)
+    return _language_model
+
+
+def load_agency_table(file_name: str = agency_file_path) -> dict:
+    """
+    Read the agency file once: agency_id -> {'hebrew_name': ..., 'english_name': ...}.
+    """
+    table = _agency_tables.get(file_name)
+    if table is None:
+        table = {}
+        with open(file_name, 'r', encoding='utf-8-sig') as file:
+            for row in csv.DictReader(file):
+                table[row['agency_id']] = {
+                    'hebrew_name': row['agency_name'],
+                    'english_name': row['agency_english_name']
+                }
+        _agency_tables[file_name] = table
+    return table
+
+
+def get_gtfs_index() -> GtfsStore:
+    """
+    Return the GTFS store (stop -> lines, scheduled departures, stop locations and route names),
+    built on first use into GTFS_STORE_DIR by the first process needing it and memory-mapped
+    by every worker; it is rebuilt when the GTFS files change.
+    """
+    global _gtfs_index
+    if _gtfs_index is None:
+        _gtfs_index = GtfsStore(ensure_gtfs_store(gtfs_data_dir, gtfs_store_dir))
+    return _gtfs_index
+
+
+async def load_gtfs_index() -> GtfsStore:
+    """
+    Async get_gtfs_index(): a missing store is built in the shared process pool while the event
+    loop keeps serving; concurrent callers wait for the same build, and the workers of the node
+    for the first one's (see ensure_gtfs_store).
+    """
+    global _gtfs_index, _gtfs_index_lock
+    if _gtfs_index is None:
+        if _gtfs_index_lock is None:
+            _gtfs_index_lock = asyncio.Lock()
+        async with _gtfs_index_lock:
+            if _gtfs_index is None:
+                path = await run_cpu_bound(ensure_gtfs_store, gtfs_data_dir, gtfs_store_dir)
+                _gtfs_index = await run_blocking(GtfsStore, path)
+    return _gtfs_index
+
+
+def gtfs_store_metrics() -> dict:
+    """
+    Size and age of the GTFS store mapped by the process (empty until it is loaded).
+    """
+    return _gtfs_index.metrics() if _gtfs_index is not None else {}
+
+
+async def warm_up() -> dict:
+    """
+    Create the expensive shared resources ahead of the first request.
+
+    Blocking loads run in the shared executors so the event loop keeps serving meanwhile. A
+    resource whose files are missing is skipped (it will fail on use, as before).
+
+    Returns:
+        dict: Seconds spent per resource, or the error that prevented loading it.
+    """
+    report = {}
+    steps = [
+        ("http_client", get_http_client),
+        ("openai_client", get_openai_client),
+        ("agency_table", load_agency_table),
+        ("language_model", get_language_model),
+        ("gtfs_index", load_gtfs_index),
+    ]
+    for name, step in steps:
+        started = time.perf_counter()
+        try:
+            if name == "http_client":
+                step()
+            elif asyncio.iscoroutinefunction(step):
+                await step()
+            else:
+                await run_blocking(step)
+            report[name] = round(time.perf_counter() - started, 3)
+        except Exception as e:
+            logger.warning("Warm-up of %s skipped: %s", name, e)
+            report[name] = f"skipped: {e}"
+    return report
+
 
 async def get_transit_times(stop_number: str, line_number: str, operator_id: str = None,
                             detected_language: str = None):
@@ -109,7 +261,7 @@ async def get_transit_times(stop_number: str, line_number: str, operator_id: str
         }
 
     except Exception as e:
-        print(f"Error processing transit request: {e}")
+        logger.error("Error processing transit request: %s", e)
         return {
             "error": str(e),
             "success": False
@@ -117,6 +269,25 @@ async def get_transit_times(stop_number: str, line_number: str, operator_id: str
 
 
 async def get_times(current_stop_code: str, time_interval: str = "PT1H"):
+    """
+    SIRI stop-monitoring response of the stop, from the shared cache (see stop_times_cache).
+    The response is shared: don't modify it.
+    """
+    return (await get_cached_times(current_stop_code, time_interval)).response
+
+
+async def get_cached_times(current_stop_code: str, time_interval: str = "PT1H"):
+    """
+    Same as get_times, with the fetch time and expiry of the response (a CachedTimes).
+
+    Recorded as the get_times stage, labelled with the cache outcome (hit, coalesced or miss).
+    """
+    with timed("get_times", cache=stop_times_cache.outcome(current_stop_code, time_interval)):
+        return await stop_times_cache.get(current_stop_code, time_interval)
+
+
+@instrumented("siri_fetch")
+async def fetch_times(current_stop_code: str, time_interval: str = "PT1H"):
     """
         Query the GTFS-RT API with the provided parameters.
         """
@@ -132,14 +303,107 @@ async def get_times(current_stop_code: str, time_interval: str = "PT1H"):
         "PreviewInterval": time_interval,
     }
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(GTFS_RT_URL, params=params)
+    async def request():
+        response = await get_http_client().get(GTFS_RT_URL, params=params, timeout=siri_upstream.timeout)
         response.raise_for_status()
+        return response
+
+    started = time.perf_counter()
+    response = await siri_upstream.call(request)
+
+    # Pretty-print the response JSON with indentation
+    # print(json.dumps(response.json(), indent=4))
 
-        # Pretty-print the response JSON with indentation
-        # print(json.dumps(response.json(), indent=4))
+    times_response = response.json()
+    if arrival_archive is not None:
+        arrival_archive.record(current_stop_code, times_response)
+    if traffic_tape is not None:
+        traffic_tape.record_upstream("siri", current_stop_code, times_response, time.perf_counter() - started)
+    return times_response
 
-        return response.json()
+
+def etas_by_line(times_response: dict, stop_number: str, now: datetime = None) -> dict:
+    """
+    Minutes until each upcoming arrival at the stop, grouped in one pass over the SIRI response.
+
+    Returns:
+        dict: (line_number, operator_id) -> sorted ETAs in minutes.
+    """
+    now = now or datetime.now()
+    grouped = {}
+    visits = times_response["Siri"]["ServiceDelivery"]["StopMonitoringDelivery"][0].get("MonitoredStopVisit") or []
+    for element in visits:
+        if element.get("MonitoringRef") != stop_number:
+            continue
+        vehicle_journey = element.get("MonitoredVehicleJourney", {})
+        arrival = vehicle_journey.get("MonitoredCall", {}).get("ExpectedArrivalTime")
+        if not arrival:
+            continue
+        delta = (datetime.fromisoformat(arrival[:-6]) - now).total_seconds()  # Remove timezone
+        if delta <= 0:
+            continue
+        key = (vehicle_journey.get("PublishedLineName"), vehicle_journey.get("OperatorRef"))
+        grouped.setdefault(key, []).append(int(delta // 60))
+    for etas in grouped.values():
+        etas.sort()
+    return grouped
+
+
+def build_arrival_board(times_response: dict, stop_number: str, now: datetime = None, max_etas: int = 3) -> list:
+    """
+    Rows of the arrival board of a SIRI response: one per line and operator, by next arrival.
+    """
+    agencies = load_agency_table()
+    lines = []
+    grouped = etas_by_line(times_response, stop_number, now=now)
+    for (line_number, operator_id), etas in sorted(grouped.items(), key=lambda item: item[1][0]):
+        names = agencies.get(operator_id, {})
+        lines.append({
+            "line_number": line_number,
+            "agency": operator_id,
+            "hebrew_name": names.get("hebrew_name", ""),
+            "english_name": names.get("english_name", ""),
+            "etas": sorted(set(etas))[:max_etas]
+        })
+    return lines
+
+
+def get_cached_board(cached, stop_number: str) -> list:
+    """
+    Arrival board of a cached SIRI response (a CachedTimes), with the ETAs counted from the
+    fetch time; built once per response and shared by its readers.
+    """
+    lines = cached.derived.get("board")
+    if lines is None:
+        lines = cached.derived["board"] = build_arrival_board(
+            cached.response, stop_number, now=datetime.fromtimestamp(cached.fetched_at))
+    return lines
+
+
+@instrumented("arrival_board")
+async def get_arrival_board(stop_number: str, max_etas: int = 3):
+    """
+    Next arrivals of every line at the stop, from a single get_times call.
+
+    The SIRI response is grouped by line and operator in one pass; operator names come from
+    the in-memory agency table.
+
+    Returns:
+        dict: {"success": True, "stop_number": ..., "lines": [{"line_number", "agency",
+        "hebrew_name", "english_name", "etas"}, ...]} with the lines sorted by their next
+        arrival, or {"success": False, "error": ...}.
+    """
+    try:
+        stop_number = str(stop_number).strip()
+        lines = build_arrival_board(await get_times(stop_number), stop_number, max_etas=max_etas)
+        return {"success": True, "stop_number": stop_number, "lines": lines}
+    except Exception as e:
+        logger.error("Error building the arrival board of stop %s: %s", stop_number, e)
+        return {"success": False, "error": str(e)}
+
+
+# SIRI responses per stop, reused for a few seconds by every caller of get_times
+stop_times_cache = StopTimesCache.from_env(fetch_times)
 
 
 def filter_json(resp_json: json, stop_code: str, agency: str, published_line: str):
@@ -165,7 +429,8 @@ def filter_json(resp_json: json, stop_code: str, agency: str, published_line: st
             }
             results.append(result)
 
-    print("RES: ", results)
+    logger.debug("filter_json: %d visits for stop %s line %s: %s", len(results), stop_code, published_line,
+                 Truncated(results))
     return results
 
 
@@ -196,16 +461,11 @@ def get_eta(res: list):
 def operatorId_to_name(file_name, operator_id):
     operator_dict = {}
     try:
-        with open(file_name, 'r', encoding='utf-8-sig') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                if row['agency_id'] == operator_id:
-                    operator_dict['hebrew_name'] = row['agency_name']
-                    operator_dict['english_name'] = row['agency_english_name']
+        operator_dict.update(load_agency_table(file_name).get(operator_id, {}))
     except FileNotFoundError:
-        print("Agency file not found.")
+        logger.error("Agency file not found.")
     except Exception as e:
-        print(f"Error reading agency file: {e}")
+        logger.error("Error reading agency file: %s", e)
     return operator_dict
 
 
@@ -226,20 +486,20 @@ async def get_user_input(prompt, timeout):
         return None
 
 
+@instrumented("detect_language")
 def detect_language(text_to_detect: str):
-    # Download a pre-trained language identification model
-    model_path = language_file_path
-    model = fasttext.load_model(model_path)
+    # Pre-trained language identification model, loaded once
+    model = get_language_model()
 
     try:
         detection = model.predict(text_to_detect)
         language = detection[0][0]  # The language code
         probability = detection[1][0]  # The probability score
-        print(f"Language: {language}, Probability: {probability}")
+        logger.debug("Language: %s, Probability: %s", language, probability)
         detected_language = language.split("__")[-1]
         return detected_language
     except Exception as e:
-        print(f"Language detection error: {e}")
+        logger.warning("Language detection error: %s", e)
         return "en"  # Default to English if detection fails
 
 
@@ -251,52 +511,20 @@ async def get_lines_at_stop(stop_number: str):
     """
     try:
 
-        # Load GTFS files
-        stops_path = os.path.join(parent_dir, 'data', 'stops.txt')
-        stop_times_path = os.path.join(parent_dir, 'data', 'stop_times.txt')
-        trips_path = os.path.join(parent_dir, 'data', 'trips.txt')
-        routes_path = os.path.join(parent_dir, 'data', 'routes.txt')
-
-        # Ensure files exist
-        for file_path in [stops_path, stop_times_path, trips_path, routes_path]:
-            if not os.path.exists(file_path):
-                raise FileNotFoundError(f"Missing required file: {file_path}")
-
-        # Load CSV files
-        stops = pd.read_csv(stops_path)
-        stop_times = pd.read_csv(stop_times_path)
-        trips = pd.read_csv(trips_path)
-        routes = pd.read_csv(routes_path)
-
-        # Clean up potential whitespace issues
-        stops["stop_code"] = stops["stop_code"].astype(str).str.strip()
+        # Lines per stop come from the GTFS index, built once (at warm-up or on first use)
+        index = await load_gtfs_index()
 
         # Step 1: Find the stop_id associated with the stop_number
-        stop_id_series = stops[stops["stop_code"] == stop_number]["stop_id"].unique()
-        if len(stop_id_series) == 0:
+        entry = index.get(str(stop_number).strip())
+        if entry is None:
             raise ValueError(f"No stop_id found for stop_number: {stop_number}")
-        stop_id = int(stop_id_series[0])
+        stop_id, route_short_name_list = entry
 
-        # Step 2: Find trip_ids associated with the stop_id
-        trip_ids = stop_times[stop_times["stop_id"] == stop_id]["trip_id"]
-        if trip_ids.empty:
-            raise ValueError(f"No trips found for stop_id: {stop_id}")
-
-        # Step 3: Map trip_ids to route_ids
-        route_ids = trips[trips["trip_id"].isin(trip_ids)]["route_id"].unique()
-        if len(route_ids) == 0:
-            raise ValueError(f"No routes found for trips at stop_id: {stop_id}")
-
-        # Step 4: Get route details
-        lines = routes[routes["route_id"].isin(route_ids)][
-            ["route_id", "route_short_name", "route_long_name"]].drop_duplicates(subset=["route_short_name"])
-        route_short_name_list = lines["route_short_name"].tolist()
-
-        # If no lines are found
+        # Step 2: Find the lines of the trips stopping there
         if not route_short_name_list:
-            raise ValueError(f"No lines found for stop_number: {stop_number}")
+            raise ValueError(f"No trips found for stop_id: {stop_id}")
 
-        print("RSSSSS", route_short_name_list)
+        logger.debug("Lines at stop %s: %s", stop_number, Truncated(route_short_name_list))
 
         # Return the successful response
         return {
@@ -313,73 +541,106 @@ async def get_lines_at_stop(stop_number: str):
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
 
 
+def stale_alerts(error: Exception):
+    """
+    The last alerts decoded, while they are recent enough to stand in for a failed fetch (else None).
+    """
+    if _last_alerts is not None:
+        alerts, decoded_at = _last_alerts
+        age = time.monotonic() - decoded_at
+        if age < ALERTS_STALE_IF_ERROR_SECONDS:
+            logger.warning("Alerts request failed (%s): serving the alerts of %.0fs ago", error, age)
+            return alerts
+    logger.error("Alerts request failed: %s", error)
+    return None
+
+
 # Processing the Special messages for developers in case of changes in routes
+@instrumented("alerts")
 async def fetch_and_decode_alerts():
     """
     Fetch and decode GTFS-Realtime Service Alerts from MOT API
+
+    While the upstream fails (or its circuit is open), the last alerts decoded are returned.
     """
+    global _last_alerts
     sm_url = os.getenv("SM_URL")
     params = {
         "Key": os.getenv("API_KEY"),
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(sm_url, params=params) as response:
-            if response.status == 200:
-                # Read the binary content
-                binary_data = await response.read()
-
-                try:
-                    # Create a FeedMessage object
-                    feed = gtfs_realtime_pb2.FeedMessage()
-                    # Parse the binary data
-                    feed.ParseFromString(binary_data)
-
-                    # Convert to dictionary for easier handling
-                    alerts = []
-                    for entity in feed.entity:
-                        if entity.HasField('alert'):
-                            alert_dict = {
-                                'id': entity.id,
-                                'alert': {
-                                    'active_period': [{
-                                        'start': period.start,
-                                        'end': period.end
-                                    } for period in entity.alert.active_period],
-                                    'informed_entity': [{
-                                        'agency_id': e.agency_id if e.HasField('agency_id') else None,
-                                        'route_id': e.route_id if e.HasField('route_id') else None,
-                                        'stop_id': e.stop_id if e.HasField('stop_id') else None,
-                                        'trip': {
-                                            'trip_id': e.trip.trip_id,
-                                            'route_id': e.trip.route_id,
-                                            'schedule_relationship': e.trip.schedule_relationship
-                                        } if e.HasField('trip') else None
-                                    } for e in entity.alert.informed_entity],
-                                    'cause': entity.alert.cause,
-                                    'effect': entity.alert.effect,
-                                    'header_text': {
-                                        lang: translation.text
-                                        for translation in entity.alert.header_text.translation
-                                        for lang in [translation.language]
-                                    },
-                                    'description_text': {
-                                        lang: translation.text
-                                        for translation in entity.alert.description_text.translation
-                                        for lang in [translation.language]
-                                    }
-                                }
-                            }
-                            alerts.append(alert_dict)
-                    # print("ALERT ", alerts)
-                    return alerts
+    from google.protobuf.message import DecodeError
 
-                except DecodeError as e:
-                    print(f"Failed to decode protobuf: {e}")
-                    return None
-            else:
-                print(f"Request failed with status {response.status}")
-                return None
+    from app.utils import gtfs_realtime_pb2
+
+    async def request():
+        response = await get_http_client().get(sm_url, params=params, timeout=alerts_upstream.timeout)
+        response.raise_for_status()
+        return response
+
+    started = time.perf_counter()
+    try:
+        response = await alerts_upstream.call(request)
+    except Exception as e:
+        return stale_alerts(e)
+    if response.status_code == 200:
+        # Read the binary content
+        binary_data = response.content
+        if traffic_tape is not None:
+            traffic_tape.record_upstream("alerts", "feed", binary_data, time.perf_counter() - started)
+
+        try:
+            # Create a FeedMessage object
+            feed = gtfs_realtime_pb2.FeedMessage()
+            # Parse the binary data
+            feed.ParseFromString(binary_data)
+
+            # Convert to dictionary for easier handling
+            alerts = []
+            for entity in feed.entity:
+                if entity.HasField('alert'):
+                    alert_dict = {
+                        'id': entity.id,
+                        'alert': {
+                            'active_period': [{
+                                'start': period.start,
+                                'end': period.end
+                            } for period in entity.alert.active_period],
+                            'informed_entity': [{
+                                'agency_id': e.agency_id if e.HasField('agency_id') else None,
+                                'route_id': e.route_id if e.HasField('route_id') else None,
+                                'stop_id': e.stop_id if e.HasField('stop_id') else None,
+                                'trip': {
+                                    'trip_id': e.trip.trip_id,
+                                    'route_id': e.trip.route_id,
+                                    'schedule_relationship': e.trip.schedule_relationship
+                                } if e.HasField('trip') else None
+                            } for e in entity.alert.informed_entity],
+                            'cause': entity.alert.cause,
+                            'effect': entity.alert.effect,
+                            'header_text': {
+                                lang: translation.text
+                                for translation in entity.alert.header_text.translation
+                                for lang in [translation.language]
+                            },
+                            'description_text': {
+                                lang: translation.text
+                                for translation in entity.alert.description_text.translation
+                                for lang in [translation.language]
+                            }
+                        }
+                    }
+                    alerts.append(alert_dict)
+            # print("ALERT ", alerts)
+            _last_alerts = (alerts, time.monotonic())
+            return alerts
+
+        except DecodeError as e:
+            logger.error("Failed to decode protobuf: %s", e)
+            return None
+    else:
+        logger.error("Request failed with status %s", response.status_code)
+        return None
 
 
 async def filter_alerts(resp_list: list, lineRef: str):
@@ -424,5 +685,5 @@ async def filter_alerts(resp_list: list, lineRef: str):
                     result[f"Description_text_{language}"] = alert["description_text"][language]
 
             results.append(result)
-    print("changes ", results)
+    logger.debug("filter_alerts: %d alerts for line %s: %s", len(results), lineRef, Truncated(results))
     return results
@@ -0,0 +1,362 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from array import array
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from app.utils.blocking import run_blocking
+from app.utils.resilience import ResilientUpstream
+from app.utils.utils import get_http_client, get_times, load_gtfs_index
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 10
+DEFAULT_MAX_AGE_SECONDS = 300
+DEFAULT_RADIUS_METERS = 500
+MAX_RADIUS_METERS = 5000
+# Side of a cell of the spatial grid, in degrees of latitude and longitude (about 1.1 km x 0.9 km
+# in Israel): a "near me" query reads the vehicles of a handful of cells
+CELL_DEGREES = 0.01
+METERS_PER_DEGREE = 111_320
+# Upcoming arrivals of the line looked up for a live position
+MAX_CANDIDATE_ARRIVALS = 5
+
+
+def distance_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """
+    Distance between two points in meters (equirectangular: exact enough within a city).
+    """
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6_371_000 * math.hypot(x, y)
+
+
+def grid_cell(lat: float, lon: float) -> tuple:
+    return int(math.floor(lat / CELL_DEGREES)), int(math.floor(lon / CELL_DEGREES))
+
+
+def decode_vehicle_positions(content: bytes) -> list:
+    """
+    (vehicle_id, trip_id, route_id, lat, lon, bearing, speed, timestamp) of every vehicle
+    position of a GTFS-RT feed. A vehicle without an id is keyed by its trip, then its entity.
+    """
+    from app.utils import gtfs_realtime_pb2
+
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(content)
+    header_timestamp = feed.header.timestamp
+    rows = []
+    for entity in feed.entity:
+        if not entity.HasField("vehicle") or not entity.vehicle.HasField("position"):
+            continue
+        vehicle = entity.vehicle
+        trip_id = vehicle.trip.trip_id
+        rows.append((
+            vehicle.vehicle.id or trip_id or entity.id,
+            trip_id,
+            vehicle.trip.route_id,
+            vehicle.position.latitude,
+            vehicle.position.longitude,
+            vehicle.position.bearing,
+            vehicle.position.speed,
+            vehicle.timestamp or header_timestamp,
+        ))
+    return rows
+
+
+class VehicleSnapshot:
+    """
+    Immutable set of the latest vehicle positions, laid out for lookups.
+
+    The coordinates, bearings, speeds and timestamps are packed in arrays, the ids in lists
+    at the same index; dictionaries map the vehicle and trip ids to their index, and the
+    spatial grid maps a cell to the indexes of the vehicles in it. A new snapshot replaces
+    the previous one after every poll, so readers never see a half-updated store.
+    """
+    __slots__ = ("vehicle_ids", "trip_ids", "route_ids", "lat", "lon", "bearing", "speed", "timestamp",
+                 "_by_vehicle", "_by_trip", "_grid", "built_at")
+
+    def __init__(self, rows: list, built_at: float = None):
+        self.vehicle_ids = [row[0] for row in rows]
+        self.trip_ids = [row[1] for row in rows]
+        self.route_ids = [row[2] for row in rows]
+        self.lat = array("d", (row[3] for row in rows))
+        self.lon = array("d", (row[4] for row in rows))
+        self.bearing = array("f", (row[5] for row in rows))
+        self.speed = array("f", (row[6] for row in rows))
+        self.timestamp = array("q", (int(row[7]) for row in rows))
+        self._by_vehicle = {vehicle_id: index for index, vehicle_id in enumerate(self.vehicle_ids)}
+        self._by_trip = {trip_id: index for index, trip_id in enumerate(self.trip_ids) if trip_id}
+        grid = {}
+        for index in range(len(rows)):
+            grid.setdefault(grid_cell(self.lat[index], self.lon[index]), array("I")).append(index)
+        self._grid = grid
+        self.built_at = time.time() if built_at is None else built_at
+
+    def __len__(self):
+        return len(self.vehicle_ids)
+
+    def find(self, vehicle_id: str = None, trip_id: str = None) -> int:
+        """
+        Index of a vehicle by its id, else by the trip it runs (None if neither is known).
+        """
+        index = self._by_vehicle.get(vehicle_id) if vehicle_id else None
+        if index is None and trip_id:
+            index = self._by_trip.get(trip_id)
+        return index
+
+    def nearby(self, lat: float, lon: float, radius_m: float, limit: int = 10) -> list:
+        """
+        (distance in meters, index) of the vehicles within radius_m of a point, nearest first.
+        """
+        cell_lat, cell_lon = grid_cell(lat, lon)
+        reach_lat = math.ceil(radius_m / (METERS_PER_DEGREE * CELL_DEGREES))
+        reach_lon = math.ceil(radius_m / (METERS_PER_DEGREE * CELL_DEGREES * max(math.cos(math.radians(lat)), 0.01)))
+        # Bounding box of the circle, checked before the distance
+        delta_lat = radius_m / METERS_PER_DEGREE
+        delta_lon = radius_m / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+        lats, lons = self.lat, self.lon
+        found = []
+        for row in range(cell_lat - reach_lat, cell_lat + reach_lat + 1):
+            for column in range(cell_lon - reach_lon, cell_lon + reach_lon + 1):
+                for index in self._grid.get((row, column), ()):
+                    if abs(lats[index] - lat) > delta_lat or abs(lons[index] - lon) > delta_lon:
+                        continue
+                    distance = distance_m(lat, lon, lats[index], lons[index])
+                    if distance <= radius_m:
+                        found.append((distance, index))
+        found.sort()
+        return found[:limit]
+
+    def describe(self, index: int, now: float = None) -> dict:
+        now = time.time() if now is None else now
+        return {
+            "vehicle_id": self.vehicle_ids[index],
+            "trip_id": self.trip_ids[index],
+            "route_id": self.route_ids[index],
+            "latitude": round(self.lat[index], 6),
+            "longitude": round(self.lon[index], 6),
+            "bearing": round(self.bearing[index]),
+            "speed_kmh": round(3.6 * self.speed[index]),
+            "age_seconds": max(0, int(now - self.timestamp[index])),
+        }
+
+
+class VehiclePositionsIngester:
+    """
+    Optional background poller of a GTFS-RT VehiclePositions feed.
+
+    Every interval seconds the feed is fetched through a ResilientUpstream, decoded in the
+    shared thread pool and merged into the latest position per vehicle (an older report never
+    replaces a newer one); positions older than max_age_seconds are dropped, and a new
+    VehicleSnapshot is published. The stop locations and route names come from the GTFS
+    store shared by the workers (load_gtfs_index).
+    """
+
+    def __init__(self, url: str, api_key: str = None, interval: float = DEFAULT_INTERVAL,
+                 max_age_seconds: float = DEFAULT_MAX_AGE_SECONDS):
+        self.url = url
+        self.api_key = api_key
+        self.interval = interval
+        self.max_age_seconds = max_age_seconds
+        self.upstream = ResilientUpstream.from_env("vehicle_positions", default_timeout=10)
+        self.snapshot = VehicleSnapshot([])
+        self._latest = {}
+        self._task = None
+        self._stopping = None
+        self.counters = {"polls": 0, "poll_errors": 0, "positions_received": 0, "positions_expired": 0}
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build the ingester of VEHICLE_POSITIONS_URL, or None when it isn't set.
+        """
+        url = os.getenv("VEHICLE_POSITIONS_URL")
+        if not url:
+            return None
+        return cls(
+            url,
+            api_key=os.getenv("API_KEY"),
+            interval=float(os.getenv("VEHICLE_POSITIONS_INTERVAL", DEFAULT_INTERVAL)),
+            max_age_seconds=float(os.getenv("VEHICLE_POSITIONS_MAX_AGE", DEFAULT_MAX_AGE_SECONDS)),
+        )
+
+    def start(self):
+        if self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._poll_loop())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopping.set()
+        await self._task
+        self._task = None
+
+    async def _poll_loop(self):
+        while not self._stopping.is_set():
+            await self.poll()
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def poll(self):
+        """
+        Fetch the feed once and publish the new snapshot (on failure the current one stays).
+        """
+        params = {"Key": self.api_key} if self.api_key else None
+
+        async def request():
+            response = await get_http_client().get(self.url, params=params, timeout=self.upstream.timeout)
+            response.raise_for_status()
+            return response
+
+        self.counters["polls"] += 1
+        try:
+            response = await self.upstream.call(request)
+            self.snapshot = await run_blocking(self._ingest, response.content, time.time())
+        except Exception as e:
+            self.counters["poll_errors"] += 1
+            logger.error("Vehicle positions poll failed: %s", e)
+
+    def _ingest(self, content: bytes, now: float) -> VehicleSnapshot:
+        rows = decode_vehicle_positions(content)
+        self.counters["positions_received"] += len(rows)
+        latest = self._latest
+        for row in rows:
+            current = latest.get(row[0])
+            if current is None or row[7] >= current[7]:
+                latest[row[0]] = row
+        expired = [vehicle_id for vehicle_id, row in latest.items() if now - row[7] > self.max_age_seconds]
+        for vehicle_id in expired:
+            del latest[vehicle_id]
+        self.counters["positions_expired"] += len(expired)
+        return VehicleSnapshot(list(latest.values()), built_at=now)
+
+    def metrics(self) -> dict:
+        return {
+            "vehicles": len(self.snapshot),
+            "snapshot_age_seconds": round(time.time() - self.snapshot.built_at, 1) if len(self.snapshot) else 0,
+            **self.counters,
+        }
+
+
+async def gtfs_store_or_none():
+    """
+    The GTFS store, or None when the GTFS files can't be read (locations and names are then
+    left out of the answers).
+    """
+    try:
+        return await load_gtfs_index()
+    except Exception as e:
+        logger.warning("GTFS store unavailable: %s", e)
+        return None
+
+
+async def locate_next_vehicle(stop_number: str, line_number: str, operator_id: str = None):
+    """
+    Live position of the next bus of a line heading to a stop.
+
+    The upcoming arrivals of the line come from the SIRI response of the stop (get_times);
+    the first one whose vehicle (or trip) is in the latest snapshot is returned, with its
+    distance to the stop when the stop location is known.
+
+    Returns:
+        dict: {"success": True, "stop_number", "line_number", "agency", "eta_minutes",
+        "vehicle_id", "latitude", "longitude", "bearing", "speed_kmh", "age_seconds",
+        "distance_meters", ...}, or {"success": False, "error": ...}.
+    """
+    if vehicle_positions is None:
+        return {"success": False, "error": "Vehicle positions are not available."}
+    try:
+        stop_number = str(stop_number).strip()
+        line_number = str(line_number).strip()
+        times_response = await get_times(stop_number)
+        now = datetime.now()
+        arrivals = []
+        visits = times_response["Siri"]["ServiceDelivery"]["StopMonitoringDelivery"][0].get("MonitoredStopVisit") or []
+        for element in visits:
+            vehicle_journey = element.get("MonitoredVehicleJourney", {})
+            if element.get("MonitoringRef") != stop_number or vehicle_journey.get("PublishedLineName") != line_number:
+                continue
+            if operator_id and vehicle_journey.get("OperatorRef") != operator_id:
+                continue
+            arrival = vehicle_journey.get("MonitoredCall", {}).get("ExpectedArrivalTime")
+            if not arrival:
+                continue
+            delta = (datetime.fromisoformat(arrival[:-6]) - now).total_seconds()  # Remove timezone
+            if delta > 0:
+                arrivals.append((delta, vehicle_journey))
+        if not arrivals:
+            return {"success": False, "error": f"No upcoming arrival of line {line_number} at stop {stop_number}."}
+
+        arrivals.sort(key=lambda item: item[0])
+        snapshot = vehicle_positions.snapshot
+        for delta, vehicle_journey in arrivals[:MAX_CANDIDATE_ARRIVALS]:
+            journey = (vehicle_journey.get("FramedVehicleJourneyRef") or {}).get("DatedVehicleJourneyRef")
+            index = snapshot.find(vehicle_journey.get("VehicleRef"), journey)
+            if index is None:
+                continue
+            result = {
+                "success": True,
+                "stop_number": stop_number,
+                "line_number": line_number,
+                "agency": vehicle_journey.get("OperatorRef"),
+                "eta_minutes": int(delta // 60),
+                **snapshot.describe(index),
+                "distance_meters": None,
+            }
+            store = await gtfs_store_or_none()
+            location = store.stop_location(stop_number) if store is not None else None
+            if location is not None:
+                result["distance_meters"] = round(distance_m(*location, snapshot.lat[index], snapshot.lon[index]))
+            return result
+        return {"success": False,
+                "error": f"No live position for the next buses of line {line_number} at stop {stop_number}."}
+    except Exception as e:
+        logger.error("Error locating line %s at stop %s: %s", line_number, stop_number, e)
+        return {"success": False, "error": str(e)}
+
+
+async def vehicles_near(stop_number: str = None, latitude: float = None, longitude: float = None,
+                        radius_meters: float = DEFAULT_RADIUS_METERS, limit: int = 10):
+    """
+    Vehicles within radius_meters of a stop or of a point, nearest first.
+
+    Returns:
+        dict: {"success": True, "radius_meters", "vehicles": [{"line_number", "distance_meters",
+        "vehicle_id", "latitude", "longitude", ...}, ...]}, or {"success": False, "error": ...}.
+    """
+    if vehicle_positions is None:
+        return {"success": False, "error": "Vehicle positions are not available."}
+    store = await gtfs_store_or_none()
+    if stop_number is not None:
+        location = store.stop_location(stop_number) if store is not None else None
+        if location is None:
+            return {"success": False, "error": f"Unknown location for stop {stop_number}."}
+        latitude, longitude = location
+    elif latitude is None or longitude is None:
+        return {"success": False, "error": "A stop number or a location is needed."}
+    radius_meters = min(int(radius_meters), MAX_RADIUS_METERS)
+    snapshot = vehicle_positions.snapshot
+    now = time.time()
+    vehicles = []
+    for distance, index in snapshot.nearby(latitude, longitude, radius_meters, limit):
+        route_id = snapshot.route_ids[index]
+        line_number = store.route_short_name(route_id) if store is not None else None
+        vehicles.append({"line_number": line_number or route_id,
+                         "distance_meters": round(distance), **snapshot.describe(index, now)})
+    return {"success": True, "stop_number": stop_number, "latitude": latitude, "longitude": longitude,
+            "radius_meters": radius_meters, "vehicles": vehicles}
+
+
+# Latest vehicle positions (None unless VEHICLE_POSITIONS_URL is set)
+vehicle_positions = VehiclePositionsIngester.from_env()
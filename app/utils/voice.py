@@ -0,0 +1,173 @@
+import asyncio
+import importlib
+import importlib.util
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import httpx
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Transcription backend, as "module:function"; the function takes an audio file path and returns the text
+DEFAULT_TRANSCRIBER = "app.utils.voice:whisper_transcribe"
+
+# Backends already imported in the current (worker) process
+_transcribers = {}
+# Whisper model loaded once per worker process
+_whisper_model = None
+
+
+def whisper_transcribe(audio_path: str) -> str:
+    """
+    Transcribe an audio file locally with openai-whisper (model chosen by WHISPER_MODEL).
+    """
+    global _whisper_model
+    if _whisper_model is None:
+        try:
+            import whisper
+        except ImportError:
+            raise RuntimeError("openai-whisper isn't installed: install it (and ffmpeg), "
+                               "or set VOICE_TRANSCRIBER to another backend") from None
+        _whisper_model = whisper.load_model(os.getenv("WHISPER_MODEL", "base"))
+    return _whisper_model.transcribe(audio_path)["text"]
+
+
+def stub_transcribe(audio_path: str) -> str:
+    """
+    Stand-in model for tests and benchmarks: returns VOICE_STUB_TEXT whatever the audio.
+    """
+    return os.getenv("VOICE_STUB_TEXT", "When is the next bus?")
+
+
+def load_transcriber(spec: str):
+    """
+    Import the transcription function described by "module:function" (cached per process).
+    """
+    if spec not in _transcribers:
+        module_name, function_name = spec.split(":")
+        _transcribers[spec] = getattr(importlib.import_module(module_name), function_name)
+    return _transcribers[spec]
+
+
+def convert_to_wav(source_path: str) -> str:
+    """
+    Convert an audio file to 16 kHz mono WAV with ffmpeg (what Whisper works on).
+
+    Returns the source path unchanged when ffmpeg isn't installed.
+    """
+    if shutil.which("ffmpeg") is None:
+        return source_path
+    target_path = os.path.splitext(source_path)[0] + ".wav"
+    subprocess.run(
+        ["ffmpeg", "-y", "-loglevel", "error", "-i", source_path, "-ac", "1", "-ar", "16000", target_path],
+        check=True, capture_output=True
+    )
+    return target_path
+
+
+def transcribe_file(audio_path: str, transcriber_spec: str, transcode: bool = True) -> str:
+    """
+    Transcode and transcribe an audio file. Runs inside a worker process of the pool.
+    """
+    if transcode:
+        audio_path = convert_to_wav(audio_path)
+    return load_transcriber(transcriber_spec)(audio_path).strip()
+
+
+class VoicePipeline:
+    """
+    Voice message pipeline: stream the audio to disk, then transcode and transcribe it
+    in a bounded process pool so the event loop is never blocked.
+
+    At most max_workers transcriptions run at once and at most max_pending wait for the
+    pool; transcribe() waits for room beyond that.
+    """
+
+    def __init__(self, transcriber: str = DEFAULT_TRANSCRIBER, max_workers: int = 2, max_pending: int = 20,
+                 transcode: bool = True, tmp_dir: str = None, download_timeout: float = 30.0,
+                 max_download_bytes: int = 16 * 1024 * 1024):
+        self.transcriber = transcriber
+        self.max_workers = max_workers
+        self.transcode = transcode
+        self.tmp_dir = tmp_dir
+        self.download_timeout = download_timeout
+        self.max_download_bytes = max_download_bytes
+        self._slots = asyncio.Semaphore(max_workers + max_pending)
+        self._pool = None
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a pipeline configured by the VOICE_* environment variables.
+        """
+        return cls(
+            transcriber=os.getenv("VOICE_TRANSCRIBER", DEFAULT_TRANSCRIBER),
+            max_workers=int(os.getenv("VOICE_WORKERS", 2)),
+            max_pending=int(os.getenv("VOICE_MAX_PENDING", 20)),
+            transcode=os.getenv("VOICE_TRANSCODE", "true").lower() == "true",
+            tmp_dir=os.getenv("VOICE_TMP_DIR"),
+        )
+
+    def check(self):
+        """
+        Warn at startup when the default backend can't run, instead of at the first voice message.
+        """
+        if self.transcriber == DEFAULT_TRANSCRIBER and importlib.util.find_spec("whisper") is None:
+            logger.warning("openai-whisper isn't installed: voice messages get a 'please send text' reply "
+                           "(install it, or set VOICE_TRANSCRIBER)")
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    async def download(self, url: str, target_dir: str) -> str:
+        """
+        Stream the audio file at url into target_dir, chunk by chunk.
+        """
+        audio_path = os.path.join(target_dir, "voice.ogg")
+        size = 0
+        async with httpx.AsyncClient(timeout=self.download_timeout, follow_redirects=True) as client:
+            async with client.stream("GET", url) as response:
+                response.raise_for_status()
+                with open(audio_path, "wb") as audio_file:
+                    async for chunk in response.aiter_bytes():
+                        size += len(chunk)
+                        if size > self.max_download_bytes:
+                            raise ValueError(f"Voice message larger than {self.max_download_bytes} bytes")
+                        audio_file.write(chunk)
+        return audio_path
+
+    async def transcribe(self, url: str) -> str:
+        """
+        Download and transcribe the voice message at url.
+
+        Returns:
+            str: The transcribed text (empty if nothing was understood).
+        """
+        async with self._slots:
+            target_dir = tempfile.mkdtemp(prefix="helpy-voice-", dir=self.tmp_dir)
+            try:
+                audio_path = await self.download(url, target_dir)
+                if self._pool is None:
+                    # Spawned, not forked, so the workers don't inherit the server's signal handlers
+                    self._pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._pool, transcribe_file, audio_path, self.transcriber,
+                                                  self.transcode)
+            finally:
+                shutil.rmtree(target_dir, ignore_errors=True)
+
+
+# Pipeline used for every WhatsApp voice message of the process
+voice_pipeline = VoicePipeline.from_env()
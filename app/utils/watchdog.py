@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from app.utils.metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG_SECONDS = Histogram("helpy_event_loop_lag_seconds", "Delay of the event loop in waking up a timer.",
+                             buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+LOOP_BLOCKS = Counter("helpy_event_loop_blocks_total", "Times a callback blocked the event loop over the threshold.")
+
+
+class LoopWatchdog:
+    """
+    Measure the lag of the event loop and report the callbacks that block it.
+
+    A task on the loop wakes up every interval and records how late it woke up. A monitor
+    thread checks that the task keeps waking up: when the loop has been stuck for more than
+    threshold seconds, it logs the stack of the loop thread (the code blocking it), once per
+    blocking episode.
+    """
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.25, clock=time.monotonic):
+        self.interval = interval
+        self.threshold = threshold
+        self.clock = clock
+        self.max_lag = 0.0
+        self.blocks = 0
+        self._heartbeat = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._loop_thread_id = None
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a watchdog configured by LOOP_WATCHDOG_INTERVAL and LOOP_BLOCK_THRESHOLD, or None
+        when LOOP_WATCHDOG is false.
+        """
+        if os.getenv("LOOP_WATCHDOG", "true").lower() != "true":
+            return None
+        return cls(
+            interval=float(os.getenv("LOOP_WATCHDOG_INTERVAL", 0.1)),
+            threshold=float(os.getenv("LOOP_BLOCK_THRESHOLD", 0.25)),
+        )
+
+    def start(self):
+        """
+        Start watching the running loop.
+        """
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = self.clock()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._beat())
+        self._thread = threading.Thread(target=self._monitor, name="helpy-loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopped.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._thread.join(timeout=self.interval * 2)
+        self._thread = None
+
+    async def _beat(self):
+        while True:
+            expected = self.clock() + self.interval
+            await asyncio.sleep(self.interval)
+            now = self.clock()
+            lag = max(0.0, now - expected)
+            self._heartbeat = now
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG_SECONDS.observe(lag)
+
+    def _monitor(self):
+        reported = None
+        while not self._stopped.wait(self.interval):
+            heartbeat = self._heartbeat
+            stuck_for = self.clock() - heartbeat - self.interval
+            if stuck_for < self.threshold or reported == heartbeat:
+                continue
+            reported = heartbeat
+            self.blocks += 1
+            LOOP_BLOCKS.inc()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "(stack unavailable)"
+            logger.warning("Event loop blocked for %.3fs, in:\n%s", stuck_for, stack)
+
+    def metrics(self) -> dict:
+        return {"max_lag_seconds": round(self.max_lag, 6), "blocks": self.blocks}
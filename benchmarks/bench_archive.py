@@ -0,0 +1,94 @@
+"""
+Benchmark of the arrival archive: recording cost on the request path, write throughput and
+memory-mapped scans.
+
+    poetry run python -m benchmarks.bench_archive --responses 20000 --stops 2000
+
+--responses SIRI responses (from the generator of benchmarks.fake_upstreams) are recorded
+into a temporary archive; it reports the time record() adds to each response, the rows and
+bytes written per second by the background flushes, the bytes per row, and the time to scan
+the segment for one stop and for one line.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from benchmarks.fake_upstreams import build_siri_response
+
+
+async def run_benchmark(args, directory: str) -> dict:
+    from app.utils.arrival_archive import ArrivalArchive
+
+    stops = [str(10000 + index) for index in range(args.stops)]
+    responses = [(stop, build_siri_response(stop, lines_per_stop=args.lines_per_stop))
+                 for stop in stops]
+    archive = ArrivalArchive(directory, flush_interval=args.flush_interval, max_pending=args.responses)
+    archive.start()
+
+    record_ns = []
+    observed_at = time.time()
+    for index in range(args.responses):
+        stop, response = responses[index % len(responses)]
+        start = time.perf_counter_ns()
+        archive.record(stop, response, observed_at)
+        record_ns.append(time.perf_counter_ns() - start)
+        if index % 1000 == 999:
+            # Let the flush loop run as it would between requests
+            await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await archive.stop()
+    flush_seconds = time.perf_counter() - start
+    return {"record_ns": record_ns, "flush_seconds": flush_seconds, **archive.metrics()}
+
+
+def scan_benchmark(args, directory: str) -> dict:
+    from app.utils.arrival_archive import ArchiveSegment, list_segments
+
+    segment_path = list_segments(directory)[-1]
+    timings = {}
+    with ArchiveSegment(segment_path) as segment:
+        rows = segment.rows
+        for name, filters in (("stop", {"stop": "10007"}), ("line", {"line": "3"}),
+                              ("stop + line", {"stop": "10007", "line": "3"})):
+            runs = []
+            for _ in range(args.scan_runs):
+                start = time.perf_counter()
+                matched = int(segment.scan(**filters).sum())
+                runs.append(time.perf_counter() - start)
+            timings[name] = (statistics.median(runs), matched)
+    size = sum(os.path.getsize(os.path.join(segment_path, name)) for name in os.listdir(segment_path))
+    return {"rows": rows, "segment_bytes": size, "scans": timings}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the arrival archive.")
+    parser.add_argument("--responses", type=int, default=20000)
+    parser.add_argument("--stops", type=int, default=2000)
+    parser.add_argument("--lines-per-stop", type=int, default=8)
+    parser.add_argument("--flush-interval", type=float, default=1.0)
+    parser.add_argument("--scan-runs", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        result = asyncio.run(run_benchmark(args, directory))
+        scan = scan_benchmark(args, directory)
+
+    record_ns = sorted(result["record_ns"])
+    print(f"{args.responses} SIRI responses of {args.stops} stops, {args.lines_per_stop} lines per stop")
+    print(f"record(): p50 {record_ns[len(record_ns) // 2] / 1000:.2f} us, "
+          f"p99 {record_ns[int(len(record_ns) * 0.99)] / 1000:.2f} us per response")
+    print(f"written: {result['rows_written']} rows, {result['bytes_written'] / 1e6:.1f} MB "
+          f"({result['bytes_written'] / max(1, result['rows_written']):.0f} bytes per row), "
+          f"last flush {result['flush_seconds']:.2f}s, dropped {result['dropped']}")
+    print(f"segment: {scan['rows']} rows, {scan['segment_bytes'] / 1e6:.1f} MB on disk")
+    for name, (seconds, matched) in scan["scans"].items():
+        print(f"scan by {name}: {1000 * seconds:.2f} ms ({matched} rows, "
+              f"{scan['rows'] / seconds / 1e6:.0f}M rows/s)")
+
+
+if __name__ == "__main__":
+    main()
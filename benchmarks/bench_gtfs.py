@@ -0,0 +1,161 @@
+"""
+Benchmark of the GTFS static lookups against a feed made by benchmarks.generate_gtfs.
+
+    poetry run python -m benchmarks.generate_gtfs --scale national --output-dir benchmarks/data/national
+    poetry run python -m benchmarks.bench_gtfs --data-dir benchmarks/data/national --calls 5
+
+It times the build of the GTFS store (in a fresh GTFS_STORE_DIR) and its opening by a worker that
+finds it built, get_lines_at_stop and the scheduled departures on hub stops, ordinary stops and
+unknown stop codes, and operatorId_to_name on every agency, then reports the latency percentiles
+and the peak memory of the process. With --workers, that many processes then map the store and
+read every stop: their private and shared memory shows what each worker adds.
+"""
+import argparse
+import asyncio
+import csv
+import multiprocessing
+import os
+import random
+import resource
+import tempfile
+import time
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def pick_stop_codes(data_dir: str, calls: int, seed: int) -> dict:
+    """
+    Stop codes to query: the busiest stops (most stop_times rows in the first million), random
+    ones and codes that don't exist.
+    """
+    with open(os.path.join(data_dir, "stops.txt"), encoding="utf-8") as file:
+        stops = {row["stop_id"]: row["stop_code"] for row in csv.DictReader(file)}
+    visits = {}
+    with open(os.path.join(data_dir, "stop_times.txt"), encoding="utf-8") as file:
+        reader = csv.reader(file)
+        stop_id_column = next(reader).index("stop_id")
+        for index, row in enumerate(reader):
+            if index >= 1000000:
+                break
+            visits[row[stop_id_column]] = visits.get(row[stop_id_column], 0) + 1
+    rng = random.Random(seed)
+    hubs = sorted(visits, key=visits.get, reverse=True)[:calls]
+    return {
+        "hub": [stops[stop_id] for stop_id in hubs],
+        "random": rng.sample(sorted(stops.values()), min(calls, len(stops))),
+        "unknown": [str(code) for code in range(1, calls + 1)],
+    }
+
+
+def memory_kb() -> dict:
+    """
+    Resident, private and shared memory of the process in kB (Linux: /proc/self/smaps_rollup).
+    """
+    fields = {}
+    with open("/proc/self/smaps_rollup") as smaps:
+        for line in smaps:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return {"rss": fields.get("Rss", 0), "pss": fields.get("Pss", 0),
+            "private": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+            "shared": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0)}
+
+
+def worker_memory(path: str) -> dict:
+    """
+    Map the store from a fresh process, read every stop, and report the memory of the process.
+    """
+    import numpy  # noqa: F401 (imported before the measure: every worker has it anyway)
+
+    from app.utils.gtfs_store import GtfsStore
+
+    before = memory_kb()
+    store = GtfsStore(path)
+    lines = departures = 0
+    for stop_code in store.arrays["stop_code"]:
+        lines += len(store.get(stop_code.decode("utf-8"))[1])
+        departures += len(store.departures(stop_code.decode("utf-8"), limit=5))
+    after = memory_kb()
+    return {name: after[name] - before[name] for name in after}
+
+
+async def run_benchmark(args, store_dir: str) -> list:
+    # GTFS_DATA_DIR and GTFS_STORE_DIR are read when app.utils.utils is imported
+    os.environ["GTFS_DATA_DIR"] = os.path.abspath(args.data_dir)
+    os.environ["GTFS_STORE_DIR"] = store_dir
+    from app.utils.gtfs_store import GtfsStore
+    from app.utils.utils import agency_file_path, get_gtfs_index, get_lines_at_stop, operatorId_to_name
+    from benchmarks.generate_gtfs import load_agencies
+
+    rows = []
+    # One-off cost, paid by the first worker of the node after a GTFS update
+    start = time.perf_counter()
+    index = get_gtfs_index()
+    rows.append(("build_gtfs_store", [time.perf_counter() - start], len(index)))
+    # What the other workers (and the restarts) pay
+    start = time.perf_counter()
+    GtfsStore(index.path)
+    rows.append(("open_gtfs_store", [time.perf_counter() - start], len(index)))
+
+    for kind, stop_codes in pick_stop_codes(args.data_dir, args.calls, args.seed).items():
+        latencies = []
+        lines = 0
+        for stop_code in stop_codes:
+            start = time.perf_counter()
+            try:
+                result = await get_lines_at_stop(stop_code)
+                lines += len(result["lines_list"])
+            except Exception:
+                pass
+            latencies.append(time.perf_counter() - start)
+        rows.append((f"get_lines_at_stop/{kind}", latencies, lines / max(1, len(stop_codes))))
+        latencies = []
+        departures = 0
+        for stop_code in stop_codes:
+            start = time.perf_counter()
+            departures += len(index.departures(stop_code, after_seconds=8 * 3600, limit=10))
+            latencies.append(time.perf_counter() - start)
+        rows.append((f"departures/{kind}", latencies, departures / max(1, len(stop_codes))))
+
+    latencies = []
+    for agency_id in load_agencies(agency_file_path):
+        start = time.perf_counter()
+        operatorId_to_name(agency_file_path, agency_id)
+        latencies.append(time.perf_counter() - start)
+    rows.append(("operatorId_to_name", latencies, 1))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the GTFS static lookups.")
+    parser.add_argument("--data-dir", default=os.path.join("benchmarks", "data", "gtfs"))
+    parser.add_argument("--calls", type=int, default=5, help="Stops queried per kind (hub, random, unknown)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=0, help="Processes mapping the store after the build")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        rows = asyncio.run(run_benchmark(args, store_dir))
+        from app.utils.utils import get_gtfs_index
+        store = get_gtfs_index()
+        workers = []
+        if args.workers:
+            with multiprocessing.get_context("spawn").Pool(args.workers) as pool:
+                workers = pool.map(worker_memory, [store.path] * args.workers)
+    print(f"{'lookup':<32}{'calls':>6}{'p50 ms':>12}{'p95 ms':>12}{'max ms':>12}{'results':>9}")
+    for name, latencies, results in rows:
+        print(f"{name:<32}{len(latencies):>6}{1000 * percentile(latencies, 0.5):>12.2f}"
+              f"{1000 * percentile(latencies, 0.95):>12.2f}{1000 * max(latencies):>12.2f}{results:>9.1f}")
+    print(f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB, "
+          f"store: {store.mapped_bytes / 1024 / 1024:.0f} MB mapped")
+    for number, memory in enumerate(workers, start=1):
+        print(f"worker {number}: +{memory['rss'] / 1024:.0f} MB resident, {memory['private'] / 1024:.0f} MB private, "
+              f"{memory['shared'] / 1024:.0f} MB shared, +{memory['pss'] / 1024:.0f} MB proportional")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Benchmark of the live arrival boards (GET /stops/{code}/live) with thousands of open connections.
+
+    poetry run python -m benchmarks.bench_live --connections 2000 --stops 50 --duration 20
+
+A uvicorn worker is started against the local upstream stand-ins; --connections SSE clients
+are spread over --stops stops. It reports the memory of the worker per open connection, the
+events and bytes received, and the SIRI requests made (one per watched stop and poll interval,
+whatever the number of connections).
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+from benchmarks.fake_upstreams import FakeUpstreams
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+async def wait_until_up(base_url: str, timeout: float = 60.0):
+    start = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        while time.perf_counter() - start < timeout:
+            try:
+                async with session.get(f"{base_url}/ready") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    raise TimeoutError("Server not ready")
+
+
+async def run_clients(args, base_url: str, pid: int) -> dict:
+    stats = {"events": 0, "snapshots": 0, "updates": 0, "bytes": 0}
+    connected = asyncio.Event()
+    first_events = 0
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=None)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+        async def client(index: int):
+            nonlocal first_events
+            stop = str(10000 + index % args.stops)
+            async with session.get(f"{base_url}/stops/{stop}/live") as response:
+                got_first = False
+                async for line in response.content:
+                    stats["bytes"] += len(line)
+                    if line.startswith(b"event: "):
+                        stats["events"] += 1
+                        stats["snapshots" if line.startswith(b"event: snapshot") else "updates"] += 1
+                        if not got_first:
+                            got_first = True
+                            first_events += 1
+                            if first_events == args.connections:
+                                connected.set()
+
+        rss_before = rss_mb(pid)
+        tasks = [asyncio.create_task(client(index)) for index in range(args.connections)]
+        await asyncio.wait_for(connected.wait(), timeout=120)
+        rss_connected = rss_mb(pid)
+        await asyncio.sleep(args.duration)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return {"rss_before": rss_before, "rss_connected": rss_connected, **stats}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the live arrival boards.")
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--stops", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds to stay connected")
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    args = parser.parse_args()
+
+    upstreams = FakeUpstreams()
+    upstreams.start()
+    port = free_port()
+    env = dict(os.environ, **upstreams.env(), LIVE_BOARD_POLL_INTERVAL=str(args.poll_interval),
+               SIRI_CACHE_TTL_SECONDS=str(args.poll_interval / 2), LOG_LEVEL="WARNING",
+               LIVE_BOARD_MAX_CONNECTIONS=str(args.connections))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.api.main:app", "--port", str(port), "--log-level", "warning",
+         "--backlog", str(max(2048, args.connections))],
+        env=env
+    )
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        asyncio.run(wait_until_up(base_url))
+        siri_before = upstreams.requests["siri"]
+        result = asyncio.run(run_clients(args, base_url, server.pid))
+        siri = upstreams.requests["siri"] - siri_before
+    finally:
+        server.terminate()
+        server.wait()
+        upstreams.stop()
+
+    per_connection_kb = 1024 * (result["rss_connected"] - result["rss_before"]) / args.connections
+    print(f"{args.connections} connections on {args.stops} stops, {args.duration:.0f}s, "
+          f"poll every {args.poll_interval}s")
+    print(f"worker RSS: {result['rss_before']:.0f} MB -> {result['rss_connected']:.0f} MB "
+          f"({per_connection_kb:.1f} KB per connection)")
+    print(f"events: {result['events']} ({result['snapshots']} snapshots, {result['updates']} updates), "
+          f"{result['bytes'] / 1024:.0f} KB received")
+    print(f"SIRI requests: {siri} ({siri / args.stops:.1f} per stop)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Benchmark of the SIRI upstream resilience: hedged requests against a long tail latency, and
+an upstream outage behind the circuit breaker and the stale SIRI cache.
+
+    poetry run python -m benchmarks.bench_resilience --calls 2000 --tail-ratio 0.03 --tail-latency 1.0
+
+1. Tail latency: --calls fetches of the SIRI stand-in, where --tail-ratio of the requests
+   take --tail-latency, without then with hedging. It reports the p50/p95/p99/max latency and
+   the extra upstream requests.
+2. Outage: the arrivals of --stops stops are cached, then the upstream stalls. It reports the
+   latency of the reads once the cache entries expired (the first ones wait for the timeout,
+   then the circuit opens and the stale responses are served at once).
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from benchmarks.bench_webhook import percentile
+from benchmarks.fake_upstreams import FakeUpstreams
+
+
+def summary(latencies: list) -> str:
+    return "  ".join(f"{name} {1000 * percentile(latencies, q):7.1f}"
+                     for name, q in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99), ("max", 1.0)))
+
+
+async def tail_latency(args, upstreams: FakeUpstreams, hedge: bool) -> dict:
+    from app.utils.utils import fetch_times, siri_upstream
+
+    siri_upstream.hedge = hedge
+    siri_upstream.counters.update(calls=0, hedged=0, hedge_wins=0)
+    siri_upstream._latencies.clear()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def call(index: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await fetch_times(str(10000 + index % args.stops))
+            latencies.append(time.perf_counter() - start)
+
+    requests_before = upstreams.requests["siri"]
+    await asyncio.gather(*(call(index) for index in range(args.calls)))
+    return {"latencies": latencies, "requests": upstreams.requests["siri"] - requests_before,
+            **siri_upstream.metrics()}
+
+
+async def outage(args, upstreams: FakeUpstreams) -> dict:
+    from app.utils.utils import get_cached_times, siri_upstream, stop_times_cache
+
+    stops = [str(20000 + index) for index in range(args.stops)]
+    await asyncio.gather(*(get_cached_times(stop) for stop in stops))
+    upstreams.outage["siri"] = "stall"
+    await asyncio.sleep(stop_times_cache.ttl_seconds)
+    stale_before = stop_times_cache.counters["stale_served"]
+    latencies = []
+    for stop in stops:
+        start = time.perf_counter()
+        await get_cached_times(stop)
+        latencies.append(time.perf_counter() - start)
+    upstreams.outage.clear()
+    return {"latencies": latencies, "stale_served": stop_times_cache.counters["stale_served"] - stale_before,
+            **siri_upstream.metrics()}
+
+
+async def run_benchmark(args, upstreams: FakeUpstreams) -> tuple:
+    from app.utils.utils import close_http_client
+
+    try:
+        without = await tail_latency(args, upstreams, hedge=False)
+        with_hedging = await tail_latency(args, upstreams, hedge=True)
+        down = await outage(args, upstreams)
+    finally:
+        await close_http_client()
+    return without, with_hedging, down
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the SIRI upstream resilience.")
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--stops", type=int, default=200)
+    parser.add_argument("--siri-latency", type=float, default=0.05)
+    parser.add_argument("--tail-ratio", type=float, default=0.03)
+    parser.add_argument("--tail-latency", type=float, default=1.0)
+    parser.add_argument("--timeout", type=float, default=2.0, help="SIRI_TIMEOUT_SECONDS")
+    args = parser.parse_args()
+
+    upstreams = FakeUpstreams(siri_latency=args.siri_latency, tail_ratio=args.tail_ratio,
+                              tail_latency=args.tail_latency).start()
+    try:
+        os.environ.update(upstreams.env())
+        os.environ.update(SIRI_TIMEOUT_SECONDS=str(args.timeout), SIRI_CACHE_TTL_SECONDS="1")
+        without, with_hedging, down = asyncio.run(run_benchmark(args, upstreams))
+    finally:
+        upstreams.stop()
+
+    print(f"{args.calls} SIRI calls, concurrency {args.concurrency}, "
+          f"{100 * args.tail_ratio:g}% of the requests take {args.tail_latency}s (ms):")
+    print(f"without hedging  {summary(without['latencies'])}  upstream requests {without['requests']}")
+    print(f"with hedging     {summary(with_hedging['latencies'])}  upstream requests {with_hedging['requests']} "
+          f"({with_hedging['hedged']} hedged, {with_hedging['hedge_wins']} won by the hedge)")
+    print(f"outage of the upstream, {args.stops} stops read after their cache entry expired (ms):")
+    print(f"stale cache      {summary(down['latencies'])}  stale served {down['stale_served']}, "
+          f"timeouts {down['timeouts']}, short-circuited {down['short_circuited']}")
+
+
+if __name__ == "__main__":
+    main()
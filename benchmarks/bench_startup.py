@@ -0,0 +1,103 @@
+"""
+Benchmark of the start-up of the app: import time of the entry points, and how long a fresh
+uvicorn process takes to answer its first request and to report ready.
+
+    poetry run python -m benchmarks.bench_startup --runs 5 --data-dir benchmarks/data/city
+
+Every measure runs in a new interpreter, so nothing is cached between runs (apart from the
+OS page cache). The server runs with GTFS_DATA_DIR set to --data-dir, so the GTFS index
+built by the warm-up is part of the time to ready.
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+ENTRY_POINTS = ("app.api.main", "app.ai.chat_ai_call_terminal")
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def environment(data_dir: str = None) -> dict:
+    env = dict(os.environ)
+    env.setdefault("OPENAI_API_KEY", "bench")
+    env.setdefault("WHAPI_URL", "http://127.0.0.1:9/")
+    if data_dir:
+        env["GTFS_DATA_DIR"] = os.path.abspath(data_dir)
+    return env
+
+
+def time_import(module: str, env: dict) -> float:
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    output = subprocess.run([sys.executable, "-c", code], env=env, check=True, capture_output=True, text=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_server(env: dict, timeout: float) -> tuple:
+    """
+    Start uvicorn and poll /ready.
+
+    Returns:
+        tuple: Seconds until the first answer (any status) and until /ready answered 200.
+    """
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.api.main:app", "--port", str(port), "--log-level", "warning"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    first_answer = None
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}") as client:
+            while time.perf_counter() - start < timeout:
+                try:
+                    response = client.get("/ready", timeout=1.0)
+                except httpx.TransportError:
+                    time.sleep(0.01)
+                    continue
+                if first_answer is None:
+                    first_answer = time.perf_counter() - start
+                if response.status_code == 200:
+                    return first_answer, time.perf_counter() - start
+                time.sleep(0.01)
+        raise TimeoutError(f"Server not ready after {timeout}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the start-up of the app.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--data-dir", default=None, help="GTFS feed loaded by the warm-up")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+
+    env = environment(args.data_dir)
+    rows = []
+    for module in ENTRY_POINTS:
+        rows.append((f"import {module}", [time_import(module, env) for _ in range(args.runs)]))
+    server_runs = [time_server(env, args.timeout) for _ in range(args.runs)]
+    rows.append(("uvicorn first answer", [first for first, _ in server_runs]))
+    rows.append(("uvicorn ready", [ready for _, ready in server_runs]))
+
+    print(f"{'measure':<42}{'runs':>6}{'p50 s':>10}{'max s':>10}")
+    for name, seconds in rows:
+        print(f"{name:<42}{len(seconds):>6}{percentile(seconds, 0.5):>10.3f}{max(seconds):>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Benchmark of the arrival alerts scheduler with tens of thousands of subscriptions.
+
+    poetry run python -m benchmarks.bench_subscriptions --subscriptions 50000 --stops 2000 --duration 10
+
+The subscriptions are spread over --stops stops; get_times is replaced by the SIRI response
+generator of benchmarks.fake_upstreams (with --siri-latency) and the WhatsApp sender by a
+counter. It reports the number of SIRI polls against the number of subscriptions, the
+notifications sent, and the event-loop time spent by the scheduler per poll.
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from benchmarks.fake_upstreams import build_siri_response
+
+
+async def run_benchmark(args) -> dict:
+    from app.utils.subscriptions import SubscriptionScheduler
+
+    rng = random.Random(args.seed)
+    notified = []
+
+    async def fetch(stop_number):
+        await asyncio.sleep(args.siri_latency)
+        return build_siri_response(stop_number, lines_per_stop=args.lines_per_stop)
+
+    async def notify(recipient_id, message):
+        notified.append(recipient_id)
+
+    scheduler = SubscriptionScheduler(poll_interval=args.poll_interval, max_poll_interval=args.poll_interval * 10,
+                                      max_concurrent_polls=args.max_concurrent_polls, max_per_user=1,
+                                      max_subscriptions=args.subscriptions, fetch=fetch, notify=notify)
+    stops = [str(10000 + index) for index in range(args.stops)]
+    start = time.perf_counter()
+    for index in range(args.subscriptions):
+        user_id = f"97250{index:07d}"
+        scheduler.subscribe(user_id, f"{user_id}@s.whatsapp.net", rng.choice(stops),
+                            str(rng.randint(1, args.lines_per_stop)), rng.randint(1, 10))
+    subscribe_seconds = time.perf_counter() - start
+
+    cpu_start = time.process_time()
+    scheduler.start()
+    await asyncio.sleep(args.duration)
+    await scheduler.stop()
+    cpu_seconds = time.process_time() - cpu_start
+
+    metrics = scheduler.metrics()
+    return {
+        "subscribe_us": 1e6 * subscribe_seconds / args.subscriptions,
+        "cpu_ms_per_poll": 1000 * cpu_seconds / max(1, metrics["polls"]),
+        "notified": len(notified),
+        **metrics,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the arrival alerts scheduler.")
+    parser.add_argument("--subscriptions", type=int, default=50000)
+    parser.add_argument("--stops", type=int, default=2000)
+    parser.add_argument("--lines-per-stop", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to run the scheduler")
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    parser.add_argument("--max-concurrent-polls", type=int, default=50)
+    parser.add_argument("--siri-latency", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    result = asyncio.run(run_benchmark(args))
+    print(f"{args.subscriptions} subscriptions on {args.stops} stops, {args.duration:.0f}s")
+    print(f"subscribe: {result['subscribe_us']:.1f} us per subscription")
+    print(f"SIRI polls: {result['polls']} ({result['polls'] / args.duration:.0f}/s, "
+          f"{result['polls'] / args.subscriptions:.3f} per subscription), errors: {result['poll_errors']}")
+    print(f"notifications: {result['notified']}, still subscribed: {result['subscriptions']} "
+          f"on {result['stops']} stops")
+    print(f"scheduler + parsing CPU: {result['cpu_ms_per_poll']:.2f} ms per poll")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Benchmark of the vehicle positions store: ingestion of a VehiclePositions feed and the
+"where is my bus" / "buses near me" lookups.
+
+    poetry run python -m benchmarks.bench_vehicles --stops 500 --queries 20000
+
+The VehiclePositions stand-in serves the vehicles of the SIRI arrivals of --stops stops; the
+matching stops.txt and routes.txt are written to a temporary GTFS_DATA_DIR. It reports the
+time of the first poll and of the decoding and indexing of the feed, then the latency (µs) of:
+
+1. the grid lookup of the vehicles within --radius meters of a stop, against a linear scan,
+2. vehicles_near(stop) and locate_next_vehicle(stop, line) (SIRI responses already cached).
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.bench_webhook import percentile
+from benchmarks.fake_upstreams import (FakeUpstreams, build_vehicle_positions_feed, synthetic_stop_location,
+                                      write_gtfs_locations)
+
+
+def summary(latencies: list) -> str:
+    return "  ".join(f"{name} {1_000_000 * percentile(latencies, q):8.1f}"
+                     for name, q in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99), ("max", 1.0)))
+
+
+def timed_calls(function, arguments: list) -> list:
+    latencies = []
+    for args in arguments:
+        start = time.perf_counter()
+        function(*args)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def timed_coroutines(function, arguments: list) -> list:
+    latencies = []
+    for args in arguments:
+        start = time.perf_counter()
+        await function(*args)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def linear_nearby(snapshot, lat: float, lon: float, radius_m: float, limit: int = 10) -> list:
+    from app.utils.vehicle_positions import distance_m
+
+    found = [(distance, index) for index in range(len(snapshot))
+             for distance in (distance_m(lat, lon, snapshot.lat[index], snapshot.lon[index]),)
+             if distance <= radius_m]
+    found.sort()
+    return found[:limit]
+
+
+async def run_benchmark(args, stops: list) -> dict:
+    from app.utils.blocking import blocking_executors
+    from app.utils.utils import close_http_client, get_times, load_gtfs_index
+    from app.utils.vehicle_positions import locate_next_vehicle, vehicle_positions, vehicles_near
+
+    try:
+        started = time.perf_counter()
+        await vehicle_positions.poll()
+        first_poll = time.perf_counter() - started
+        content = build_vehicle_positions_feed(stops, args.lines_per_stop, args.seed)
+        started = time.perf_counter()
+        snapshot = vehicle_positions._ingest(content, time.time())
+        ingest = time.perf_counter() - started
+
+        rng = random.Random(args.seed)
+        points = [(*synthetic_stop_location(rng.choice(stops)), args.radius) for _ in range(args.queries)]
+        grid = timed_calls(snapshot.nearby, points)
+        linear = timed_calls(lambda lat, lon, radius: linear_nearby(snapshot, lat, lon, radius),
+                             points[:max(1, args.queries // 20)])
+        assert [snapshot.nearby(*point) for point in points[:50]] == \
+               [linear_nearby(snapshot, *point) for point in points[:50]]
+
+        # Warm the GTFS store and the SIRI cache so the lookups are measured, not the builds
+        # (with fewer requests at once than the connections of the shared HTTP client)
+        await load_gtfs_index()
+        warm_up = asyncio.Semaphore(args.warm_up_concurrency)
+
+        async def warm(stop):
+            async with warm_up:
+                await get_times(stop)
+
+        await asyncio.gather(*(warm(stop) for stop in stops))
+        near = await timed_coroutines(vehicles_near, [(rng.choice(stops), None, None, args.radius)
+                                                      for _ in range(args.queries)])
+        queries = [(rng.choice(stops), str(rng.randint(1, args.lines_per_stop))) for _ in range(args.queries)]
+        located = await timed_coroutines(locate_next_vehicle, queries)
+        found = sum([(await locate_next_vehicle(*query))["success"] for query in queries[:1000]])
+    finally:
+        await close_http_client()
+        blocking_executors.shutdown()
+    return {"first_poll": first_poll, "ingest": ingest, "feed_bytes": len(content), "vehicles": len(snapshot),
+            "grid": grid, "linear": linear, "near": near, "located": located,
+            "found_ratio": found / min(1000, len(queries))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the vehicle positions store.")
+    parser.add_argument("--stops", type=int, default=500)
+    parser.add_argument("--lines-per-stop", type=int, default=8)
+    parser.add_argument("--queries", type=int, default=20000)
+    parser.add_argument("--radius", type=float, default=500)
+    parser.add_argument("--warm-up-concurrency", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    stops = [str(30000 + index) for index in range(args.stops)]
+    upstreams = FakeUpstreams(lines_per_stop=args.lines_per_stop, vehicle_stops=stops, seed=args.seed).start()
+    with tempfile.TemporaryDirectory() as gtfs_dir:
+        write_gtfs_locations(gtfs_dir, stops, args.lines_per_stop)
+        try:
+            os.environ.update(upstreams.env())
+            os.environ.update(GTFS_DATA_DIR=gtfs_dir, GTFS_STORE_DIR=os.path.join(gtfs_dir, "store"),
+                              SIRI_CACHE_TTL_SECONDS="600")
+            results = asyncio.run(run_benchmark(args, stops))
+        finally:
+            upstreams.stop()
+
+    print(f"{results['vehicles']} vehicles of {args.stops} stops: first poll {1000 * results['first_poll']:.0f} ms, "
+          f"decode and index of the {results['feed_bytes'] // 1024} KiB feed "
+          f"{1000 * results['ingest']:.0f} ms")
+    print(f"{args.queries} lookups, radius {args.radius:g} m (µs):")
+    print(f"grid nearby            {summary(results['grid'])}")
+    print(f"linear scan            {summary(results['linear'])}")
+    print(f"vehicles_near          {summary(results['near'])}")
+    print(f"locate_next_vehicle    {summary(results['located'])}  "
+          f"found {100 * results['found_ratio']:.0f}%")
+
+
+if __name__ == "__main__":
+    main()
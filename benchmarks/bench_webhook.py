@@ -0,0 +1,209 @@
+"""
+End-to-end benchmark of whatsapp_webhook against local stand-ins of every upstream.
+
+Run it with:
+    poetry run python -m benchmarks.bench_webhook --requests 500 --concurrency 50 --llm-latency 0.3
+
+Each request is a WHAPI webhook carrying "<stop> <line>" from one of --users users (each
+concurrent worker has its own users, so a user never has two requests in flight). It
+reports the throughput, the p50/p95/p99 latency of the webhook call and of the reply
+(until the answer reaches the WHAPI sink), and the per-stage breakdown recorded by
+app.utils.metrics.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+
+from benchmarks.fake_upstreams import FakeUpstreams
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def histogram_quantile(buckets: tuple, bucket_counts: list, fraction: float) -> float:
+    """
+    Upper bound of the histogram bucket holding the given quantile.
+    """
+    target = fraction * sum(bucket_counts)
+    cumulative = 0
+    for bound, count in zip(buckets + (float("inf"),), bucket_counts):
+        cumulative += count
+        if cumulative >= target:
+            return bound
+    return float("inf")
+
+
+def stage_breakdown(before: dict, after: dict, buckets: tuple) -> list:
+    """
+    Per-stage (count, mean, ~p95) of the observations recorded between two histogram snapshots.
+    """
+    rows = []
+    for labels, (bucket_counts, total, count) in sorted(after.items(), key=lambda item: str(item[0])):
+        previous_counts, previous_total, previous_count = before.get(labels, ([0] * len(bucket_counts), 0.0, 0))
+        delta_count = count - previous_count
+        if delta_count <= 0:
+            continue
+        delta_buckets = [now - then for now, then in zip(bucket_counts, previous_counts)]
+        name = "/".join(label for label in labels if label)
+        rows.append((name, delta_count, (total - previous_total) / delta_count,
+                     histogram_quantile(buckets, delta_buckets, 0.95)))
+    return rows
+
+
+def build_webhook(user_id: str, text: str) -> dict:
+    return {
+        "event": {"type": "messages", "event": "post"},
+        "messages": [{
+            "id": uuid.uuid4().hex,
+            "from_me": False,
+            "type": "text",
+            "chat_id": f"{user_id}@s.whatsapp.net",
+            "from": user_id,
+            "timestamp": int(time.time()),
+            "text": {"body": text},
+        }],
+    }
+
+
+def configure_environment(upstreams: FakeUpstreams):
+    """
+    Point the app at the fake servers and lift the admission limits before it is imported.
+    """
+    os.environ.update(upstreams.env())
+    for name in ("RATE_LIMIT_USER_BURST", "RATE_LIMIT_CHAT_BURST", "RATE_LIMIT_GLOBAL_BURST"):
+        os.environ[name] = "1000000"
+    for name in ("RATE_LIMIT_USER_PER_MINUTE", "RATE_LIMIT_CHAT_PER_MINUTE"):
+        os.environ[name] = "1000000000"
+    os.environ["RATE_LIMIT_GLOBAL_PER_SECOND"] = "1000000"
+
+
+async def run_benchmark(args, upstreams: FakeUpstreams) -> dict:
+    import httpx
+    from app.api.main import app, lifespan
+    from app.utils.metrics import STAGE_SECONDS
+
+    rng = random.Random(args.seed)
+    stops = [str(10000 + rng.randrange(args.stops)) for _ in range(args.stops)]
+    users = [f"97250{index:07d}" for index in range(max(args.users, args.concurrency))]
+
+    loop = asyncio.get_running_loop()
+    # recipient -> futures waiting for the next reply reaching the sink
+    reply_waiters = {}
+
+    def on_sent(recipient, body):
+        waiters = reply_waiters.get(recipient)
+        if waiters:
+            future = waiters.pop(0)
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(time.perf_counter()))
+
+    upstreams.on_sent(on_sent)
+
+    webhook_latencies = []
+    reply_latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for index in range(args.requests):
+        queue.put_nowait(index)
+
+    async with lifespan(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://helpy") as client:
+
+            async def worker(worker_users: list):
+                nonlocal errors
+                while True:
+                    try:
+                        queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    user_id = rng.choice(worker_users)
+                    recipient = f"{user_id}@s.whatsapp.net"
+                    text = f"{rng.choice(stops)} {rng.randint(1, upstreams.lines_per_stop)}"
+                    reply = loop.create_future()
+                    reply_waiters.setdefault(recipient, []).append(reply)
+                    start = time.perf_counter()
+                    response = await client.post("/webhook/whatsapp", json=build_webhook(user_id, text))
+                    webhook_latencies.append(time.perf_counter() - start)
+                    if response.status_code != 200 or not response.json().get("success"):
+                        errors += 1
+                    try:
+                        replied_at = await asyncio.wait_for(reply, timeout=args.reply_timeout)
+                        reply_latencies.append(replied_at - start)
+                    except asyncio.TimeoutError:
+                        errors += 1
+                        if reply in reply_waiters.get(recipient, []):
+                            reply_waiters[recipient].remove(reply)
+
+            before = STAGE_SECONDS.snapshot()
+            started = time.perf_counter()
+            await asyncio.gather(*(worker(users[index::args.concurrency]) for index in range(args.concurrency)))
+            elapsed = time.perf_counter() - started
+            after = STAGE_SECONDS.snapshot()
+
+    return {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "errors": errors,
+        "elapsed_s": elapsed,
+        "throughput_rps": args.requests / elapsed,
+        "webhook_ms": {name: 1000 * percentile(webhook_latencies, q)
+                       for name, q in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))},
+        "reply_ms": {name: 1000 * percentile(reply_latencies, q)
+                     for name, q in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))},
+        "stages": [{"stage": name, "count": count, "mean_ms": 1000 * mean, "p95_le_ms": 1000 * p95}
+                   for name, count, mean, p95 in stage_breakdown(before, after, STAGE_SECONDS.buckets)],
+        "upstream_requests": dict(upstreams.requests),
+    }
+
+
+def print_report(report: dict):
+    print(f"{report['requests']} requests, concurrency {report['concurrency']}, "
+          f"{report['elapsed_s']:.2f}s, {report['throughput_rps']:.1f} req/s, {report['errors']} errors")
+    for name in ("webhook_ms", "reply_ms"):
+        latencies = report[name]
+        print(f"{name:<11} p50 {latencies['p50']:8.1f}  p95 {latencies['p95']:8.1f}  p99 {latencies['p99']:8.1f}")
+    print(f"{'stage':<28}{'count':>8}{'mean ms':>10}{'p95 <= ms':>11}")
+    for row in report["stages"]:
+        print(f"{row['stage']:<28}{row['count']:>8}{row['mean_ms']:>10.1f}{row['p95_le_ms']:>11.1f}")
+    print("upstream requests:", report["upstream_requests"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the WhatsApp webhook.")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--stops", type=int, default=50)
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--siri-latency", type=float, default=0.05)
+    parser.add_argument("--alerts-latency", type=float, default=0.05)
+    parser.add_argument("--whapi-latency", type=float, default=0.02)
+    parser.add_argument("--reply-timeout", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    upstreams = FakeUpstreams(siri_latency=args.siri_latency, alerts_latency=args.alerts_latency,
+                              whapi_latency=args.whapi_latency, llm_latency=args.llm_latency,
+                              seed=args.seed).start()
+    try:
+        configure_environment(upstreams)
+        report = asyncio.run(run_benchmark(args, upstreams))
+    finally:
+        upstreams.stop()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+"""
+Local stand-ins for the upstream services used by Helpy, for benchmarks and offline runs:
+
+- a SIRI stop-monitoring JSON endpoint (GTFS_RT_URL),
+- a GTFS-RT service alerts protobuf endpoint (SM_URL), built with gtfs_realtime_pb2,
+- a WHAPI sink recording every message sent (WHAPI_URL),
+- an OpenAI-compatible chat completions mock (OPENAI_BASE_URL),
+- optionally, a GTFS-RT VehiclePositions protobuf endpoint (VEHICLE_POSITIONS_URL), whose
+  vehicles are those of the SIRI arrivals of the given stops.
+
+Every endpoint has a configurable latency; the SIRI and alerts endpoints can also answer a
+share of the requests with a long tail latency, and be put in an outage (errors or stalls).
+The servers run on their own event loop in a background thread, so the app's synchronous
+OpenAI client can't block them.
+"""
+import asyncio
+import csv
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+from aiohttp import web
+
+from app.utils import gtfs_realtime_pb2
+
+# Operators of the generated arrivals (agency_id of agency_simple.txt)
+OPERATORS = ["3", "5", "4", "15", "16", "18", "25"]
+
+
+def build_siri_response(stop_code: str, lines_per_stop: int = 8, arrivals_per_line: int = 4,
+                        multi_operator_ratio: float = 0.0, seed: int = 0) -> dict:
+    """
+    Build a deterministic SIRI stop-monitoring response for a stop (arrivals in the next hour).
+    """
+    rng = random.Random(f"{seed}-{stop_code}")
+    now = datetime.now()
+    visits = []
+    for line_index in range(lines_per_stop):
+        line = str(line_index + 1)
+        operators = [OPERATORS[(int(stop_code) + line_index) % len(OPERATORS)]] if stop_code.isdigit() \
+            else [rng.choice(OPERATORS)]
+        if rng.random() < multi_operator_ratio:
+            operators.append(rng.choice([op for op in OPERATORS if op not in operators]))
+        for operator_id in operators:
+            for _ in range(arrivals_per_line):
+                arrival = now + timedelta(minutes=rng.uniform(1, 60))
+                visits.append({
+                    "MonitoringRef": stop_code,
+                    "MonitoredVehicleJourney": {
+                        "LineRef": f"{operator_id}{line.zfill(4)}",
+                        "DirectionRef": str(rng.randint(1, 2)),
+                        "PublishedLineName": line,
+                        "OperatorRef": operator_id,
+                        "FramedVehicleJourneyRef": {"DatedVehicleJourneyRef": str(rng.randint(10 ** 7, 10 ** 8))},
+                        "VehicleRef": str(rng.randint(1000000, 9999999)),
+                        "MonitoredCall": {
+                            "StopPointRef": stop_code,
+                            "ExpectedArrivalTime": arrival.replace(microsecond=0).isoformat() + "+03:00"
+                        }
+                    }
+                })
+    return {"Siri": {"ServiceDelivery": {"StopMonitoringDelivery": [{"MonitoredStopVisit": visits}]}}}
+
+
+def build_alerts_feed(alert_count: int = 50, seed: int = 0) -> bytes:
+    """
+    Build a GTFS-RT FeedMessage with service alerts on random routes, serialized as protobuf.
+    """
+    rng = random.Random(seed)
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.timestamp = int(time.time())
+    for index in range(alert_count):
+        entity = feed.entity.add()
+        entity.id = str(index)
+        alert = entity.alert
+        period = alert.active_period.add()
+        period.start = int(time.time()) - 3600
+        period.end = int(time.time()) + 3600
+        informed = alert.informed_entity.add()
+        operator_id = rng.choice(OPERATORS)
+        informed.agency_id = operator_id
+        informed.route_id = f"{operator_id}{str(rng.randint(1, 8)).zfill(4)}"
+        for language, header, description in (("he", "שינוי במסלול", "הקו מוסט בשל עבודות"),
+                                              ("en", "Route change", "The line is diverted due to works"),
+                                              ("ar", "تغيير المسار", "تم تحويل الخط بسبب الأشغال")):
+            translation = alert.header_text.translation.add()
+            translation.language, translation.text = language, header
+            translation = alert.description_text.translation.add()
+            translation.language, translation.text = language, description
+    return feed.SerializeToString()
+
+
+def synthetic_stop_location(stop_code: str) -> tuple:
+    """
+    Deterministic (lat, lon) of a stop in the Tel Aviv area, for feeds without a stops.txt.
+    """
+    rng = random.Random(f"stop-{stop_code}")
+    return 32.0 + rng.uniform(0, 0.15), 34.75 + rng.uniform(0, 0.1)
+
+
+def write_gtfs_locations(directory: str, stop_codes: list, lines_per_stop: int = 8):
+    """
+    Write the stops.txt (with the synthetic stop locations) and routes.txt matching the
+    stand-in feeds to directory, with empty trips.txt and stop_times.txt.
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "stops.txt"), "w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["stop_id", "stop_code", "stop_name", "stop_lat", "stop_lon"])
+        for stop_id, stop_code in enumerate(stop_codes, start=1):
+            writer.writerow([stop_id, stop_code, f"Stop {stop_code}", *synthetic_stop_location(stop_code)])
+    with open(os.path.join(directory, "routes.txt"), "w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["route_id", "agency_id", "route_short_name"])
+        for operator_id in OPERATORS:
+            for line_index in range(lines_per_stop):
+                line = str(line_index + 1)
+                writer.writerow([f"{operator_id}{line.zfill(4)}", operator_id, line])
+    with open(os.path.join(directory, "trips.txt"), "w", encoding="utf-8", newline="") as file:
+        csv.writer(file).writerow(["route_id", "service_id", "trip_id"])
+    with open(os.path.join(directory, "stop_times.txt"), "w", encoding="utf-8", newline="") as file:
+        csv.writer(file).writerow(["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"])
+
+
+def build_vehicle_positions_feed(stop_codes: list, lines_per_stop: int = 8, seed: int = 0,
+                                 meters_per_minute: float = 400) -> bytes:
+    """
+    Build a GTFS-RT FeedMessage with the position of every vehicle of the SIRI arrivals of the
+    stops (same vehicle and trip ids), meters_per_minute of ETA away from the stop and heading
+    to it, serialized as protobuf.
+    """
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    now = datetime.now()
+    feed.header.timestamp = int(now.timestamp())
+    for stop_code in stop_codes:
+        stop_lat, stop_lon = synthetic_stop_location(stop_code)
+        visits = build_siri_response(stop_code, lines_per_stop, seed=seed)["Siri"]["ServiceDelivery"][
+            "StopMonitoringDelivery"][0]["MonitoredStopVisit"]
+        for visit in visits:
+            journey = visit["MonitoredVehicleJourney"]
+            arrival = datetime.fromisoformat(journey["MonitoredCall"]["ExpectedArrivalTime"][:-6])
+            distance = meters_per_minute * max(0.0, (arrival - now).total_seconds() / 60)
+            heading = random.Random(journey["VehicleRef"]).uniform(0, 2 * math.pi)
+            entity = feed.entity.add()
+            entity.id = journey["VehicleRef"]
+            vehicle = entity.vehicle
+            vehicle.trip.trip_id = journey["FramedVehicleJourneyRef"]["DatedVehicleJourneyRef"]
+            vehicle.trip.route_id = journey["LineRef"]
+            vehicle.vehicle.id = journey["VehicleRef"]
+            vehicle.position.latitude = stop_lat + distance * math.cos(heading) / 111_320
+            vehicle.position.longitude = stop_lon + distance * math.sin(heading) / (
+                111_320 * math.cos(math.radians(stop_lat)))
+            vehicle.position.bearing = math.degrees(heading + math.pi) % 360
+            vehicle.position.speed = meters_per_minute / 60
+            vehicle.timestamp = feed.header.timestamp
+    return feed.SerializeToString()
+
+
+def build_chat_completion(messages: list) -> dict:
+    """
+    Answer like the LLM would: call get_transit_times when the last user message holds a stop
+    and a line number, get_lines_at_stop when it asks for the lines of a stop, get_arrival_board
+    when it asks what is coming to a stop, get_vehicle_location when it asks where a line is,
+    get_vehicles_nearby when it asks for the buses near a stop, else ask a question.
+    """
+    user_message = next((msg.get("content") or "" for msg in reversed(messages) if msg.get("role") == "user"), "")
+    numbers = re.findall(r"\d+", user_message)
+    message = {"role": "assistant", "content": None}
+    if "lines" in user_message.lower() and numbers:
+        message["function_call"] = {"name": "get_lines_at_stop",
+                                    "arguments": json.dumps({"stop_number": numbers[0]})}
+    elif "coming" in user_message.lower() and numbers:
+        message["function_call"] = {"name": "get_arrival_board",
+                                    "arguments": json.dumps({"stop_number": numbers[0]})}
+    elif "near" in user_message.lower() and numbers:
+        message["function_call"] = {"name": "get_vehicles_nearby",
+                                    "arguments": json.dumps({"stop_number": numbers[0]})}
+    elif "where" in user_message.lower() and len(numbers) >= 2:
+        message["function_call"] = {"name": "get_vehicle_location",
+                                    "arguments": json.dumps({"stop_number": numbers[0], "line_number": numbers[1]})}
+    elif len(numbers) >= 2:
+        message["function_call"] = {"name": "get_transit_times",
+                                    "arguments": json.dumps({"stop_number": numbers[0], "line_number": numbers[1]})}
+    else:
+        message["content"] = "Which line are you waiting for?"
+    return {
+        "id": "chatcmpl-bench",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": "gpt-4o",
+        "choices": [{"index": 0, "message": message,
+                     "finish_reason": "function_call" if "function_call" in message else "stop"}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+
+
+class FakeUpstreams:
+    """
+    Run the fake SIRI, alerts, WHAPI and OpenAI servers on 127.0.0.1 in a background thread.
+
+    Latencies are in seconds; tail_ratio of the SIRI and alerts requests take tail_latency
+    instead. Setting outage["siri"] (or "alerts") to "error" answers 503, to "stall" holds the
+    requests until the outage ends. Every message reaching the WHAPI sink is kept in `sent` as (perf_counter time,
+    recipient, body). With vehicle_stops, the VehiclePositions feed of those stops is served too.
+    """
+
+    def __init__(self, siri_latency: float = 0.05, alerts_latency: float = 0.05, whapi_latency: float = 0.02,
+                 llm_latency: float = 0.5, lines_per_stop: int = 8, multi_operator_ratio: float = 0.0,
+                 alert_count: int = 50, seed: int = 0, tail_ratio: float = 0.0, tail_latency: float = 1.0,
+                 vehicle_stops: list = None, vehicle_positions_latency: float = 0.05):
+        self.siri_latency = siri_latency
+        self.alerts_latency = alerts_latency
+        self.whapi_latency = whapi_latency
+        self.llm_latency = llm_latency
+        self.lines_per_stop = lines_per_stop
+        self.multi_operator_ratio = multi_operator_ratio
+        self.seed = seed
+        self.tail_ratio = tail_ratio
+        self.tail_latency = tail_latency
+        self.vehicle_stops = vehicle_stops
+        self.vehicle_positions_latency = vehicle_positions_latency
+        self.outage = {}
+        self._rng = random.Random(seed)
+        self.alerts_feed = build_alerts_feed(alert_count, seed)
+        self.sent = []
+        self.requests = {"siri": 0, "alerts": 0, "whapi": 0, "openai": 0, "vehicle_positions": 0}
+        self.base_url = None
+        self._loop = None
+        self._runner = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._sent_listeners = []
+
+    def env(self) -> dict:
+        """
+        Environment variables pointing the app at the fake servers.
+        """
+        env = {
+            "GTFS_RT_URL": f"{self.base_url}/siri",
+            "SM_URL": f"{self.base_url}/alerts",
+            "API_KEY": "bench",
+            "WHAPI_URL": f"{self.base_url}/whapi/",
+            "WHAPI_CHANNEL_TOKEN": "bench",
+            "OPENAI_BASE_URL": f"{self.base_url}/v1",
+            "OPENAI_API_KEY": "bench",
+        }
+        if self.vehicle_stops:
+            env["VEHICLE_POSITIONS_URL"] = f"{self.base_url}/vehicle_positions"
+        return env
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="fake-upstreams", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def on_sent(self, listener):
+        """
+        Call listener(recipient, body) (from the server thread) for every message reaching the sink.
+        """
+        self._sent_listeners.append(listener)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._serve())
+        self._ready.set()
+        self._loop.run_forever()
+
+    async def _serve(self):
+        app = web.Application()
+        app.router.add_get("/siri", self._siri)
+        app.router.add_get("/alerts", self._alerts)
+        app.router.add_get("/vehicle_positions", self._vehicle_positions)
+        app.router.add_post("/whapi/messages/text", self._whapi)
+        app.router.add_post("/v1/chat/completions", self._openai)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    async def _upstream_delay(self, service: str, latency: float):
+        """
+        Wait like the upstream would; an HTTP error response when it is in an error outage.
+        """
+        while self.outage.get(service) == "stall":
+            await asyncio.sleep(0.05)
+        if self.outage.get(service) == "error":
+            return web.Response(status=503, text="Service unavailable")
+        await asyncio.sleep(self.tail_latency if self._rng.random() < self.tail_ratio else latency)
+        return None
+
+    async def _siri(self, request):
+        self.requests["siri"] += 1
+        error = await self._upstream_delay("siri", self.siri_latency)
+        if error is not None:
+            return error
+        stop_code = request.query.get("MonitoringRef", "")
+        return web.json_response(build_siri_response(stop_code, self.lines_per_stop,
+                                                     multi_operator_ratio=self.multi_operator_ratio, seed=self.seed))
+
+    async def _alerts(self, request):
+        self.requests["alerts"] += 1
+        error = await self._upstream_delay("alerts", self.alerts_latency)
+        if error is not None:
+            return error
+        return web.Response(body=self.alerts_feed, content_type="application/x-protobuf")
+
+    async def _vehicle_positions(self, request):
+        self.requests["vehicle_positions"] += 1
+        error = await self._upstream_delay("vehicle_positions", self.vehicle_positions_latency)
+        if error is not None:
+            return error
+        feed = build_vehicle_positions_feed(self.vehicle_stops or [], self.lines_per_stop, self.seed)
+        return web.Response(body=feed, content_type="application/x-protobuf")
+
+    async def _whapi(self, request):
+        self.requests["whapi"] += 1
+        payload = await request.json()
+        await asyncio.sleep(self.whapi_latency)
+        self.sent.append((time.perf_counter(), payload["to"], payload["body"]))
+        for listener in self._sent_listeners:
+            listener(payload["to"], payload["body"])
+        return web.json_response({"sent": True})
+
+    async def _openai(self, request):
+        self.requests["openai"] += 1
+        payload = await request.json()
+        await asyncio.sleep(self.llm_latency)
+        return web.json_response(build_chat_completion(payload.get("messages", [])))
@@ -0,0 +1,230 @@
+"""
+Deterministic generator of a synthetic GTFS static feed, shaped like the Israeli national feed.
+
+It writes stops.txt, routes.txt, trips.txt, stop_times.txt and calendar.txt (plus a copy of
+agency_simple.txt) with the columns used by the MOT feed. Operators and their share of the
+routes come from app/data/agency_simple.txt; stops are grouped in cities with a few hub stops
+served by many lines, and the same line numbers are reused by several operators, as in the
+real data.
+
+    poetry run python -m benchmarks.generate_gtfs --scale national --output-dir benchmarks/data/national
+
+The "national" scale is about 30k stops, 8k routes and 20M+ stop_times rows (several GB,
+a few minutes to generate). The same seed always produces the same files.
+"""
+import argparse
+import csv
+import math
+import os
+import random
+import shutil
+import time
+
+from app.utils.utils import agency_file_path
+
+SCALES = {
+    # stops, cities, routes, mean trips per route
+    "tiny": (300, 3, 40, 10),
+    "city": (3000, 10, 600, 30),
+    "region": (10000, 40, 2500, 50),
+    "national": (30000, 120, 8000, 90),
+}
+
+# Approximate share of the routes run by the main operators; the others share what's left
+OPERATOR_SHARES = {
+    "3": 22.0, "5": 7.0, "15": 8.0, "16": 7.0, "18": 6.0, "25": 6.0, "4": 5.0, "14": 4.0, "23": 3.0,
+    "22": 3.0, "31": 2.0, "32": 2.0, "37": 2.0, "38": 2.0, "35": 1.5, "2": 1.5, "20": 0.2, "33": 0.2,
+}
+DEFAULT_SHARE = 0.6
+
+# GTFS route_type per operator (bus by default)
+ROUTE_TYPES = {"2": 2, "20": 1, "33": 6}
+
+STREET_NAMES = ["הרצל", "ויצמן", "בן גוריון", "רוטשילד", "ז'בוטינסקי", "העצמאות", "הנביאים", "יפו",
+                "אלנבי", "הגפן", "התמר", "הזית", "ביאליק", "סוקולוב", "אחד העם", "דרך השלום"]
+CITY_NAMES = ["ירושלים", "תל אביב יפו", "חיפה", "באר שבע", "אשדוד", "נתניה", "ראשון לציון", "פתח תקווה",
+              "חולון", "בני ברק", "רמת גן", "אשקלון", "רחובות", "בית שמש", "כפר סבא", "הרצליה",
+              "חדרה", "מודיעין", "נצרת", "לוד", "רמלה", "רעננה", "עפולה", "טבריה", "אילת", "צפת"]
+
+
+def load_agencies(path: str = agency_file_path) -> list:
+    with open(path, "r", encoding="utf-8-sig") as file:
+        return [row["agency_id"] for row in csv.DictReader(file)]
+
+
+def format_time(seconds: int) -> str:
+    # GTFS times may go past 24:00:00 for trips running after midnight
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+class GtfsGenerator:
+    """
+    Generate the feed file by file, streaming stop_times so memory stays flat at any scale.
+    """
+
+    def __init__(self, stops: int, cities: int, routes: int, trips_per_route: int, seed: int = 0):
+        self.stop_count = stops
+        self.city_count = cities
+        self.route_count = routes
+        self.trips_per_route = trips_per_route
+        self.rng = random.Random(seed)
+        self.agencies = load_agencies()
+        self.city_stops = []
+        self.stop_weights = []
+        self.stop_names = {}
+        self.route_patterns = {}
+        self.counts = {}
+
+    def generate(self, output_dir: str):
+        os.makedirs(output_dir, exist_ok=True)
+        self.write_stops(os.path.join(output_dir, "stops.txt"))
+        self.write_calendar(os.path.join(output_dir, "calendar.txt"))
+        self.write_routes(os.path.join(output_dir, "routes.txt"))
+        self.write_trips_and_stop_times(os.path.join(output_dir, "trips.txt"),
+                                        os.path.join(output_dir, "stop_times.txt"))
+        shutil.copyfile(agency_file_path, os.path.join(output_dir, "agency_simple.txt"))
+        return self.counts
+
+    def write_stops(self, path: str):
+        rng = self.rng
+        # City sizes follow a Zipf-like law: a few large cities, many small ones
+        sizes = [1 / (rank + 1) ** 0.8 for rank in range(self.city_count)]
+        total = sum(sizes)
+        stop_codes = rng.sample(range(10000, 10000 + 3 * self.stop_count), self.stop_count)
+        stop_id = 0
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.writer(file)
+            writer.writerow(["stop_id", "stop_code", "stop_name", "stop_desc", "stop_lat", "stop_lon",
+                             "location_type", "parent_station", "zone_id"])
+            for city_index, size in enumerate(sizes):
+                city_name = CITY_NAMES[city_index % len(CITY_NAMES)]
+                city_lat, city_lon = rng.uniform(29.6, 33.2), rng.uniform(34.3, 35.7)
+                count = max(5, round(self.stop_count * size / total))
+                if city_index == len(sizes) - 1:
+                    count = max(5, self.stop_count - stop_id)
+                stops = []
+                for _ in range(count):
+                    if stop_id >= self.stop_count:
+                        break
+                    stop_id += 1
+                    name = f"{rng.choice(STREET_NAMES)}/{rng.choice(STREET_NAMES)}"
+                    self.stop_names[stop_id] = (name, city_name)
+                    writer.writerow([stop_id, stop_codes[stop_id - 1], name, f"רחוב: {name} עיר: {city_name}",
+                                     round(city_lat + rng.gauss(0, 0.02), 6), round(city_lon + rng.gauss(0, 0.02), 6),
+                                     0, "", city_index + 1])
+                    stops.append(stop_id)
+                if stops:
+                    self.city_stops.append(stops)
+                    # A few hub stops per city get most of the lines
+                    self.stop_weights.append([1 / (rank + 1) ** 0.9 for rank in range(len(stops))])
+        self.counts["stops"] = stop_id
+
+    def write_calendar(self, path: str):
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.writer(file)
+            writer.writerow(["service_id", "sunday", "monday", "tuesday", "wednesday", "thursday", "friday",
+                             "saturday", "start_date", "end_date"])
+            # Weekdays, Friday, Saturday night and every day, as in the national feed
+            writer.writerow([1, 1, 1, 1, 1, 1, 0, 0, 20260101, 20261231])
+            writer.writerow([2, 0, 0, 0, 0, 0, 1, 0, 20260101, 20261231])
+            writer.writerow([3, 0, 0, 0, 0, 0, 0, 1, 20260101, 20261231])
+            writer.writerow([4, 1, 1, 1, 1, 1, 1, 1, 20260101, 20261231])
+        self.counts["services"] = 4
+
+    def write_routes(self, path: str):
+        rng = self.rng
+        weights = [OPERATOR_SHARES.get(agency_id, DEFAULT_SHARE) for agency_id in self.agencies]
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.writer(file)
+            writer.writerow(["route_id", "agency_id", "route_short_name", "route_long_name", "route_desc",
+                             "route_type", "route_color"])
+            for route_id in range(1, self.route_count + 1):
+                agency_id = rng.choices(self.agencies, weights)[0]
+                # Line numbers are small and reused by several operators (and both directions)
+                short_name = str(min(999, int(rng.expovariate(1 / 60)) + 1))
+                pattern = self._route_pattern()
+                self.route_patterns[route_id] = pattern
+                (first_name, first_city), (last_name, last_city) = (self.stop_names[pattern[0]],
+                                                                    self.stop_names[pattern[-1]])
+                direction = rng.randint(1, 2)
+                writer.writerow([route_id, agency_id, short_name,
+                                 f"{first_name}-{first_city}<->{last_name}-{last_city}-{direction}#",
+                                 f"{route_id:05d}-{direction}-#", ROUTE_TYPES.get(agency_id, 3), ""])
+        self.counts["routes"] = self.route_count
+
+    def write_trips_and_stop_times(self, trips_path: str, stop_times_path: str):
+        rng = self.rng
+        trip_count = 0
+        stop_time_count = 0
+        with open(trips_path, "w", newline="", encoding="utf-8") as trips_file, \
+                open(stop_times_path, "w", newline="", encoding="utf-8", buffering=1 << 20) as stop_times_file:
+            trips_writer = csv.writer(trips_file)
+            stop_times_writer = csv.writer(stop_times_file)
+            trips_writer.writerow(["route_id", "service_id", "trip_id", "trip_headsign", "direction_id", "shape_id"])
+            stop_times_writer.writerow(["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence",
+                                        "pickup_type", "drop_off_type", "shape_dist_traveled"])
+            for route_id, pattern in self.route_patterns.items():
+                # Busy lines run every few minutes, rural lines a few times a day
+                trips = max(1, int(rng.lognormvariate(math.log(self.trips_per_route), 0.8)))
+                headsign = self.stop_names[pattern[-1]][0]
+                hops = [rng.randint(45, 180) for _ in pattern]
+                for trip_index in range(trips):
+                    trip_count += 1
+                    service_id = rng.choices((1, 2, 3, 4), (70, 10, 5, 15))[0]
+                    trip_id = f"{route_id}_{trip_index:04d}{service_id}"
+                    direction_id = trip_index % 2
+                    trips_writer.writerow([route_id, service_id, trip_id, headsign, direction_id, route_id])
+                    departure = rng.randint(5 * 3600, 24 * 3600)
+                    distance = 0
+                    rows = []
+                    for sequence, (stop_id, hop) in enumerate(zip(pattern, hops), start=1):
+                        clock = format_time(departure)
+                        rows.append((trip_id, clock, clock, stop_id, sequence, 0 if sequence < len(pattern) else 1,
+                                     1 if sequence == 1 else 0, distance))
+                        departure += hop
+                        distance += hop * 8
+                    stop_times_writer.writerows(rows)
+                    stop_time_count += len(rows)
+        self.counts["trips"] = trip_count
+        self.counts["stop_times"] = stop_time_count
+
+    def _route_pattern(self) -> list:
+        """
+        Ordered stops of a route: inside one city, or between two cities for intercity lines.
+        """
+        rng = self.rng
+        city_index = rng.choices(range(len(self.city_stops)), [len(stops) for stops in self.city_stops])[0]
+        cities = [city_index]
+        if len(self.city_stops) > 1 and rng.random() < 0.25:
+            cities.append(rng.randrange(len(self.city_stops)))
+        pattern = []
+        for index in cities:
+            stops, weights = self.city_stops[index], self.stop_weights[index]
+            length = min(len(stops), rng.randint(10, 40))
+            chosen = set()
+            while len(chosen) < length:
+                chosen.update(rng.choices(stops, weights, k=length - len(chosen)))
+            pattern.extend(sorted(chosen, key=lambda stop_id: rng.random()))
+        return pattern
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a deterministic synthetic GTFS feed.")
+    parser.add_argument("--scale", choices=SCALES, default="city")
+    parser.add_argument("--output-dir", default=os.path.join("benchmarks", "data", "gtfs"))
+    parser.add_argument("--stops", type=int, help="Override the number of stops of the scale")
+    parser.add_argument("--routes", type=int, help="Override the number of routes of the scale")
+    parser.add_argument("--trips-per-route", type=int, help="Override the mean number of trips per route")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    stops, cities, routes, trips_per_route = SCALES[args.scale]
+    generator = GtfsGenerator(stops=args.stops or stops, cities=cities, routes=args.routes or routes,
+                              trips_per_route=args.trips_per_route or trips_per_route, seed=args.seed)
+    started = time.perf_counter()
+    counts = generator.generate(args.output_dir)
+    print(f"Generated {counts} in {args.output_dir} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
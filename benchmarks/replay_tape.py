@@ -0,0 +1,334 @@
+"""
+Replay of a traffic tape (recorded with TRAFFIC_TAPE_PATH) against the app, offline.
+
+    poetry run python -m benchmarks.replay_tape --tape traffic.jsonl --speed 10
+
+The webhooks of the tape are posted to whatsapp_webhook at their recorded pace (--speed 1),
+compressed (--speed 10) or as fast as --concurrency allows (--speed max). The upstreams are
+served from the tape with their recorded latency:
+
+- SIRI: the response of the stop recorded last before the replayed moment, its arrival
+  times shifted by the time elapsed since the recording (so the ETAs are the recorded ones);
+- the alerts feed, its active periods shifted alike;
+- the chat completions, by sanitized user message, in recording order.
+
+Requests missing from the tape fall back to the generators of benchmarks.fake_upstreams and
+are counted. It reports the throughput and the webhook and reply latencies next to the
+recorded ones, to compare a change against real traffic shapes.
+"""
+import argparse
+import asyncio
+import bisect
+import copy
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+from aiohttp import web
+
+from benchmarks.bench_webhook import configure_environment, percentile
+from benchmarks.fake_upstreams import FakeUpstreams, build_chat_completion
+
+
+class TapeUpstreams(FakeUpstreams):
+    """
+    FakeUpstreams answering from the upstream responses of a tape.
+
+    tape_clock is the tape time (seconds from the start of the recording) being replayed; the
+    replay moves it forward as it posts the webhooks.
+    """
+
+    def __init__(self, entries: list, recorded_latency: bool = True, whapi_latency: float = 0.02):
+        super().__init__(whapi_latency=whapi_latency)
+        from app.utils.traffic_tape import upstream_body
+
+        self.recorded_latency = recorded_latency
+        self.tape_clock = 0.0
+        self.misses = {"siri": 0, "alerts": 0, "openai": 0}
+        self._siri_responses = {}
+        self._alerts_feeds = []
+        self._completions = {}
+        for entry in entries:
+            if entry.get("type") != "upstream":
+                continue
+            recorded = (entry["t"], entry.get("at", 0.0), entry.get("duration", 0.0), upstream_body(entry))
+            if entry["service"] == "siri":
+                self._siri_responses.setdefault(entry["key"], []).append(recorded)
+            elif entry["service"] == "alerts":
+                self._alerts_feeds.append(recorded)
+            elif entry["service"] == "openai":
+                self._completions.setdefault(entry["key"], []).append(recorded)
+        # The workers recording the tape append their entries independently: order them by time
+        for recordings in (*self._siri_responses.values(), self._alerts_feeds, *self._completions.values()):
+            recordings.sort(key=lambda recorded: recorded[0])
+        self._completion_index = {key: 0 for key in self._completions}
+
+    def _recorded_at(self, recordings: list) -> tuple:
+        """
+        The recording made last before the replayed moment (the first one before it starts).
+        """
+        index = bisect.bisect_right([recorded[0] for recorded in recordings], self.tape_clock)
+        return recordings[max(0, index - 1)]
+
+    async def _wait(self, duration: float):
+        if self.recorded_latency and duration > 0:
+            await asyncio.sleep(duration)
+
+    async def _siri(self, request):
+        recordings = self._siri_responses.get(request.query.get("MonitoringRef", ""))
+        if not recordings:
+            self.misses["siri"] += 1
+            return await super()._siri(request)
+        self.requests["siri"] += 1
+        _, recorded_at, duration, body = self._recorded_at(recordings)
+        await self._wait(duration)
+        return web.json_response(shift_siri_response(body, time.time() - recorded_at))
+
+    async def _alerts(self, request):
+        if not self._alerts_feeds:
+            self.misses["alerts"] += 1
+            return await super()._alerts(request)
+        self.requests["alerts"] += 1
+        _, recorded_at, duration, body = self._recorded_at(self._alerts_feeds)
+        await self._wait(duration)
+        return web.Response(body=shift_alerts_feed(body, time.time() - recorded_at),
+                            content_type="application/x-protobuf")
+
+    async def _openai(self, request):
+        from app.utils.traffic_tape import llm_key
+
+        self.requests["openai"] += 1
+        messages = (await request.json()).get("messages", [])
+        key = llm_key(messages)
+        recordings = self._completions.get(key)
+        if not recordings:
+            self.misses["openai"] += 1
+            await asyncio.sleep(self.llm_latency if self.recorded_latency else 0)
+            return web.json_response(build_chat_completion(messages))
+        # The same message asked again gets the next recorded answer (the last one repeats)
+        index = self._completion_index[key]
+        self._completion_index[key] = min(index + 1, len(recordings) - 1)
+        _, _, duration, body = recordings[index]
+        await self._wait(duration)
+        return web.json_response(body)
+
+
+def shift_siri_response(body: dict, seconds: float) -> dict:
+    """
+    Copy of a SIRI response with its expected arrival times moved by the given seconds.
+    """
+    shifted = copy.deepcopy(body)
+    deliveries = shifted.get("Siri", {}).get("ServiceDelivery", {}).get("StopMonitoringDelivery") or []
+    for delivery in deliveries:
+        for visit in delivery.get("MonitoredStopVisit") or []:
+            call = visit.get("MonitoredVehicleJourney", {}).get("MonitoredCall", {})
+            if call.get("ExpectedArrivalTime"):
+                expected = datetime.fromisoformat(call["ExpectedArrivalTime"]) + timedelta(seconds=seconds)
+                call["ExpectedArrivalTime"] = expected.replace(microsecond=0).isoformat()
+    return shifted
+
+
+def shift_alerts_feed(body: bytes, seconds: float) -> bytes:
+    """
+    Copy of a GTFS-RT alerts feed with its timestamp and active periods moved by the given seconds.
+    """
+    from app.utils import gtfs_realtime_pb2
+
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(body)
+    shift = int(seconds)
+    feed.header.timestamp += shift
+    for entity in feed.entity:
+        for period in entity.alert.active_period:
+            if period.start:
+                period.start += shift
+            if period.end:
+                period.end += shift
+    return feed.SerializeToString()
+
+
+def replayable_webhooks(entries: list) -> tuple:
+    """
+    The webhooks of a tape in recording order, keeping only their text messages (the media of
+    voice messages isn't recorded).
+
+    Returns:
+        tuple: (webhook entries, number of messages skipped).
+    """
+    webhooks = []
+    skipped = 0
+    for entry in entries:
+        if entry.get("type") != "webhook":
+            continue
+        payload = entry["payload"]
+        messages = payload.get("messages")
+        if messages is not None:
+            text_messages = [message for message in messages if message.get("type") == "text"]
+            skipped += len(messages) - len(text_messages)
+            if not text_messages:
+                continue
+            entry = dict(entry, payload=dict(payload, messages=text_messages))
+        webhooks.append(entry)
+    webhooks.sort(key=lambda entry: entry["t"])
+    return webhooks, skipped
+
+
+def reply_recipients(payload: dict) -> set:
+    """
+    Recipients the app answers for the messages of a webhook (as group_messages_by_chat).
+    """
+    recipients = set()
+    for message in payload.get("messages") or []:
+        if message.get("from_me"):
+            continue
+        chat_id = message.get("chat_id", "")
+        recipients.add(chat_id if chat_id.endswith("@g.us") else f"{message.get('from')}@s.whatsapp.net")
+    return recipients
+
+
+async def replay(args, webhooks: list, upstreams: TapeUpstreams) -> dict:
+    import httpx
+    from app.api.main import app, lifespan
+
+    loop = asyncio.get_running_loop()
+    reply_waiters = {}
+
+    def on_sent(recipient, body):
+        # Turns of a chat answered together are coalesced by the sender into one message
+        waiters = reply_waiters.pop(recipient, [])
+        for future in waiters:
+            loop.call_soon_threadsafe(lambda future=future: future.done() or future.set_result(time.perf_counter()))
+
+    upstreams.on_sent(on_sent)
+
+    webhook_latencies = []
+    reply_latencies = []
+    counts = {"errors": 0, "no_reply": 0}
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async with lifespan(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://helpy") as client:
+
+            async def post(entry: dict):
+                replies = []
+                for recipient in reply_recipients(entry["payload"]):
+                    reply = loop.create_future()
+                    reply_waiters.setdefault(recipient, []).append(reply)
+                    replies.append((recipient, reply))
+                start = time.perf_counter()
+                try:
+                    response = await client.post("/webhook/whatsapp", json=entry["payload"])
+                finally:
+                    limit.release()
+                webhook_latencies.append(time.perf_counter() - start)
+                if response.status_code != 200 or not response.json().get("success"):
+                    counts["errors"] += 1
+                for recipient, reply in replies:
+                    try:
+                        replied_at = await asyncio.wait_for(reply, timeout=args.reply_timeout)
+                        reply_latencies.append(replied_at - start)
+                    except asyncio.TimeoutError:
+                        counts["no_reply"] += 1
+                        if reply in reply_waiters.get(recipient, []):
+                            reply_waiters[recipient].remove(reply)
+
+            tasks = []
+            started = time.perf_counter()
+            first = webhooks[0]["t"] if webhooks else 0.0
+            for entry in webhooks:
+                if args.speed is not None:
+                    delay = (entry["t"] - first) / args.speed - (time.perf_counter() - started)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                upstreams.tape_clock = entry["t"]
+                await limit.acquire()
+                tasks.append(asyncio.create_task(post(entry)))
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - started
+
+    recorded = [entry.get("duration", float("nan")) for entry in webhooks]
+    span = (webhooks[-1]["t"] - first) if webhooks else 0.0
+    return {
+        "webhooks": len(webhooks),
+        "speed": "max" if args.speed is None else args.speed,
+        "tape_span_s": span,
+        "elapsed_s": elapsed,
+        "throughput_rps": len(webhooks) / elapsed if elapsed else float("nan"),
+        **counts,
+        "webhook_ms": {name: 1000 * percentile(webhook_latencies, q)
+                       for name, q in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))},
+        "recorded_webhook_ms": {name: 1000 * percentile(recorded, q)
+                                for name, q in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))},
+        "reply_ms": {name: 1000 * percentile(reply_latencies, q)
+                     for name, q in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))},
+        "upstream_requests": dict(upstreams.requests),
+        "tape_misses": dict(upstreams.misses),
+    }
+
+
+def parse_speed(value: str):
+    """
+    "1", "10x" -> a factor; "max" -> None (no pacing).
+    """
+    value = value.lower()
+    if value == "max":
+        return None
+    value = value.removesuffix("x")
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("The speed must be positive")
+    return speed
+
+
+def print_report(report: dict, skipped: int):
+    speed = report["speed"] if report["speed"] == "max" else f"{report['speed']:g}x"
+    print(f"{report['webhooks']} webhooks ({skipped} non-text messages skipped), tape span "
+          f"{report['tape_span_s']:.1f}s, speed {speed}: {report['elapsed_s']:.2f}s, "
+          f"{report['throughput_rps']:.1f} req/s, {report['errors']} errors, {report['no_reply']} without reply")
+    for name in ("webhook_ms", "recorded_webhook_ms", "reply_ms"):
+        latencies = report[name]
+        print(f"{name:<20} p50 {latencies['p50']:8.1f}  p95 {latencies['p95']:8.1f}  p99 {latencies['p99']:8.1f}")
+    print("upstream requests:", report["upstream_requests"])
+    print("not on the tape:", report["tape_misses"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a traffic tape against the app.")
+    parser.add_argument("--tape", required=True, help="Tape recorded with TRAFFIC_TAPE_PATH")
+    parser.add_argument("--speed", type=parse_speed, default=1.0, help="1, 10 (times the recorded pace) or max")
+    parser.add_argument("--concurrency", type=int, default=100, help="Webhooks in flight at most")
+    parser.add_argument("--no-upstream-latency", action="store_true",
+                        help="Answer from the tape at once instead of with the recorded latency")
+    parser.add_argument("--whapi-latency", type=float, default=0.02)
+    parser.add_argument("--keep-rate-limits", action="store_true",
+                        help="Keep the configured rate limits (lifted by default)")
+    parser.add_argument("--reply-timeout", type=float, default=30.0)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    # The replay itself isn't recorded
+    os.environ["TRAFFIC_TAPE_PATH"] = ""
+    from app.utils.traffic_tape import read_tape
+
+    entries = read_tape(args.tape)
+    webhooks, skipped = replayable_webhooks(entries)
+    upstreams = TapeUpstreams(entries, recorded_latency=not args.no_upstream_latency,
+                              whapi_latency=args.whapi_latency).start()
+    try:
+        if args.keep_rate_limits:
+            os.environ.update(upstreams.env())
+        else:
+            configure_environment(upstreams)
+        report = asyncio.run(replay(args, webhooks, upstreams))
+    finally:
+        upstreams.stop()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report, skipped)
+
+
+if __name__ == "__main__":
+    main()